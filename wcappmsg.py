@@ -0,0 +1,98 @@
+import io
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+from lxml import etree
+
+# xml标头，删除以免解析出错
+XML_HEADER_RE = re.compile(r'<\?.*\?>')
+# 与PyQuery.text()一致：连续的空白合并为一个空格
+WHITESPACE_RE = re.compile('[\x20\x09\x0C\u200B\x0A\x0D]+')
+# 被回复的是分享/回复等appmsg时，它的标题
+REFER_TITLE_RE = re.compile(r'<title>(.*?)</title>')
+# 被回复的是表情时，表情的地址
+REFER_EMOJI_URL_RE = re.compile(r'"http\*#\*//(.*?)" ')
+# 按msgId缓存的解析结果条数
+APPMSG_CACHE = 4096
+
+'''content解析后的记录，没有的字段为空字符串，attrs为<msg>的属性'''
+AppMsg = namedtuple('AppMsg', ['title', 'des', 'url', 'type', 'template', 'displayname', 'refer_type',
+                               'refer_content', 'emoticonmd5', 'sendertitle', 'attrs'])
+
+'''相对<msg>的路径 -> 字段；APPMSG_ANYWHERE中的字段不论位置，取第一个同名元素'''
+APPMSG_FIELDS = {
+    ('appmsg', 'title'): 'title',
+    ('appmsg', 'des'): 'des',
+    ('appmsg', 'url'): 'url',
+    ('appmsg', 'type'): 'type',
+    ('appmsg', 'refermsg', 'displayname'): 'displayname',
+    ('appmsg', 'refermsg', 'type'): 'refer_type',
+    ('appmsg', 'refermsg', 'content'): 'refer_content',
+}
+APPMSG_ANYWHERE = {'template': 'template', 'emoticonmd5': 'emoticonmd5', 'sendertitle': 'sendertitle'}
+# 显示用的字段，和原来的PyQuery(...).text()一样合并空白
+APPMSG_SQUASH = ('title', 'des', 'url', 'emoticonmd5')
+
+_appmsg_cache = OrderedDict()
+_appmsg_lock = threading.Lock()
+
+
+def squash_text(text):
+    """
+    合并连续的空白并去掉首尾空白
+
+    :param text:
+    :return:
+    """
+    return WHITESPACE_RE.sub(' ', text).strip()
+
+
+def _parse_appmsg(message):
+    fields = dict.fromkeys(AppMsg._fields, '')
+    fields['attrs'] = {}
+    found = set()
+    path = []
+    xml = XML_HEADER_RE.sub('', message or '').encode('utf-8')
+    try:
+        '''lxml流式解析，容错模式下不规范的XML也能取出前面的字段'''
+        for event, elem in etree.iterparse(io.BytesIO(xml), events=('start', 'end'), recover=True):
+            if event == 'start':
+                if not path:
+                    fields['attrs'] = dict(elem.attrib)
+                path.append(elem.tag)
+                continue
+            key = tuple(path[1:])
+            field = APPMSG_FIELDS.get(key) or APPMSG_ANYWHERE.get(elem.tag)
+            if field is not None and field not in found:
+                found.add(field)
+                fields[field] = elem.text or ''
+            path.pop()
+            if len(path) > 1:
+                elem.clear()
+    except etree.LxmlError:
+        pass
+    for field in APPMSG_SQUASH:
+        fields[field] = squash_text(fields[field])
+    return AppMsg(**fields)
+
+
+def parse_appmsg(message, msgId=None):
+    """
+    解析消息的content（分享/文件/回复/拍一拍/名片/表情/转账/红包）：只解析一次，各处理函数直接读取字段
+
+    :param message: content
+    :param msgId: 消息id，不为空时按msgId缓存结果
+    :return: AppMsg
+    """
+    if msgId is None:
+        return _parse_appmsg(message)
+    with _appmsg_lock:
+        appmsg = _appmsg_cache.get(msgId)
+    if appmsg is None:
+        appmsg = _parse_appmsg(message)
+        with _appmsg_lock:
+            _appmsg_cache[msgId] = appmsg
+            if len(_appmsg_cache) > APPMSG_CACHE:
+                _appmsg_cache.popitem(last=False)
+    return appmsg
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    '''Windows没有fcntl，不能硬链接时直接复制'''
+    fcntl = None
+
+# 导出的文件/视频/语音在导出目录下只保存一份，文件名为内容的md5，各月份文件夹里是指向它的硬链接
+BLOB_DIR = 'blob_store'
+# Linux的FICLONE：btrfs/xfs等文件系统上共享数据块的写时复制拷贝
+FICLONE = 0x40049409
+
+
+def link_file(src, dst):
+    """
+    把src放到dst：优先硬链接，跨文件系统等不能硬链接时用reflink，都不支持时复制
+
+    :param src: 源文件
+    :param dst: 目标路径，已存在时替换
+    """
+    if os.path.isfile(dst) and os.path.samefile(src, dst):
+        return
+    tmp_file = dst + '.' + str(os.getpid())
+    if os.path.lexists(tmp_file):
+        os.remove(tmp_file)
+    try:
+        os.link(src, tmp_file)
+    except OSError:
+        try:
+            if fcntl is None:
+                raise OSError('reflink is not supported')
+            with open(src, 'rb') as fsrc, open(tmp_file, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfile(src, tmp_file)
+    os.replace(tmp_file, dst)
+
+
+class BlobStore(object):
+    """
+    按内容寻址的附件仓库：同一个文件不管转发多少次、导出多少个月份，在磁盘上只占一份
+    """
+
+    def __init__(self, root=BLOB_DIR):
+        """
+        :param root: 仓库文件夹
+        """
+        self.root = root
+        '''{(路径, 大小, 修改时间): md5}，同一个文件在一次运行中只读一遍'''
+        self._md5 = {}
+
+    def md5(self, src):
+        """
+        计算文件内容的md5，分块读取，视频再大也不会占满内存
+
+        :param src: 文件路径
+        :return: md5
+        """
+        st = os.stat(src)
+        key = (os.path.abspath(src), st.st_size, st.st_mtime_ns)
+        if key not in self._md5:
+            m = hashlib.md5()
+            with open(src, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    m.update(chunk)
+            self._md5[key] = m.hexdigest()
+        return self._md5[key]
+
+    def put(self, src):
+        """
+        把文件存入仓库
+
+        :param src: 文件路径
+        :return: 仓库中的路径
+        """
+        md5 = self.md5(src)
+        blob = os.path.join(self.root, md5[:2], md5 + os.path.splitext(src)[1].lower())
+        if not os.path.isfile(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            '''先复制到临时文件再改名，并行导出时不会用到复制了一半的文件'''
+            tmp_file = blob + '.' + str(os.getpid())
+            shutil.copyfile(src, tmp_file)
+            os.replace(tmp_file, blob)
+        return blob
+
+    def link(self, src, dst):
+        """
+        把文件放到文档旁的文件夹：存入仓库后链接到dst
+
+        :param src: 文件路径
+        :param dst: 目标路径
+        """
+        link_file(self.put(src), dst)
+
+
+_blob_store = None
+
+
+def get_blob_store():
+    """
+    导出目录下默认的附件仓库
+
+    :return: BlobStore
+    """
+    global _blob_store
+    if _blob_store is None:
+        _blob_store = BlobStore()
+    return _blob_store
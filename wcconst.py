@@ -0,0 +1,47 @@
+import time
+from collections import namedtuple
+
+# TYPE模式的宏定义
+TYPE_MSG = 1
+TYPE_IMG = 3
+TYPE_SPEAK = 34
+TYPE_NAME_CARD = 42
+TYPE_VIDEO_FILE = 43
+TYPE_BIG_EMOJI = 47
+TYPE_LINK = 49  # 链接共享或来自网络的文件, see https://github.com/ppwwyyxx/wechat-dump/issues/52
+TYPE_VOIP = 50  # 语音通话
+TYPE_SYSTEM = 10000  # 撤回/转账接收/拒收消息
+TYPE_CUSTOM_EMOJI = 1048625
+TYPE_WITHDRAW_MSG = 268445456  # 撤回的消息
+TYPE_MONEY_TRANSFER = 419430449  # 微信转账
+TYPE_LUCKY_MONEY = 436207665  # 发红包
+TYPE_ANSWER_MSG = 822083633  # 回复消息
+TYPE_SHOT = 922746929  # 拍一拍
+TYPE_FILE = 1090519089  # 发送文件
+TYPE_APP_MSG = 16777265
+
+# 显示时间的格式
+LOVE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+'''按列读出的聊天记录：createTime为int64毫秒时间戳，isSend为uint8，type为int64，按时间排序'''
+LoveColumns = namedtuple('LoveColumns', ['createTime', 'isSend', 'type'])
+
+
+def love_time_to_ms(love_time):
+    """
+    把'%Y-%m-%d %H:%M:%S'格式的本地时间转换为毫秒时间戳（与msg.createTime一致）
+
+    :param love_time:
+    :return: 毫秒时间戳
+    """
+    return int(time.mktime(time.strptime(love_time, LOVE_TIME_FORMAT))) * 1000
+
+
+def love_ms_to_time(love_ms):
+    """
+    把毫秒时间戳转换为'%Y-%m-%d %H:%M:%S'格式的本地时间
+
+    :param love_ms: 毫秒时间戳
+    :return: 本地时间
+    """
+    return time.strftime(LOVE_TIME_FORMAT, time.localtime(love_ms // 1000))
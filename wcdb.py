@@ -1,49 +1,100 @@
+import argparse
+import contextlib
+import copy
 import hashlib
 import io
 import os
 import re
-import shutil
 import time
 import itertools
-import xml.etree.ElementTree as ET
-from urllib.request import urlretrieve
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.util import Finalize
+from collections import namedtuple, deque
 
 import docx
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
-import requests
+import numpy as np
 from docx import shared
 from docx.enum.dml import MSO_THEME_COLOR_INDEX
+from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.table import WD_ALIGN_VERTICAL
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT, WD_COLOR_INDEX
 from docx.opc.constants import RELATIONSHIP_TYPE
 from docx.oxml.ns import qn
+from docx.oxml.shape import CT_Inline
 from docx.oxml.shared import OxmlElement
 from docx.shared import Pt
-from pyquery import PyQuery
+from docx.table import Table
 from pysqlcipher3 import dbapi2 as sqlite
 from termcolor import colored
 
-# TYPE模式的宏定义
-TYPE_MSG = 1
-TYPE_IMG = 3
-TYPE_SPEAK = 34
-TYPE_NAME_CARD = 42
-TYPE_VIDEO_FILE = 43
-TYPE_BIG_EMOJI = 47
-TYPE_LINK = 49  # 链接共享或来自网络的文件, see https://github.com/ppwwyyxx/wechat-dump/issues/52
-TYPE_VOIP = 50  # 语音通话
-TYPE_SYSTEM = 10000  # 撤回/转账接收/拒收消息
-TYPE_CUSTOM_EMOJI = 1048625
-TYPE_WITHDRAW_MSG = 268445456  # 撤回的消息
-TYPE_MONEY_TRANSFER = 419430449  # 微信转账
-TYPE_LUCKY_MONEY = 436207665  # 发红包
-TYPE_ANSWER_MSG = 822083633  # 回复消息
-TYPE_SHOT = 922746929  # 拍一拍
-TYPE_FILE = 1090519089  # 发送文件
-TYPE_APP_MSG = 16777265
+from wcappmsg import REFER_EMOJI_URL_RE, REFER_TITLE_RE, XML_HEADER_RE, parse_appmsg
+from wcblob import get_blob_store
+from wcconst import (TYPE_ANSWER_MSG, TYPE_APP_MSG, TYPE_BIG_EMOJI, TYPE_CUSTOM_EMOJI, TYPE_FILE, TYPE_IMG, TYPE_LINK,
+                     TYPE_LUCKY_MONEY, TYPE_MONEY_TRANSFER, TYPE_MSG, TYPE_NAME_CARD, TYPE_SHOT, TYPE_SPEAK, TYPE_SYSTEM,
+                     TYPE_VIDEO_FILE, TYPE_VOIP, TYPE_WITHDRAW_MSG, LoveColumns, love_ms_to_time, love_time_to_ms)
+from wcemoji import EmojiFetcher, emoji_cdn_url, get_emoji_fetcher
+from wcimage import IMAGE_MAX_PX, IMAGE_QUALITY, ImageCache, get_image_cache
+from wcmedia import get_media_index
+from wcnet import AssetCache, get_asset_cache
+from wcstats import love_night
+from wcvoice import get_voice_cache
+from wcwords import LOVE_WORDS, LoveWord, WordMatcher
 
 MSG_MAX = 20
+# 通话消息lvbuffer中的时长：聊天时长/通话时长/通话中断 mm:ss或hh:mm:ss
+VOIP_DURATION_RE = re.compile(r'(?:聊天时长|通话时长|通话中断)\s*(\d+(?::\d+)+)')
+# 每次从游标取出的行数：内存占用只和批大小有关，和聊天记录多少无关
+LOVE_BATCH = 500
+# 后台线程提前准备图片的消息条数和线程数
+LOVE_PREFETCH = 32
+LOVE_PREFETCH_WORKERS = 4
+
+'''按固定间隔统计的消息数：times为每个区间开始的日期，counts为各区间的消息数'''
+LoveEvery = namedtuple('LoveEvery', ['times', 'counts', 'max_count', 'max_time', 'total'])
+
+
+class LoveMsg(object):
+    """
+    导出用的一条聊天记录：时间保存为毫秒时间戳createTime（与msg.createTime一致），
+    显示用的时间字符串theTime在第一次用到时才格式化
+    """
+    __slots__ = ('createTime', 'person', 'isSend', 'message', 'type', 'imgPath', 'status', 'msgId', 'buffer',
+                 '_theTime')
+    _fields = __slots__[:-1]
+
+    def __init__(self, createTime, person, isSend, message, type, imgPath, status, msgId, buffer):
+        self.createTime = createTime
+        self.person = person
+        self.isSend = isSend
+        self.message = message
+        self.type = type
+        self.imgPath = imgPath
+        self.status = status
+        self.msgId = msgId
+        self.buffer = buffer
+        self._theTime = None
+
+    @classmethod
+    def _make(cls, row):
+        return cls(*row)
+
+    @property
+    def theTime(self):
+        """
+        本地时间，'%Y-%m-%d %H:%M:%S'格式
+        """
+        if self._theTime is None:
+            self._theTime = love_ms_to_time(self.createTime)
+        return self._theTime
+
+    def _asdict(self):
+        love_dict = {'theTime': self.theTime}
+        love_dict.update((field, getattr(self, field)) for field in self._fields)
+        return love_dict
+
 
 def remove_control_chars(s):
     """
@@ -86,6 +137,141 @@ def close_wcdb(msg_c, file_c, msg, file):
     file_c.close()
 
 
+class LoveSession(object):
+    """
+    导出会话：整个导出过程只打开一次数据库（只读），并缓存自己和联系人的wxid
+
+    用法：
+        with LoveSession() as session:
+            love_all('备注', '2021-01-01 00:00:00', '2022-01-01 00:00:00', session=session)
+    """
+
+    def __init__(self, media=None, images=None, prefetch=LOVE_PREFETCH, emoji=None, assets=None):
+        """
+        :param media: 媒体文件索引，为空时使用当前目录的全局索引
+        :param images: 图片缓存（ImageCache），为空时使用默认设置
+        :param prefetch: 导出时后台线程提前准备图片的消息条数，0为不预读
+        :param emoji: 表情包下载（EmojiFetcher），为空时使用assets
+        :param assets: 网络文件缓存（AssetCache），为空时使用emoji的缓存或默认设置
+        """
+        self.msg_cur, self.file_cur, self.msg_con, self.file_con = connect_wcdb()
+        '''只读模式，导出过程中不会改动解密后的数据库'''
+        self.msg_cur.execute('PRAGMA query_only = ON;')
+        self.file_cur.execute('PRAGMA query_only = ON;')
+        self._self_wxid = None
+        self._love_wxid = {}
+        self._media = media
+        self.images = images if images is not None else get_image_cache()
+        self.prefetch = prefetch
+        if assets is None:
+            assets = emoji.assets if emoji is not None else get_asset_cache()
+        self.assets = assets
+        self.emoji = emoji if emoji is not None else EmojiFetcher(assets=assets)
+        '''当前消息预读好的图片：{原图路径: 插入文档用的图片内容}'''
+        self.prefetched = {}
+        '''头像图片内容，以wxid为键，跨月份的文档共用'''
+        self.avatars = {}
+
+    @property
+    def media(self):
+        """
+        媒体文件索引（第一次使用时才扫描）
+        """
+        if self._media is None:
+            self._media = get_media_index()
+        return self._media
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        关闭数据库连接
+        """
+        self.msg_cur.close()
+        self.file_cur.close()
+        self.msg_con.close()
+        self.file_con.close()
+
+    def query(self, sql, params=()):
+        """
+        在聊天数据库上执行查询，每次返回新的游标，互不干扰
+
+        :param sql:
+        :param params: 绑定参数
+        :return: 游标
+        """
+        return self.msg_con.execute(sql, params)
+
+    def iter_rows(self, sql, params=(), row_type=None, batch_size=LOVE_BATCH):
+        """
+        执行查询，用fetchmany分批取出结果，逐行返回
+
+        :param sql:
+        :param params: 绑定参数
+        :param row_type: 行类型（有_make的namedtuple或LoveMsg），为空时按查询的列名生成
+        :param batch_size: 每批取出的行数
+        :return: 生成器
+        """
+        cur = self.query(sql, params)
+        if row_type is None:
+            row_type = namedtuple('LoveRow', [col[0] for col in cur.description])
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row_type._make(row)
+        finally:
+            cur.close()
+
+    def get_self_wxid(self):
+        """
+        获取自己的wxid（只查询一次）
+
+        :return: wxid
+        """
+        if self._self_wxid is None:
+            select_self_wxid = 'SELECT value ' \
+                               'FROM userinfo ' \
+                               'WHERE value like "wxid#_%" ESCAPE "#";'
+            self._self_wxid = self.query(select_self_wxid).fetchall()[0][0]
+        return self._self_wxid
+
+    def get_love_wxid(self, conRemark):
+        """
+        获取指定备注名的wxid（每个备注只查询一次）
+
+        :param conRemark:
+        :return: wxid
+        """
+        if conRemark not in self._love_wxid:
+            select_love_wxid = 'SELECT username ' \
+                               'FROM rcontact ' \
+                               'WHERE conRemark = ?;'
+            self._love_wxid[conRemark] = self.query(select_love_wxid, (conRemark,)).fetchall()[0][0]
+        return self._love_wxid[conRemark]
+
+
+@contextlib.contextmanager
+def love_session(session=None):
+    """
+    传入会话时直接复用；否则临时打开一个会话，用完即关闭
+
+    :param session:
+    :return: 会话
+    """
+    if session is not None:
+        yield session
+        return
+    with LoveSession() as session:
+        yield session
+
+
 def get_md5(text):
     """
     将wxid使用MD5编码加密, 加密结果是用户头像路径
@@ -99,52 +285,146 @@ def get_md5(text):
     return m.hexdigest()
 
 
-def get_avator_path(wxid):
+def get_media(session=None):
+    """
+    获取媒体文件索引：有会话时用会话中的索引，否则用当前目录的全局索引
+
+    :param session:
+    :return: MediaIndex
+    """
+    if session is not None:
+        return session.media
+    return get_media_index()
+
+
+def get_images(session=None):
+    """
+    获取图片缓存：有会话时用会话的设置，否则用默认设置
+
+    :param session:
+    :return: ImageCache
+    """
+    if session is not None:
+        return session.images
+    return get_image_cache()
+
+
+def get_emoji(session=None):
+    """
+    获取表情包下载：有会话时用会话的设置，否则用默认设置
+
+    :param session:
+    :return: EmojiFetcher
+    """
+    if session is not None:
+        return session.emoji
+    return get_emoji_fetcher()
+
+
+def get_assets(session=None):
+    """
+    获取网络文件缓存：有会话时用会话的设置，否则用默认设置
+
+    :param session:
+    :return: AssetCache
+    """
+    if session is not None:
+        return session.assets
+    return get_asset_cache()
+
+
+def get_display_image(image_file, session=None):
+    """
+    获取插入文档用的图片：过大的图片缩小后缓存
+
+    :param image_file: 原图路径
+    :param session: 导出会话
+    :return: 图片路径
+    """
+    return get_images(session).prepare(image_file)
+
+
+def read_display_image(image_file, session=None):
+    """
+    读取插入文档用的图片：优先使用后台线程预读好的内容
+
+    :param image_file: 原图路径
+    :param session: 导出会话
+    :return: 图片内容
+    """
+    if session is not None and image_file in session.prefetched:
+        return session.prefetched.pop(image_file)
+    with open(get_display_image(image_file, session), 'rb') as f:
+        return f.read()
+
+
+def get_avator_path(wxid, session=None):
     """
     获取头像文件完整路径
 
     :param wxid:
+    :param session: 导出会话
     :return:
     """
     avatar = get_md5(wxid)
     # print(avatar)
-    avatar_path = r"./avatar/"
-    path = avatar_path + avatar[:2] + '/' + avatar[2:4]
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            if avatar in file:
-                avatar = file
-                break
-    return path + '/' + avatar
+    avatar_file = get_media(session).avatar(avatar)
+    if avatar_file is None:
+        return r"./avatar/" + avatar[:2] + '/' + avatar[2:4] + '/' + avatar
+    return avatar_file
+
+
+def get_avatar_blob(wxid, session=None):
+    """
+    读取头像图片：有导出会话时每个头像只读一次
 
+    :param wxid:
+    :param session: 导出会话
+    :return: 图片内容
+    """
+    avatars = session.avatars if session is not None else {}
+    if wxid not in avatars:
+        with open(get_avator_path(wxid, session), 'rb') as f:
+            avatars[wxid] = f.read()
+    return avatars[wxid]
 
-def get_emoji_path(msg, imgPath):
+
+def get_sender_wxid(isSend, person, session=None):
+    """
+    获取发送者的wxid
+
+    :param isSend:
+    :param person: 备注
+    :param session: 导出会话
+    :return: wxid
+    """
+    if isSend:
+        return get_self_wxid(session)
+    return get_love_wxid(person, session)
+
+
+def get_emoji_path(msg, imgPath, session=None):
     """
     获取表情包路径
 
     :param msg: content
     :param imgPath:
+    :param session: 导出会话
     :return: ret, 路径
     """
     try:
-        Path = r'./emoji'
-        for root, dirs, files in os.walk(Path):
-            for file in files:
-                if imgPath + '_cover' in file:
-                    emoji_path = root + '/' + file
-                    return 1, emoji_path
-        for root, dirs, files in os.walk(Path):
-            for file in files:
-                if imgPath in file:
-                    emoji_path = root + '/' + file
-                    return 1, emoji_path
+        media = get_media(session)
+        emoji_path = media.emoji(imgPath)
+        if emoji_path is not None:
+            return 1, emoji_path
         # path = f'.//emoji//{imgPath}'
         # is_Exist = os.path.exists(path)
         # if not is_Exist:
         '''表情包不存在，则下载表情包到emoji文件夹中'''
-        ret = download_emoji(msg, imgPath)
+        ret = download_emoji(msg, imgPath, session)
         if ret == 0:
             return 0, 0
+        media.add_emoji(imgPath)
         emoji_path = f'./emoji/{imgPath}'
         return 1, emoji_path
         # image(doc, isSend, Type=47, content=content, imgPath=imgPath)
@@ -153,46 +433,96 @@ def get_emoji_path(msg, imgPath):
         # print("can't find emoji!")
 
 
-def download_emoji(content, img_path):
+def download_emoji(content, img_path, session=None):
     """
-    下载emoji文件
+    下载emoji文件（一般已由prefetch_love_emoji提前下载，这里只处理漏掉的）
 
     :param content:
     :param img_path:
+    :param session: 导出会话
     :return: ret
     """
-    try:
-        url = content.split('cdnurl = "')[1].split('"')[0]
-        url = ':'.join(url.split('*#*'))
-        if 'amp;' in url:
-            url = ''.join(url.split('amp;'))
-            # print('emoji downloading!!!')
-        # print(url)
-        # print('1')
-        resp = requests.get(url)
-        with open(f'./emoji/{img_path}', 'wb') as f:
-            f.write(resp.content)
-        return 1
-    except Exception:
+    emoji = get_emoji(session)
+    if emoji.fetch(img_path, emoji_cdn_url(content)) is None:
         # print("emoji download error")
+        emoji.save_dead()
         return 0
+    return 1
+
+
+def prefetch_love_emoji(conRemark, timeStart, timeEnd, session=None):
+    """
+    导出前扫描时间范围内的表情消息（47和1048625），并发下载本地没有的表情包，
+    写文档时不再逐个同步下载
+
+    :param conRemark: 备注
+    :param timeStart: 开始时间
+    :param timeEnd: 结束时间
+    :param session: 导出会话，为空时临时打开数据库
+    :return: 下载成功的表情包数
+    """
+    select_love_emoji = 'SELECT msg.type AS type,' \
+                        'msg.msgId AS msgId,' \
+                        'msg.imgPath AS imgPath,' \
+                        'msg.content AS message ' \
+                        'FROM message msg ' \
+                        'WHERE msg.talker = ? ' \
+                        'AND msg.createTime >= ? ' \
+                        'AND msg.createTime < ? ' \
+                        'AND msg.type IN (?, ?);'
+    with love_session(session) as session:
+        talker = session.get_love_wxid(conRemark)
+        media = get_media(session)
+        emojis = {}
+        for row in session.iter_rows(select_love_emoji, (talker, love_time_to_ms(timeStart), love_time_to_ms(timeEnd),
+                                                         TYPE_BIG_EMOJI, TYPE_CUSTOM_EMOJI)):
+            md5 = row.imgPath
+            if row.type == TYPE_CUSTOM_EMOJI:
+                md5 = parse_appmsg(row.message, row.msgId).emoticonmd5
+            if not md5 or md5 in emojis or media.emoji(md5) is not None:
+                continue
+            emojis[md5] = emoji_cdn_url(row.message)
+        fetched = get_emoji(session).prefetch(emojis)
+        for md5 in fetched:
+            media.add_emoji(md5)
+        if emojis:
+            print(colored('{}个表情包已下载，{}个失败'.format(len(fetched), len(emojis) - len(fetched)), "green"))
+        return len(fetched)
 
 
 '''获得爱人的聊天数据，返回字典'''
 
 
-def get_love_msg(conRemark, timeStart, timeEnd):
+def prepare_wcdb(db='EnMicroMsg-decrypted.db'):
     """
-    获得爱人的聊天数据
+    预处理解密后的数据库：为message表建立(talker, createTime)索引，
+    按联系人和时间范围查询时不用再扫描全表。只需运行一次
+
+    :param db: 解密后的数据库
+    """
+    msg = sqlite.connect(db)
+    msg.execute('CREATE INDEX IF NOT EXISTS love_talker_createTime_index ON message (talker, createTime);')
+    msg.execute('ANALYZE message;')
+    msg.commit()
+    msg.close()
+
+
+def iter_love_msg(conRemark, timeStart, timeEnd, session=None, batch_size=LOVE_BATCH):
+    """
+    按时间顺序逐条返回爱人的聊天数据（分批读取，不会一次全部载入内存）
 
     :param conRemark: 备注
     :param timeStart: 开始时间
     :param timeEnd: 结束时间
-    :return: 聊天数据字典
+    :param session: 导出会话，为空时临时打开数据库
+    :param batch_size: 每批读取的行数
+    :return: LoveMsg生成器
     """
-    select_love_msg = 'SELECT datetime(subStr(cast(msg.createTime as text),1,10),"unixepoch","localtime") AS theTime,' \
+    talker_start = love_time_to_ms(timeStart)
+    talker_end = love_time_to_ms(timeEnd)
+    select_love_msg = 'SELECT msg.createTime AS createTime,' \
                       'CASE msg.isSend ' \
-                      'WHEN 0 THEN name.conRemark ' \
+                      'WHEN 0 THEN ? ' \
                       'WHEN 1 THEN "我" ' \
                       'END AS person,' \
                       'msg.isSend AS isSend,' \
@@ -202,89 +532,239 @@ def get_love_msg(conRemark, timeStart, timeEnd):
                       'msg.status AS status,' \
                       'msg.msgId AS msgId,' \
                       'msg.lvbuffer AS buffer ' \
-                      'FROM message msg INNER JOIN rcontact name ON msg.talker = name.username ' \
-                      'WHERE name.conRemark = \'' + conRemark + '\' ' \
-                                                                'AND theTime < \'' + timeEnd + '\' ' \
-                                                                                               'AND theTime >= \'' + timeStart + '\' ' \
-                                                                                                                                 'ORDER BY msg.createTime;'
+                      'FROM message msg ' \
+                      'WHERE msg.talker = ? ' \
+                      'AND msg.createTime >= ? ' \
+                      'AND msg.createTime < ? ' \
+                      'ORDER BY msg.createTime;'
     # 'AND msg.type = 49 ' \
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love_msg)
-    desc = msg_cur.description
-    special_love_dict = [dict(zip([col[0] for col in desc], row)) for row in msg_cur.fetchall()]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
+    with love_session(session) as session:
+        '''只查询一次联系人的wxid，直接用talker和毫秒时间戳过滤，可以走(talker, createTime)索引'''
+        talker = session.get_love_wxid(conRemark)
+        yield from session.iter_rows(select_love_msg, (conRemark, talker, talker_start, talker_end), LoveMsg,
+                                     batch_size)
+
+
+def love_msg_images(love_msg, session=None):
+    """
+    消息要插入文档的本地图片：聊天图片/表情包/视频封面
+
+    :param love_msg: LoveMsg
+    :param session: 导出会话
+    :return: 原图路径列表
+    """
+    media = get_media(session)
+    if love_msg.type == TYPE_IMG:
+        image_file = media.image(love_msg.imgPath.split('//th_')[-1], love_msg.isSend)
+    elif love_msg.type == TYPE_BIG_EMOJI:
+        image_file = media.emoji(love_msg.imgPath)
+    elif love_msg.type == TYPE_CUSTOM_EMOJI:
+        md5 = parse_appmsg(love_msg.message, love_msg.msgId).emoticonmd5
+        image_file = media.emoji(md5) if md5 else None
+    elif love_msg.type == TYPE_VIDEO_FILE:
+        image_file = media.video(love_msg.imgPath)[0]
+    else:
+        image_file = None
+    return [image_file] if image_file is not None else []
+
+
+def _prefetch_images(image_files, session):
+    """
+    在后台线程中准备图片：缩小并读取内容（不访问数据库）
+
+    :param image_files: 原图路径列表
+    :param session: 导出会话
+    :return: {原图路径: 图片内容}
+    """
+    prefetched = {}
+    for image_file in image_files:
+        try:
+            with open(get_display_image(image_file, session), 'rb') as f:
+                prefetched[image_file] = f.read()
+        except Exception:
+            continue
+    return prefetched
+
+
+def prefetch_love_msg(love_msgs, session, ahead=None):
+    """
+    后台线程提前准备后面ahead条消息要插入的图片（查找、读取、缩小），消息仍按原顺序交给写文档的线程。
+    每条消息返回前，它的图片放入session.prefetched，由各处理函数通过read_display_image取用
 
+    :param love_msgs: LoveMsg迭代器
+    :param session: 导出会话
+    :param ahead: 提前的消息条数，为空时使用session.prefetch
+    :return: LoveMsg生成器
+    """
+    if ahead is None:
+        ahead = session.prefetch
+    if ahead <= 0:
+        yield from love_msgs
+        return
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=LOVE_PREFETCH_WORKERS) as pool:
+        try:
+            for love_msg in love_msgs:
+                image_files = love_msg_images(love_msg, session)
+                future = pool.submit(_prefetch_images, image_files, session) if image_files else None
+                pending.append((love_msg, future))
+                if len(pending) > ahead:
+                    love_msg, future = pending.popleft()
+                    session.prefetched = future.result() if future is not None else {}
+                    yield love_msg
+            while pending:
+                love_msg, future = pending.popleft()
+                session.prefetched = future.result() if future is not None else {}
+                yield love_msg
+        finally:
+            for love_msg, future in pending:
+                if future is not None:
+                    future.cancel()
+            session.prefetched = {}
+
+
+def get_love_msg(conRemark, timeStart, timeEnd, session=None):
+    """
+    获得爱人的聊天数据
+
+    :param conRemark: 备注
+    :param timeStart: 开始时间
+    :param timeEnd: 结束时间
+    :param session: 导出会话，为空时临时打开数据库
+    :return: 聊天数据字典
+    """
+    special_love_dict = [love_msg._asdict() for love_msg in iter_love_msg(conRemark, timeStart, timeEnd, session)]
     return special_love_dict
 
 
-def get_love_wxid(conRemark):
+def get_love_wxid(conRemark, session=None):
     """
     获取指定备注名的wxid
 
     :param conRemark:
+    :param session: 导出会话，为空时临时打开数据库
     :return: wxid
     """
-    select_love_wxid = 'SELECT username ' \
-                       'FROM rcontact ' \
-                       'WHERE conRemark = \'' + conRemark + '\';'
-
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love_wxid)
-    wxid = msg_cur.fetchall()[0][0]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
-    # print(wxid)
-    return wxid
+    with love_session(session) as session:
+        return session.get_love_wxid(conRemark)
 
 
-def get_self_wxid():
+def get_self_wxid(session=None):
     """
     获取自己的wxid
 
+    :param session: 导出会话，为空时临时打开数据库
     :return: wxid
     """
-    select_self_wxid = 'SELECT value ' \
-                       'FROM userinfo ' \
-                       'WHERE value like "wxid#_%" ESCAPE "#";'
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_self_wxid)
-    wxid = msg_cur.fetchall()[0][0]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
-    # print(wxid)
-    return wxid
+    with love_session(session) as session:
+        return session.get_self_wxid()
 
 
 def IS_3_min(last_time, now_time):
     """
     判断两次聊天时间是不是大于三分钟。若大于三分钟则显示时间；否则不显示
 
-    :param last_time:
-    :param now_time:
+    :param last_time: 毫秒时间戳
+    :param now_time: 毫秒时间戳
     :return: ret(是否显示)
     """
-    last = time.strptime(last_time, "%Y-%m-%d %H:%M:%S")
-    now = time.strptime(now_time, "%Y-%m-%d %H:%M:%S")
-    '''两次聊天记录时间差，单位是秒'''
-    love_sub = (now.tm_sec - last.tm_sec) + (now.tm_min - last.tm_min) * 60 + (now.tm_hour - last.tm_hour) * 60 * 60 + (
-            now.tm_yday - last.tm_yday) * 24 * 60 * 60 + (now.tm_year - last.tm_year) * 366 * 24 * 60 * 60
-    # print(sub)
-    return love_sub >= 180
+    return now_time - last_time >= 180 * 1000
 
 
 def IS_8_hour(last_time, now_time):
     """
     判断上次打印时间是不是大于八小时。若大于八小时则打印时间；否则不打印
 
-    :param last_time:
-    :param now_time:
+    :param last_time: 毫秒时间戳
+    :param now_time: 毫秒时间戳
     :return: ret(是否打印)
     """
-    last = time.strptime(last_time, "%Y-%m-%d %H:%M:%S")
-    now = time.strptime(now_time, "%Y-%m-%d %H:%M:%S")
-    '''两次的打印时间差，单位是秒'''
-    love_sub = (now.tm_sec - last.tm_sec) + (now.tm_min - last.tm_min) * 60 + (now.tm_hour - last.tm_hour) * 60 * 60 + (
-            now.tm_yday - last.tm_yday) * 24 * 60 * 60 + (now.tm_year - last.tm_year) * 366 * 24 * 60 * 60
-    # print(sub)
-    return love_sub >= 28800
+    return now_time - last_time >= 28800 * 1000
+
+
+def add_love_styles(doc):
+    """
+    定义聊天记录用到的样式：BubbleText/BubbleTextRight 聊天内容，Expired 过期提示，
+    SystemNotice 系统提示，TimeStamp 时间，QuoteText 被回复的内容。
+    各处理函数按样式id引用这些样式，不再逐个设置run和段落的格式
+
+    :param doc:
+    """
+    styles = doc.styles
+    bubble = styles.add_style('BubbleText', WD_STYLE_TYPE.PARAGRAPH)
+    bubble.base_style = styles['Normal']
+    bubble.paragraph_format.space_before = Pt(0)
+    bubble.paragraph_format.space_after = Pt(0)
+    bubble.font.size = Pt(12)
+    bubble_right = styles.add_style('BubbleTextRight', WD_STYLE_TYPE.PARAGRAPH)
+    bubble_right.base_style = bubble
+    bubble_right.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+    expired = styles.add_style('Expired', WD_STYLE_TYPE.CHARACTER)
+    expired.base_style = styles['Default Paragraph Font']
+    expired.font.size = Pt(11)
+    expired.font.color.rgb = shared.RGBColor(191, 191, 191)
+    expired.font.strike = True
+    notice = styles.add_style('SystemNotice', WD_STYLE_TYPE.PARAGRAPH)
+    notice.base_style = styles['Normal']
+    notice.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    notice.paragraph_format.space_before = Pt(0)
+    notice.paragraph_format.space_after = Pt(0)
+    notice.font.size = Pt(10.5)
+    notice.font.color.rgb = shared.RGBColor(191, 191, 191)
+    stamp = styles.add_style('TimeStamp', WD_STYLE_TYPE.PARAGRAPH)
+    stamp.base_style = styles['Normal']
+    stamp.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    stamp.paragraph_format.space_before = Pt(10)
+    stamp.paragraph_format.space_after = Pt(10)
+    stamp.font.name = 'Times New Roman'
+    stamp.font.size = Pt(11)
+    quote = styles.add_style('QuoteText', WD_STYLE_TYPE.CHARACTER)
+    quote.base_style = styles['Default Paragraph Font']
+    quote.font.size = Pt(11)
+    quote.font.color.rgb = shared.RGBColor(121, 121, 121)
+    quote.font.highlight_color = WD_COLOR_INDEX.GRAY_25
+
+
+def love_style(paragraph, style_id):
+    """
+    按样式id设置段落样式，不用按名称在样式表中查找
+
+    :param paragraph:
+    :param style_id:
+    """
+    paragraph._p.get_or_add_pPr().style = style_id
+
+
+def bubble_style(paragraph, right=False):
+    """
+    聊天内容的段落样式
+
+    :param paragraph:
+    :param right: 是否右对齐
+    """
+    love_style(paragraph, 'BubbleTextRight' if right else 'BubbleText')
+
+
+def love_run_style(run, style_id):
+    """
+    按样式id设置字符样式
+
+    :param run:
+    :param style_id:
+    """
+    run._r.get_or_add_rPr().style = style_id
+
+
+def expired_love(paragraph, text, isSend):
+    """
+    文件已过期或找不到时的灰色删除线提示
+
+    :param paragraph:
+    :param text:
+    :param isSend:
+    """
+    bubble_style(paragraph, isSend)
+    love_run_style(paragraph.add_run(text), 'Expired')
 
 
 def text_love_time(doc, love_time):
@@ -295,62 +775,103 @@ def text_love_time(doc, love_time):
     :param love_time:
     """
     love_paragraph = doc.add_paragraph("")
-    love_run = love_paragraph.add_run(love_time)
-    love_run.font.name = 'Times New Roman'
-    love_run.font.size = Pt(11)
-    love_paragraph.paragraph_format.space_before = Pt(10)
-    love_paragraph.paragraph_format.space_after = Pt(10)
-    love_paragraph.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+    love_style(love_paragraph, 'TimeStamp')
+    love_paragraph.add_run(love_time)
 
 
-def create_love_table(doc, isSend, person):
+# 每个文档已插入头像的空表格，以文档的part为键，文档释放后自动清除
+_love_bubbles = weakref.WeakKeyDictionary()
+# 每个文档中头像图片的(关系id, 文件名, 尺寸)，以wxid为键
+_love_avatars = weakref.WeakKeyDictionary()
+
+
+def create_love_table(doc, isSend, person, session=None, wxid=None):
     """
-    创建一个1*2表格：isSend = 1 (0,0)存聊天内容，(0,1)存头像；isSend = 0 (0,0)存头像，(0,1)存聊天内容
+    创建一个1*2表格：isSend = 1 (0,0)存聊天内容，(0,1)存头像；isSend = 0 (0,0)存头像，(0,1)存聊天内容。
+    每个文档中同一个人的表格只完整创建一次，之后复制缓存的空表格（头像图片共用同一个关系）
 
     :param doc:
     :param isSend:
     :param person:
+    :param session: 导出会话
+    :param wxid: 发送者的wxid，群聊时传入发言的群成员；为空时按isSend和备注查找
+    :return: 聊天内容的坐标
+    """
+    if wxid is None:
+        wxid = get_sender_wxid(isSend, person, session)
+    bubbles = _love_bubbles.setdefault(doc.part, {})
+    bubble = bubbles.get((isSend, wxid))
+    if bubble is not None:
+        love_tbl = copy.deepcopy(bubble)
+        doc.element.body._insert_tbl(love_tbl)
+        return Table(love_tbl, doc._body).cell(0, 0 if isSend else 1)
+    content_cell = new_love_table(doc, isSend, wxid, session)
+    bubbles[(isSend, wxid)] = copy.deepcopy(content_cell._parent._tbl)
+    return content_cell
+
+
+def love_avatar_inline(doc, wxid, session=None):
+    """
+    头像图片：每个文档中每个wxid只添加一次图片，之后直接引用已有的关系
+
+    :param doc:
+    :param wxid:
+    :param session: 导出会话
+    :return: <wp:inline>
+    """
+    avatars = _love_avatars.setdefault(doc.part, {})
+    if wxid not in avatars:
+        rId, image = doc.part.get_or_add_image(io.BytesIO(get_avatar_blob(wxid, session)))
+        avatars[wxid] = rId, image.filename, image.scaled_dimensions(shared.Inches(0.5), None)
+    rId, filename, (cx, cy) = avatars[wxid]
+    '''图片编号在保存前统一设置'''
+    return CT_Inline.new_pic_inline(0, rId, filename, cx, cy)
+
+
+def renumber_love_pictures(doc):
+    """
+    复制的表格中头像的编号重复，保存前给所有图片重新编号
+
+    :param doc:
+    """
+    for i, docPr in enumerate(doc.element.body.iter(qn('wp:docPr')), 1):
+        docPr.set('id', str(i))
+        docPr.set('name', 'Picture ' + str(i))
+
+
+def new_love_table(doc, isSend, wxid, session=None):
+    """
+    逐项设置格式，创建带头像的1*2表格
+
+    :param doc:
+    :param isSend:
+    :param wxid: 发送者的wxid
+    :param session: 导出会话
     :return: 聊天内容的坐标
     """
     love_table = doc.add_table(rows=1, cols=2, style='Normal Table')
-    love_table.cell(0, 1).height = shared.Inches(0.5)
-    love_table.cell(0, 0).height = shared.Inches(0.5)
     if isSend:
-        self_wxid = get_self_wxid()
-        self_avator = get_avator_path(self_wxid)
-        img_self = open(self_avator, 'rb')
         '''表格右对齐'''
         love_table.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
-        avatar = love_table.cell(0, 1).paragraphs[0]
-        '''插入头像，设置头像宽度'''
-        avatar.add_run().add_picture(img_self, width=shared.Inches(0.5))
-        '''设置单元格宽度跟头像一致'''
-        love_table.cell(0, 1).width = shared.Inches(0.5)
+        avatar_cell = love_table.cell(0, 1)
         content_cell = love_table.cell(0, 0)
-        '''聊天内容右对齐'''
-        # content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
-        img_self.close()
     else:
-        love_wxid = get_love_wxid(person)
-        love_avator = get_avator_path(love_wxid)
-        img_love = open(love_avator, 'rb')
-        avatar = love_table.cell(0, 0).paragraphs[0]
-        '''插入头像，设置头像宽度'''
-        avatar.add_run().add_picture(img_love, width=shared.Inches(0.5))
-        '''设置单元格宽度跟头像一致'''
-        love_table.cell(0, 0).width = shared.Inches(0.5)
+        avatar_cell = love_table.cell(0, 0)
         content_cell = love_table.cell(0, 1)
-        img_love.close()
+    avatar = avatar_cell.paragraphs[0]
+    '''插入头像，设置头像宽度'''
+    avatar.add_run()._r.add_drawing(love_avatar_inline(doc, wxid, session))
+    '''设置单元格宽度跟头像一致'''
+    avatar_cell.width = shared.Inches(0.5)
     '''聊天内容垂直居中对齐'''
     content_cell.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
     avatar.paragraph_format.space_before = Pt(0)
     avatar.paragraph_format.space_after = Pt(0)
-    avatar.vertical_alignment = WD_ALIGN_VERTICAL.CENTER
     # content_cell.width = shared.Inches(8)
     return content_cell
 
 
-def text_love(doc, isSend, person, message, status):
+def text_love(doc, isSend, person, message, status, session=None):
     """
     将文字聊天记录写入文件
 
@@ -359,24 +880,20 @@ def text_love(doc, isSend, person, message, status):
     :param person: 
     :param message: 
     :param status: 状态码
+    :param session: 导出会话
     """
     if status == 5:
         message += '（未发出） '
-    content_cell = create_love_table(doc, isSend, person)
+    content_cell = create_love_table(doc, isSend, person, session)
     try:
-        content_run = content_cell.paragraphs[0].add_run(message)
+        content_cell.paragraphs[0].add_run(message)
     except:
-        content_run = content_cell.paragraphs[0].add_run(remove_control_chars(message))
-    content_cell.paragraphs[0].font_size = shared.Inches(0.5)
-    content_run.font.size = Pt(12)
-    content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-    '''当且仅当是自己发送的且发送的字符较短时：左对齐'''
-    if len(message) < MSG_MAX and isSend:
-        content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        content_cell.paragraphs[0].add_run(remove_control_chars(message))
+    '''当且仅当是自己发送的且发送的字符较短时：右对齐'''
+    bubble_style(content_cell.paragraphs[0], len(message) < MSG_MAX and isSend)
 
 
-def image_love(doc, isSend, person, imgPath):
+def image_love(doc, isSend, person, imgPath, session=None, image_love_dic=None):
     """
     插入聊天图片：isSend = 1 只有缩略图，isSend = 0 有原图 
 
@@ -384,56 +901,37 @@ def image_love(doc, isSend, person, imgPath):
     :param isSend: 
     :param person: 
     :param imgPath: 
+    :param session: 导出会话
+    :param image_love_dic: 不为空时把原图复制到该文件夹，并在图片下方链接原图
     """
-    content_cell = create_love_table(doc, isSend, person)
+    content_cell = create_love_table(doc, isSend, person, session)
     content_run = content_cell.paragraphs[0].add_run()
-    content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
     imgPath = imgPath.split('//th_')[-1]
-    Path = f'.//image2//{imgPath[:2]}//{imgPath[2:4]}'
-    for root, dirs, files in os.walk(Path):
-        for file in files:
-            if isSend:
-                if imgPath + 'hd' in file:
-                    if '_hevc' in file:
-                        continue
-                    imgPath = file
-                    break
-            if imgPath in file:
-                if '_hevc' in file:
-                    continue
-                if 'jpg' in file:
-                    continue
-                imgPath = file
-                break
+    img_file = get_media(session).image(imgPath, isSend)
     try:
-        img_love = open(f'{Path}/{imgPath}', 'rb')
+        if img_file is None:
+            raise FileNotFoundError(imgPath)
+        img_love = io.BytesIO(read_display_image(img_file, session))
         '''插入图片，设置单元格高度跟图片一致'''
         content_run.add_picture(img_love, height=shared.Inches(2))
-        content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-        content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-        if isSend:
-            content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        bubble_style(content_cell.paragraphs[0], isSend)
         # content_cell.width = shared.Inches(0.5)
         '''注意关闭图片，否则不能移植'''
         img_love.close()
+        if image_love_dic is not None:
+            love_image = os.path.basename(img_file)
+            get_blob_store().link(img_file, image_love_dic + '/' + love_image)
+            add_hyperlink(content_cell, '\n查看原图', 'image_love/' + love_image)
         # content_cell.paragraphs[0].add_run('您的图片已过期或被错误删除')
         # doc.add_paragraph()
     except Exception:
         # print(f'{Path}/{imgPath}')
         # print('您的图片已过期或被错误删除')
-        content_run = content_cell.paragraphs[0].add_run('您的图片已过期或被错误删除')
-        content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-        content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-        content_run.font.size = Pt(11)
-        content_run.font.color.rgb = shared.RGBColor(191, 191, 191)
-        content_run.font.strike = True
-        if isSend:
-            content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        expired_love(content_cell.paragraphs[0], '您的图片已过期或被错误删除', isSend)
         # print("Error!image")
 
 
-def emoji_love(doc, isSend, person, message, imgPath):
+def emoji_love(doc, isSend, person, message, imgPath, session=None):
     """
     插入聊天表情包
     
@@ -442,79 +940,56 @@ def emoji_love(doc, isSend, person, message, imgPath):
     :param person: 
     :param message: 
     :param imgPath: 
+    :param session: 导出会话
     """
-    ret, emoji_path = get_emoji_path(message, imgPath)
+    ret, emoji_path = get_emoji_path(message, imgPath, session)
     # print(emoji_path)
-    content_cell = create_love_table(doc, isSend, person)
+    content_cell = create_love_table(doc, isSend, person, session)
     content_run = content_cell.paragraphs[0].add_run()
     if ret:
-        emoji_img_love = open(emoji_path, 'rb')
+        emoji_img_love = io.BytesIO(read_display_image(emoji_path, session))
         try:
             content_run.add_picture(emoji_img_love, height=shared.Inches(2))
-            content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-            content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
+            bubble_style(content_cell.paragraphs[0], isSend)
         except Exception:
             # print(imgPath)
             # print('不能正确打开表情')
-            content_run = content_cell.paragraphs[0].add_run('不能正确打开表情')
-            content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-            content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-            content_run.font.size = Pt(11)
-            content_run.font.color.rgb = shared.RGBColor(191, 191, 191)
-            content_run.font.strike = True
-        if isSend:
-            content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+            expired_love(content_cell.paragraphs[0], '不能正确打开表情', isSend)
         # content_cell.width = shared.Inches(0.5)
         emoji_img_love.close()
     else:
         # print(imgPath)
         # print('不能正确找到表情')
-        content_run = content_cell.paragraphs[0].add_run('不能正确找到表情')
-        content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-        content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-        content_run.font.size = Pt(11)
-        content_run.font.color.rgb = shared.RGBColor(191, 191, 191)
-        content_run.font.strike = True
-        if isSend:
-            content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        expired_love(content_cell.paragraphs[0], '不能正确找到表情', isSend)
 
 
-def voice_love(doc, isSend, person, imgPath, tmp_voice_dic):
+def voice_love(doc, isSend, person, imgPath, voices, session=None):
     """
-    插入微信语音，利用超链接的形式
+    插入微信语音，利用超链接的形式，语音在文档保存时统一转成mp3
     
-    :param tmp_voice_dic:
+    :param voices: 待转换的语音，[(语音文件路径, 文件名)]
     :param doc:
     :param isSend: 
     :param person: 
     :param imgPath: 
+    :param session: 导出会话
     :return: 
     """
-    voice = get_md5(imgPath)
-    voice_file = './voice2/' + voice[:2] + '/' + voice[2:4] + '/msg_' + imgPath + '.amr'
-    content_cell = create_love_table(doc, isSend, person)
+    voice_file = get_media(session).voice(imgPath)
+    content_cell = create_love_table(doc, isSend, person, session)
     # print(voice_file)
     try:
-        '''复制一份到新的文件夹中以免文件过大'''
-        shutil.copyfile(voice_file, tmp_voice_dic + '/' + 'msg_' + imgPath + '.amr')
+        if voice_file is None:
+            raise FileNotFoundError(imgPath)
+        voices.append((voice_file, 'msg_' + imgPath))
     except Exception:
         # print(voice_file)
         # print('您的语音已过期或被错误删除')
-        content_run = content_cell.paragraphs[0].add_run('您的语音已过期或被错误删除')
-        content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-        content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-        content_run.font.size = Pt(11)
-        content_run.font.color.rgb = shared.RGBColor(191, 191, 191)
-        content_run.font.strike = True
-        if isSend:
-            content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        expired_love(content_cell.paragraphs[0], '您的语音已过期或被错误删除', isSend)
         return
 
     add_hyperlink(content_cell, person + '的语音', 'voice_love/' + 'msg_' + imgPath + '.mp3')
-    content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-    if isSend:
-        content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+    bubble_style(content_cell.paragraphs[0], isSend)
 
 
 def content_xml_ready(content):
@@ -525,116 +1000,75 @@ def content_xml_ready(content):
     :return: 预处理好的xml
     """
     '''删除 xml 标头以避免可能产生的错误'''
-    header = re.compile(r'<\?.*\?>')
-    msg = header.sub("", content)
+    msg = XML_HEADER_RE.sub("", content)
     return msg
 
 
-def reply_love(doc, isSend, person, message, status):
+def reply_text(message, msgId=None):
     """
-    添加回复信息
+    解析回复信息
 
-    :param doc:
-    :param isSend:
-    :param person:
     :param message:
-    :param status:
-    """
-    # print(message)
-    flag_emoji = 0
-    '''获取回复信息'''
-    answer = re.compile(r"<title>(?P<title>(.*?))</title>")
-    answer_love = answer.search(message).groupdict()['title']
-    # print(answer_love)
-    '''获取回复的人'''
-    name = re.compile(r"<displayname>(?P<displayname>(.*?))</displayname>")
-    name_love = name.search(message).groupdict()['displayname']
-    # print(name_love)
-    '''获取要回复的那条信息'''
-    last = re.compile(r"\n?title&gt;(?P<content>(.*?))\n?&lt;/title&gt")
-    if not last.search(message):
-        if isSend == 0:
-            '''匹配对方的回复'''
-            last = re.compile(r"<content>(?P<content>(.*?))</content>")
-        else:
-            '''匹配自己的回复'''
-            last = re.compile(r"</msgsource>\n?<content>(?P<content>(.*?))\n?</content>")
-
-    try:
-        '''试错'''
-        last_love = last.search(message).groupdict()['content']
-        # print(last_love)
-    except Exception:
-        try:
-            '''试错'''
-            last_love = last.search(message).groupdict()['content']
-        except Exception:
-            '''试错'''
-            last = re.compile(r"\n?<content>(?P<content>(.*?))\n?</content>")
-            '''试错'''
-            if last.search(message):
-                last_love = last.search(message).groupdict()['content']
-            else:
-                # print(message)
-                last_love = '[图片]'
-            # TODO: 解决图片/语音引用问题
-    if status == 5:
-        message += '（未发出） '
+    :param msgId: 消息id，用于缓存解析结果
+    :return: 回复内容, 被回复的人, 被回复的内容, 被回复表情包的链接(没有时为None)
+    """
+    appmsg = parse_appmsg(message, msgId)
+    love_url = None
+    answer_love = appmsg.title
+    name_love = appmsg.displayname
+    '''被回复的消息：分享/回复等appmsg取其标题，否则为原文'''
+    refer_title = REFER_TITLE_RE.search(appmsg.refer_content)
+    last_love = refer_title.group(1) if refer_title else appmsg.refer_content
+    if not last_love:
+        # TODO: 解决图片/语音引用问题
+        last_love = '[图片]'
     if 'xml' in last_love:
         if len(last_love) > 2 * MSG_MAX:
             last_love = '[图片]'
-    if '&quot;http*#*//' in last_love:
+    if '"http*#*//' in last_love:
         if len(last_love) > 2 * MSG_MAX:
-            url = re.compile(r"&quot;http\*#\*//(?P<content>(.*?))&quot;&#x20;")
-            try:
-                love_url = url.search(last_love).groupdict()['content']
-                # print(message)
-                # print(love_url)
-                flag_emoji = 1
-            except Exception:
-                flag_emoji = 0
+            refer_url = REFER_EMOJI_URL_RE.search(last_love)
+            love_url = refer_url.group(1) if refer_url else None
     if 'wxid' in last_love:
         last_love = '[动画表情]'
-    content_cell = create_love_table(doc, isSend, person)
-    content_run = content_cell.paragraphs[0].add_run(answer_love)
-    content_run.font.size = Pt(12)
-    content_cell.paragraphs[0].font_size = shared.Inches(0.5)
-    content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-    if len(answer_love) < MSG_MAX and isSend:
-        p = content_cell.paragraphs[0]
-        p.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+    return answer_love, name_love, last_love, love_url
+
+
+def reply_love(doc, isSend, person, message, status, session=None, msgId=None):
+    """
+    添加回复信息
+
+    :param doc:
+    :param isSend:
+    :param person:
+    :param message:
+    :param status:
+    :param session: 导出会话
+    :param msgId: 消息id
+    """
+    answer_love, name_love, last_love, love_url = reply_text(message, msgId)
+    flag_emoji = love_url is not None
+    content_cell = create_love_table(doc, isSend, person, session)
+    content_cell.paragraphs[0].add_run(answer_love)
+    bubble_style(content_cell.paragraphs[0], len(answer_love) < MSG_MAX and isSend)
 
     reply_p = content_cell.add_paragraph()
     if flag_emoji:
         try:
-            urlretrieve('http://' + love_url, './tmp/' + 'new_img' + '.png')
-            img_emoji = open('./tmp/' + 'new_img' + '.png', 'rb')
-            run = content_cell.paragraphs[1].add_run(name_love + ':')
+            img_emoji = open(get_assets(session).get('http://' + love_url), 'rb')
+            run = reply_p.add_run(name_love + ':')
             run.add_picture(img_emoji, height=shared.Inches(2))
-            run.font.color.rgb = shared.RGBColor(121, 121, 121)
-            run.font_size = shared.Inches(0.3)
-            run.font.size = Pt(11)
-            run.font.highlight_color = WD_COLOR_INDEX.GRAY_25
-            content_cell.paragraphs[1].paragraph_format.space_before = Pt(0)
-            content_cell.paragraphs[1].paragraph_format.space_after = Pt(0)
-            if isSend:
-                reply_p.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+            love_run_style(run, 'QuoteText')
+            bubble_style(reply_p, isSend)
             return
         except Exception:
             last_love = '[动画表情]'
 
-    run = content_cell.paragraphs[1].add_run(name_love + ':' + last_love)
+    run = reply_p.add_run(name_love + ':' + last_love)
     '''设置被回复内容格式'''
-    run.font.color.rgb = shared.RGBColor(121, 121, 121)
-    run.font_size = shared.Inches(0.3)
-    run.font.highlight_color = WD_COLOR_INDEX.GRAY_25
-    content_cell.paragraphs[1].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[1].paragraph_format.space_after = Pt(0)
-    run.font.size = Pt(11)
+    love_run_style(run, 'QuoteText')
     # TODO: 优化引用格式
-    if len(name_love + ':' + last_love) < MSG_MAX and isSend:
-        reply_p.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+    bubble_style(reply_p, len(name_love + ':' + last_love) < MSG_MAX and isSend)
 
 
 def add_hyperlink(content_cell, text, url):
@@ -655,7 +1089,6 @@ def add_hyperlink(content_cell, text, url):
     run = paragraph.add_run(text)
     run.font.color.theme_color = MSO_THEME_COLOR_INDEX.HYPERLINK
     run.font.underline = True
-    run.font.size = Pt(12)
     hyperlink.append(run._r)
     paragraph._element.append(hyperlink)
     return hyperlink
@@ -669,12 +1102,8 @@ def retract_message_love(doc, message):
     :param message:
     """
     paragraph = doc.add_paragraph()
-    run = paragraph.add_run(message)
-    paragraph.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    paragraph.paragraph_format.space_before = Pt(0)
-    paragraph.paragraph_format.space_after = Pt(0)
-    run.font.size = Pt(10.5)
-    run.font.color.rgb = shared.RGBColor(191, 191, 191)
+    love_style(paragraph, 'SystemNotice')
+    paragraph.add_run(message)
 
 
 def mkdir(path):
@@ -688,76 +1117,77 @@ def mkdir(path):
     path = path.rstrip("\\")
     if os.path.exists(path):
         return False
-    os.makedirs(path)
+    try:
+        os.makedirs(path)
+    except FileExistsError:
+        '''并行导出时可能被其他进程抢先创建'''
+        return False
     return True
 
 
-def namecard_love(doc, isSend, person, message):
+def namecard_info(message, session=None, msgId=None):
     """
-    添加分享名片信息
+    解析分享名片：下载名片图标，找不到时使用头像
 
-    :param doc:
-    :param isSend:
-    :param person:
     :param message:
+    :param session: 导出会话
+    :param msgId: 消息id
+    :return: 昵称, [依次尝试插入的图片路径]
     """
-    content_cell = create_love_table(doc, isSend, person)
-    content_run = content_cell.paragraphs[0].add_run()
-    pq_love = PyQuery(content_xml_ready(message), parser='xml')
-    msg_love = pq_love('msg').attr
-    nickname = msg_love['nickname']
+    msg_love = parse_appmsg(message, msgId).attrs
+    nickname = msg_love.get('nickname')
     if not nickname:
-        nickname = msg_love['alias']
+        nickname = msg_love.get('alias')
     if not nickname:
         nickname = ""
-    download_url = msg_love['brandIconUrl']
-    if not download_url:
-        user_name = msg_love['username']
-    try:
-        urlretrieve(download_url, './tmp/' + nickname + '.png')
-    except Exception:
-        try:
-            love_avator = get_avator_path(user_name)
-        except Exception:
-            print("Can't deal name_card\n" + message)
-    run0 = content_cell.add_paragraph().add_run('分享卡片')
-    run0.font.size = Pt(12)
+    '''名片图标通过网络文件缓存下载，同一个图标只下载一次'''
+    love_icon = get_assets(session).get(msg_love.get('brandIconUrl'))
+    if love_icon is not None:
+        return nickname, [love_icon]
     try:
-        img_log = open('./tmp/' + nickname + '.png', 'rb')
-        content_run.add_picture(img_log, height=shared.Inches(2))
+        return nickname, [get_avator_path(msg_love['username'], session)]
     except Exception:
-        try:
-            img_avator = open(love_avator, 'rb')
-            content_run.add_picture(img_avator, height=shared.Inches(2))
-        except Exception:
-            run1 = content_cell.paragraphs[0].add_run('[图片]')
-            run1.font.size = Pt(12)
-    run2 = content_cell.add_paragraph().add_run(nickname)
-    run2.font.size = Pt(12)
-
-    content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-    content_cell.paragraphs[1].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[1].paragraph_format.space_after = Pt(0)
-    content_cell.paragraphs[2].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[2].paragraph_format.space_after = Pt(0)
-
-    if isSend:
-        content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
-        content_cell.paragraphs[1].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
-        content_cell.paragraphs[2].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        print("Can't deal name_card\n" + message)
+    return nickname, []
 
 
-def voip_love(doc, isSend, person, buffer):
+def namecard_love(doc, isSend, person, message, session=None, msgId=None):
     """
-    添加语音通话结束标志
+    添加分享名片信息
 
     :param doc:
     :param isSend:
     :param person:
-    :param buffer:
+    :param message:
+    :param session: 导出会话
+    :param msgId: 消息id
+    """
+    content_cell = create_love_table(doc, isSend, person, session)
+    content_run = content_cell.paragraphs[0].add_run()
+    nickname, love_images = namecard_info(message, session, msgId)
+    content_cell.add_paragraph().add_run('分享卡片')
+    for love_image in love_images:
+        try:
+            img_love = open(love_image, 'rb')
+            content_run.add_picture(img_love, height=shared.Inches(2))
+            break
+        except Exception:
+            continue
+    else:
+        content_cell.paragraphs[0].add_run('[图片]')
+    content_cell.add_paragraph().add_run(nickname)
+
+    for paragraph in content_cell.paragraphs:
+        bubble_style(paragraph, isSend)
+
+
+def voip_text(buffer):
+    """
+    解析语音通话结束信息
+
+    :param buffer: lvbuffer
+    :return: 通话结果文字
     """
-    content_cell = create_love_table(doc, isSend, person)
     str_tmp = str(buffer, 'utf-8')
     if str_tmp.find('聊天时长') != -1:
         str_love = str_tmp[str_tmp.find('聊天时长'):str_tmp.find(':') + 3]
@@ -786,16 +1216,26 @@ def voip_love(doc, isSend, person, buffer):
         # print(str_tmp)
         str_love = '语音通话'
     # print(str_love)
-    content_run = content_cell.paragraphs[0].add_run(str_love)
-    content_cell.paragraphs[0].font_size = shared.Inches(0.5)
-    content_run.font.size = Pt(12)
-    content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-    if isSend:
-        content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+    return str_love
+
 
+def voip_love(doc, isSend, person, buffer, session=None):
+    """
+    添加语音通话结束标志
 
-def file_love(doc, isSend, person, message, file_love_dic):
+    :param doc:
+    :param isSend:
+    :param person:
+    :param buffer:
+    :param session: 导出会话
+    """
+    content_cell = create_love_table(doc, isSend, person, session)
+    str_love = voip_text(buffer)
+    content_cell.paragraphs[0].add_run(str_love)
+    bubble_style(content_cell.paragraphs[0], isSend)
+
+
+def file_love(doc, isSend, person, message, file_love_dic, session=None, msgId=None):
     """
     插入发送的文件，利用超链接的形式
 
@@ -804,47 +1244,39 @@ def file_love(doc, isSend, person, message, file_love_dic):
     :param person:
     :param message:
     :param file_love_dic:
+    :param session: 导出会话
+    :param msgId: 消息id
     :return:
     """
-    file = re.compile(r"<title>(.*?)<")
-    love_file = file.search(message).group()
-    love_filename = love_file.lstrip('<title>').rstrip('<')
-    content_cell = create_love_table(doc, isSend, person)
+    love_filename = parse_appmsg(message, msgId).title
+    download_file = get_media(session).download(love_filename)
+    content_cell = create_love_table(doc, isSend, person, session)
     try:
-        '''复制一份到新的文件夹中以免文件过大'''
-        shutil.copyfile('./Download/' + love_filename, file_love_dic + '/' + love_filename)
+        if download_file is None:
+            raise FileNotFoundError(love_filename)
+        '''链接到新的文件夹中，同一个文件在导出目录下只存一份'''
+        get_blob_store().link(download_file, file_love_dic + '/' + love_filename)
     except Exception:
         # print(love_filename)
         # print('您的文件已过期或被错误删除')
-        content_run = content_cell.paragraphs[0].add_run(love_filename + '\n(您的文件已过期或被错误删除)')
-        content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-        content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-        content_run.font.size = Pt(11)
-        content_run.font.color.rgb = shared.RGBColor(191, 191, 191)
-        content_run.font.strike = True
-        if isSend:
-            content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
-            # content_cell.paragraphs[1].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        expired_love(content_cell.paragraphs[0], love_filename + '\n(您的文件已过期或被错误删除)', isSend)
         return
 
     add_hyperlink(content_cell, love_filename, 'file_love/' + love_filename)
-    content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-    if isSend:
-        content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+    bubble_style(content_cell.paragraphs[0], isSend)
     # print(love_filename)
 
 
-def shot_love(doc, person, message):
+def shot_text(person, message, msgId=None):
     """
-    添加拍一拍信息
+    解析拍一拍信息
 
-    :param doc:
     :param person:
     :param message:
+    :param msgId: 消息id
+    :return: 拍一拍文字
     """
-    pattern = re.compile(r"<template><!\[CDATA\[(?P<it>(.*?))]]></template>")
-    result = pattern.search(message).groupdict()['it']
+    result = parse_appmsg(message, msgId).template
     fromusername = '${fromusername@textstatusicon}'
     pattedusername = '${pattedusername@textstatusicon}'
     '''我拍别人'''
@@ -857,6 +1289,19 @@ def shot_love(doc, person, message):
     love_pat = ''.join(love_pat.split(fromusername))
     love_pat = ''.join(love_pat.split(pattedusername))
     love_pat = ''.join(love_pat.split(' '))
+    return love_pat
+
+
+def shot_love(doc, person, message, msgId=None):
+    """
+    添加拍一拍信息
+
+    :param doc:
+    :param person:
+    :param message:
+    :param msgId: 消息id
+    """
+    love_pat = shot_text(person, message, msgId)
     # print(love_pat)
     paragraph = doc.add_paragraph()
     run = paragraph.add_run(love_pat)
@@ -870,13 +1315,13 @@ def shot_love(doc, person, message):
     # run.font.highlight_color=WD_COLOR_INDEX.GRAY_25
 
 
-def system_love(doc, person, message):
+def system_text(person, message):
     """
-    添加模式提示：领取红包/撤回/拒收/转账提示
+    解析系统提示：领取红包/撤回/拒收/转账提示
 
-    :param doc:
     :param person:
     :param message:
+    :return: 提示文字
     """
     if '撤回' in message:
         love_content = message
@@ -895,17 +1340,25 @@ def system_love(doc, person, message):
     else:
         print("Can't deal system\n" + message)
         love_content = message
+    return love_content
+
+
+def system_love(doc, person, message):
+    """
+    添加模式提示：领取红包/撤回/拒收/转账提示
+
+    :param doc:
+    :param person:
+    :param message:
+    """
+    love_content = system_text(person, message)
     paragraph = doc.add_paragraph()
-    run = paragraph.add_run(love_content)
-    paragraph.paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
-    paragraph.paragraph_format.space_before = Pt(0)
-    paragraph.paragraph_format.space_after = Pt(0)
-    run.font.size = Pt(10.5)
-    run.font.color.rgb = shared.RGBColor(191, 191, 191)
+    love_style(paragraph, 'SystemNotice')
+    paragraph.add_run(love_content)
     # run.font.highlight_color=WD_COLOR_INDEX.GRAY_25
 
 
-def video_love(doc, isSend, person, imgPath, video_love_dic):
+def video_love(doc, isSend, person, imgPath, video_love_dic, session=None):
     """
     插入视频文件，包括封面图和视频全部
 
@@ -914,39 +1367,30 @@ def video_love(doc, isSend, person, imgPath, video_love_dic):
     :param isSend:
     :param person:
     :param imgPath:
+    :param session: 导出会话
     """
-    content_cell = create_love_table(doc, isSend, person)
+    content_cell = create_love_table(doc, isSend, person, session)
     content_run = content_cell.paragraphs[0].add_run()
-    Path = './video'
-    for root, dirs, files in os.walk(Path):
-        for file in files:
-            if imgPath in file:
-                if '.jpg' in file:
-                    love_image = file
-                if '.mp4' in file:
-                    love_video = file
+    love_image, video_file = get_media(session).video(imgPath)
     try:
-        content_run.add_picture(f'{Path}/{love_image}', height=shared.Inches(2))
-        content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-        content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-        shutil.copyfile(Path + '/' + love_video, video_love_dic + '/' + love_video)
+        if love_image is None:
+            raise FileNotFoundError(imgPath)
+        content_run.add_picture(io.BytesIO(read_display_image(love_image, session)), height=shared.Inches(2))
+        if video_file is None:
+            raise FileNotFoundError(imgPath)
+        love_video = os.path.basename(video_file)
+        get_blob_store().link(video_file, video_love_dic + '/' + love_video)
         add_hyperlink(content_cell, '\n播放视频', 'video_love/' + love_video)
 
     except Exception:
         # print(f'{Path}/{imgPath}')
         # print('您的视频已过期或被错误删除')
-        content_run = content_cell.paragraphs[0].add_run('您的视频已过期或被错误删除')
-        content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-        content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-        content_run.font.size = Pt(11)
-        content_run.font.color.rgb = shared.RGBColor(191, 191, 191)
-        content_run.font.strike = True
+        expired_love(content_cell.paragraphs[0], '您的视频已过期或被错误删除', isSend)
 
-    if isSend:
-        content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+    bubble_style(content_cell.paragraphs[0], isSend)
 
 
-def link_love(doc, isSend, person, message, file_love_dic):
+def link_love(doc, isSend, person, message, file_love_dic, session=None, msgId=None):
     """
     添加微信分享信息：聊天记录/网络文件/外部链接
 
@@ -955,73 +1399,58 @@ def link_love(doc, isSend, person, message, file_love_dic):
     :param isSend:
     :param person:
     :param message:
+    :param session: 导出会话
+    :param msgId: 消息id
     :return:
     """
-    content_cell = create_love_table(doc, isSend, person)
+    content_cell = create_love_table(doc, isSend, person, session)
     # content_run = content_cell.paragraphs[0].add_run()
-    pq_love = PyQuery(content_xml_ready(message))
-    url_love = pq_love('url').text()
-    title_love = pq_love('title').text().split(' null')[0]
+    appmsg = parse_appmsg(message, msgId)
+    url_love = appmsg.url
+    title_love = appmsg.title.split(' null')[0]
     if '聊天记录' in title_love:
-        des_love = pq_love('des').text()
-        content_run = content_cell.paragraphs[0].add_run(title_love)
-        content_cell.paragraphs[0].font_size = shared.Inches(0.5)
-        content_run.font.size = Pt(12)
-        content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
+        des_love = appmsg.des
+        content_cell.paragraphs[0].add_run(title_love)
+        bubble_style(content_cell.paragraphs[0])
         content_cell.paragraphs[0].paragraph_format.space_after = Pt(5)
         # des_love = ''.join(des_love.split('\n'))
         # content_cell.add_paragraph('\n'.join(des_love.split(' ')))
         content_cell.add_paragraph()
         # des_love = '\n'.join(des_love.split('\r'))
         # print(des_love)
-        content_run = content_cell.paragraphs[1].add_run(des_love)
-        content_cell.paragraphs[1].font_size = shared.Inches(0.5)
-        content_run.font.size = Pt(12)
-        content_cell.paragraphs[1].paragraph_format.space_before = Pt(0)
-        content_cell.paragraphs[1].paragraph_format.space_after = Pt(0)
+        content_cell.paragraphs[1].add_run(des_love)
+        bubble_style(content_cell.paragraphs[1])
         return
     elif not url_love:
-        if pq_love('des').text() != '':
-            line_love = title_love + '(' + pq_love('des').text() + ')'
+        if appmsg.des != '':
+            line_love = title_love + '(' + appmsg.des + ')'
         else:
             line_love = title_love
         try:
-            shutil.copyfile('./Download/' + title_love, file_love_dic + '/' + title_love)
+            download_file = get_media(session).download(title_love)
+            if download_file is None:
+                raise FileNotFoundError(title_love)
+            get_blob_store().link(download_file, file_love_dic + '/' + title_love)
             add_hyperlink(content_cell, line_love, 'file_love/' + title_love)
-            content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-            content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
             # print('超链接')
         except Exception:
-            content_run = content_cell.paragraphs[0].add_run(line_love)
-            content_cell.paragraphs[0].font_size = shared.Inches(0.5)
-            content_run.font.size = Pt(12)
-            content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-            content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-        if isSend:
-            content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+            content_cell.paragraphs[0].add_run(line_love)
+        bubble_style(content_cell.paragraphs[0], isSend)
         return
     elif url_love:
         add_hyperlink(content_cell, title_love, url_love)
-        content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-        content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-        if isSend:
-            content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        bubble_style(content_cell.paragraphs[0], isSend)
         # print("URL:{}".format(url_love))
         # print(content_xml_ready(message))
         return
     else:
         print("Can't deal link\n" + content_xml_ready(message))
-        content_run = content_cell.paragraphs[0].add_run(content_xml_ready(message))
-        content_cell.paragraphs[0].font_size = shared.Inches(0.5)
-        content_run.font.size = Pt(12)
-        content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-        content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-        if isSend:
-            content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+        content_cell.paragraphs[0].add_run(content_xml_ready(message))
+        bubble_style(content_cell.paragraphs[0], isSend)
         # print(content_xml_ready(message))
 
 
-def custom_emoji_love(doc, isSend, person, message):
+def custom_emoji_love(doc, isSend, person, message, session=None, msgId=None):
     """
     添加用户表情包
 
@@ -1029,17 +1458,32 @@ def custom_emoji_love(doc, isSend, person, message):
     :param isSend:
     :param person:
     :param message:
+    :param session: 导出会话
+    :param msgId: 消息id
     """
     if 'emoticonmd5' in message:
-        pq_love = PyQuery(message)
-        imgPath = pq_love('emoticonmd5').text()
+        imgPath = parse_appmsg(message, msgId).emoticonmd5
         # print(imgPath)
-        emoji_love(doc, isSend, person, message, imgPath)
+        emoji_love(doc, isSend, person, message, imgPath, session)
     else:
         print('Custom emoji deal wrong')
 
 
-def money_transfer_love(doc, isSend, person, message):
+def money_transfer_text(message, msgId=None):
+    """
+    解析转账信息
+
+    :param message:
+    :param msgId: 消息id
+    :return: 转账文字
+    """
+    title = parse_appmsg(message, msgId).des
+    if not title:
+        return "[微信转账]"
+    return "[微信转账]\n{}".format(title)
+
+
+def money_transfer_love(doc, isSend, person, message, session=None, msgId=None):
     """
     添加转账信息
 
@@ -1047,28 +1491,30 @@ def money_transfer_love(doc, isSend, person, message):
     :param isSend:
     :param person:
     :param message:
+    :param session: 导出会话
+    :param msgId: 消息id
     """
-    content_cell = create_love_table(doc, isSend, person)
-    data_to_parse = io.BytesIO(message.encode('utf-8'))
-    love_money = "[微信转账]"
-    try:
-        for event, elem in ET.iterparse(data_to_parse, events=('end',)):
-            if elem.tag == 'des':
-                title = elem.text
-                love_money = "[微信转账]\n{}".format(title)
-                break
-    except Exception:
-        love_money = "[微信转账]"
-    content_run = content_cell.paragraphs[0].add_run(love_money)
-    content_cell.paragraphs[0].font_size = shared.Inches(0.5)
-    content_run.font.size = Pt(12)
-    content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-    if isSend:
-        content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+    content_cell = create_love_table(doc, isSend, person, session)
+    love_money = money_transfer_text(message, msgId)
+    content_cell.paragraphs[0].add_run(love_money)
+    bubble_style(content_cell.paragraphs[0], isSend)
+
+
+def luck_money_text(message, msgId=None):
+    """
+    解析红包信息
+
+    :param message:
+    :param msgId: 消息id
+    :return: 红包文字
+    """
+    title = parse_appmsg(message, msgId).sendertitle
+    if not title:
+        return "[微信红包]"
+    return "[微信红包]\n{}".format(title)
 
 
-def luck_money_love(doc, isSend, person, message):
+def luck_money_love(doc, isSend, person, message, session=None, msgId=None):
     """
     添加微信红包信息
 
@@ -1076,28 +1522,16 @@ def luck_money_love(doc, isSend, person, message):
     :param isSend:
     :param person:
     :param message:
+    :param session: 导出会话
+    :param msgId: 消息id
     """
-    content_cell = create_love_table(doc, isSend, person)
-    data_to_parse = io.BytesIO(message.encode('utf-8'))
-    love_lucky_money = "[微信红包]"
-    try:
-        for event, elem in ET.iterparse(data_to_parse, events=('end',)):
-            if elem.tag == 'sendertitle':
-                title = elem.text
-                love_lucky_money = "[微信红包]\n{}".format(title)
-                break
-    except Exception:
-        love_lucky_money = "[微信红包]"
-    content_run = content_cell.paragraphs[0].add_run(love_lucky_money)
-    content_cell.paragraphs[0].font_size = shared.Inches(0.5)
-    content_run.font.size = Pt(12)
-    content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-    if isSend:
-        content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+    content_cell = create_love_table(doc, isSend, person, session)
+    love_lucky_money = luck_money_text(message, msgId)
+    content_cell.paragraphs[0].add_run(love_lucky_money)
+    bubble_style(content_cell.paragraphs[0], isSend)
 
 
-def app_msg_love(doc, isSend, person, message):
+def app_msg_love(doc, isSend, person, message, session=None, msgId=None):
     """
     添加APP到微信信息
 
@@ -1105,353 +1539,575 @@ def app_msg_love(doc, isSend, person, message):
     :param isSend:
     :param person:
     :param message:
+    :param session: 导出会话
+    :param msgId: 消息id
     """
-    content_cell = create_love_table(doc, isSend, person)
-    pq_love = PyQuery(content_xml_ready(message))
-    des_love = pq_love('des').text()
-    title_love = pq_love('title').text()
-    content_run = content_cell.paragraphs[0].add_run(title_love + des_love)
-    content_cell.paragraphs[0].font_size = shared.Inches(0.5)
-    content_run.font.size = Pt(12)
-    content_cell.paragraphs[0].paragraph_format.space_before = Pt(0)
-    content_cell.paragraphs[0].paragraph_format.space_after = Pt(0)
-    if isSend:
-        content_cell.paragraphs[0].paragraph_format.alignment = WD_PARAGRAPH_ALIGNMENT.RIGHT
+    content_cell = create_love_table(doc, isSend, person, session)
+    appmsg = parse_appmsg(message, msgId)
+    des_love = appmsg.des
+    title_love = appmsg.title
+    content_cell.paragraphs[0].add_run(title_love + des_love)
+    bubble_style(content_cell.paragraphs[0], isSend)
 
 
-def love_to_docx(conRemark, timeStart, timeEnd):
+def love_to_docx(conRemark, timeStart, timeEnd, session=None, log=print, backend='docx'):
     """
     主函数，将给爱人聊天记录导出到docx
 
     :param conRemark:
     :param timeStart:
     :param timeEnd:
-    """
-    voice_love_dic = './' + timeStart[:4] + '/' + timeStart[5:7] + '/voice_love'
-    file_love_dic = './' + timeStart[:4] + '/' + timeStart[5:7] + '/file_love'
-    tmp_voice_dic = './' + timeStart[:4] + '/' + timeStart[5:7] + '/tmp_voice'
-    video_love_dic = './' + timeStart[:4] + '/' + timeStart[5:7] + '/video_love'
-    mkdir(voice_love_dic)
-    mkdir(file_love_dic)
-    mkdir(tmp_voice_dic)
-    mkdir(video_love_dic)
-    mkdir('./tmp')
-    filename = f"./" + timeStart[:4] + "/" + timeStart[5:7] + "/" + timeStart[:7] + ".docx"
-    doc_love = docx.Document()
-    doc_love.styles['Normal'].font.name = 'Times New Roman'
-    doc_love.styles['Normal']._element.rPr.rFonts.set(qn('w:eastAsia'), u'楷体')
-    special_love_dict = get_love_msg(conRemark, timeStart, timeEnd)
-    last_time = timeStart
-    last_print = timeStart
-    last_isSend = 520
-    for love_msg in special_love_dict:
-        if IS_3_min(last_time, love_msg['theTime']):
-            text_love_time(doc_love, love_msg['theTime'])
-        elif last_isSend ^ love_msg['isSend']:
-            love_paragraph = doc_love.add_paragraph()
-            love_paragraph.paragraph_format.space_before = Pt(5)
-            love_paragraph.paragraph_format.space_after = Pt(5)
-        last_time = love_msg['theTime']
-
-        if IS_8_hour(last_print, love_msg['theTime']):
-            print(colored(love_msg['theTime'] + ' is finished.', "green"))
-            last_print = love_msg['theTime']
-
-        if love_msg['type'] == TYPE_MSG:
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
-            text_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['message'], love_msg['status'])
-        elif love_msg['type'] == TYPE_IMG:
-            image_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['imgPath'])
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['imgPath'])
-        elif love_msg['type'] == TYPE_BIG_EMOJI:
-            emoji_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['message'], love_msg['imgPath'])
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['imgPath'])
-        elif love_msg['type'] == TYPE_SPEAK:
-            voice_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['imgPath'], tmp_voice_dic)
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['imgPath'])
-        elif love_msg['type'] == TYPE_ANSWER_MSG:
-            reply_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['message'], love_msg['status'])
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
-        elif love_msg['type'] == TYPE_WITHDRAW_MSG:
-            retract_message_love(doc_love, love_msg['message'])
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
-        elif love_msg['type'] == TYPE_NAME_CARD:
-            namecard_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['message'])
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
-        elif love_msg['type'] == TYPE_VOIP:
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + str(love_msg['buffer'], 'utf-8'))
-            voip_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['buffer'])
-        elif love_msg['type'] == TYPE_FILE:
-            file_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['message'], file_love_dic)
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
-        elif love_msg['type'] == TYPE_SHOT:
-            shot_love(doc_love, love_msg['person'], love_msg['message'])
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
-        elif love_msg['type'] == TYPE_VIDEO_FILE:
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['imgPath'])
-            video_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['imgPath'], video_love_dic)
-        elif love_msg['type'] == TYPE_SYSTEM:
-            system_love(doc_love, love_msg['person'], love_msg['message'])
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
-        elif love_msg['type'] == TYPE_LINK:
-            link_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['message'], file_love_dic)
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
-        elif love_msg['type'] == TYPE_CUSTOM_EMOJI:
-            custom_emoji_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['message'])
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
-        elif love_msg['type'] == TYPE_MONEY_TRANSFER:
-            money_transfer_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['message'])
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
-        elif love_msg['type'] == TYPE_LUCKY_MONEY:
-            luck_money_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['message'])
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
-        elif love_msg['type'] == TYPE_APP_MSG:
-            app_msg_love(doc_love, love_msg['isSend'], love_msg['person'], love_msg['message'])
-            # print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'])
+    :param session: 导出会话，为空时临时打开数据库
+    :param log: 输出进度的函数
+    :param backend: 'docx'用python-docx生成；'ooxml'直接流式写入WordprocessingML，速度快、内存占用小
+    """
+    with love_session(session) as session:
+        prefetch_love_emoji(conRemark, timeStart, timeEnd, session)
+        _love_to_docx(conRemark, timeStart, timeEnd, session, log, backend)
+
+
+class LoveDocxWriter(object):
+    """
+    一个月份的docx文档：建立所需文件夹，按消息类型逐条写入，最后保存并清理空文件夹
+    """
+
+    def __init__(self, timeStart, session, log=print, last_time=None, last_isSend=520):
+        """
+        :param timeStart: 月份的开始时间，决定输出目录和文件名
+        :param session: 导出会话
+        :param log: 输出进度的函数
+        :param last_time: 上一条消息的时间（毫秒时间戳），跨月连续导出时由上个月传入
+        :param last_isSend: 上一条消息的发送方
+        """
+        self.session = session
+        self.log = log
+        self.voice_love_dic = './' + timeStart[:4] + '/' + timeStart[5:7] + '/voice_love'
+        self.file_love_dic = './' + timeStart[:4] + '/' + timeStart[5:7] + '/file_love'
+        self.tmp_voice_dic = './' + timeStart[:4] + '/' + timeStart[5:7] + '/tmp_voice'
+        self.video_love_dic = './' + timeStart[:4] + '/' + timeStart[5:7] + '/video_love'
+        self.image_love_dic = None
+        if get_images(session).sidecar:
+            self.image_love_dic = './' + timeStart[:4] + '/' + timeStart[5:7] + '/image_love'
+            mkdir(self.image_love_dic)
+        mkdir(self.voice_love_dic)
+        mkdir(self.file_love_dic)
+        mkdir(self.tmp_voice_dic)
+        mkdir(self.video_love_dic)
+        self.voices = []
+        self.filename = f"./" + timeStart[:4] + "/" + timeStart[5:7] + "/" + timeStart[:7] + ".docx"
+        self.open()
+        self.last_time = last_time or love_time_to_ms(timeStart)
+        self.last_print = self.last_time
+        self.last_isSend = last_isSend
+
+    def open(self):
+        """
+        新建文档
+        """
+        self.doc_love = docx.Document()
+        self.doc_love.styles['Normal'].font.name = 'Times New Roman'
+        self.doc_love.styles['Normal']._element.rPr.rFonts.set(qn('w:eastAsia'), u'楷体')
+        add_love_styles(self.doc_love)
+
+    def write(self, love_msg):
+        """
+        写入一条聊天记录
+
+        :param love_msg: LoveMsg
+        """
+        if IS_3_min(self.last_time, love_msg.createTime):
+            self.add_time(love_msg.theTime)
+        elif self.last_isSend ^ love_msg.isSend:
+            self.add_spacing()
+        self.last_time = love_msg.createTime
+
+        if IS_8_hour(self.last_print, love_msg.createTime):
+            self.log(colored(love_msg.theTime + ' is finished.', "green"))
+            self.last_print = love_msg.createTime
+
+        self.add_msg(love_msg)
+        self.last_isSend = love_msg.isSend
+
+    def add_time(self, love_time):
+        """
+        输出时间
+
+        :param love_time:
+        """
+        text_love_time(self.doc_love, love_time)
+
+    def add_spacing(self):
+        """
+        换人说话时空一行
+        """
+        love_paragraph = self.doc_love.add_paragraph()
+        love_paragraph.paragraph_format.space_before = Pt(5)
+        love_paragraph.paragraph_format.space_after = Pt(5)
+
+    def add_msg(self, love_msg):
+        """
+        按消息类型写入聊天内容
+
+        :param love_msg: LoveMsg
+        """
+        if love_msg.type == TYPE_MSG:
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
+            text_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.message, love_msg.status, self.session)
+        elif love_msg.type == TYPE_IMG:
+            image_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.imgPath, self.session,
+                       self.image_love_dic)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.imgPath)
+        elif love_msg.type == TYPE_BIG_EMOJI:
+            emoji_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.message, love_msg.imgPath, self.session)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.imgPath)
+        elif love_msg.type == TYPE_SPEAK:
+            voice_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.imgPath, self.voices, self.session)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.imgPath)
+        elif love_msg.type == TYPE_ANSWER_MSG:
+            reply_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.message, love_msg.status, self.session,
+                       love_msg.msgId)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
+        elif love_msg.type == TYPE_WITHDRAW_MSG:
+            retract_message_love(self.doc_love, love_msg.message)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
+        elif love_msg.type == TYPE_NAME_CARD:
+            namecard_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.message, self.session, love_msg.msgId)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
+        elif love_msg.type == TYPE_VOIP:
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + str(love_msg.buffer, 'utf-8'))
+            voip_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.buffer, self.session)
+        elif love_msg.type == TYPE_FILE:
+            file_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.message, self.file_love_dic, self.session,
+                      love_msg.msgId)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
+        elif love_msg.type == TYPE_SHOT:
+            shot_love(self.doc_love, love_msg.person, love_msg.message, love_msg.msgId)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
+        elif love_msg.type == TYPE_VIDEO_FILE:
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.imgPath)
+            video_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.imgPath, self.video_love_dic, self.session)
+        elif love_msg.type == TYPE_SYSTEM:
+            system_love(self.doc_love, love_msg.person, love_msg.message)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
+        elif love_msg.type == TYPE_LINK:
+            link_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.message, self.file_love_dic, self.session,
+                      love_msg.msgId)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
+        elif love_msg.type == TYPE_CUSTOM_EMOJI:
+            custom_emoji_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.message, self.session,
+                              love_msg.msgId)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
+        elif love_msg.type == TYPE_MONEY_TRANSFER:
+            money_transfer_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.message, self.session,
+                                love_msg.msgId)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
+        elif love_msg.type == TYPE_LUCKY_MONEY:
+            luck_money_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.message, self.session, love_msg.msgId)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
+        elif love_msg.type == TYPE_APP_MSG:
+            app_msg_love(self.doc_love, love_msg.isSend, love_msg.person, love_msg.message, self.session, love_msg.msgId)
+            # print(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message)
         else:
-            print('wrong')
-            print(love_msg['theTime'] + ' ' + love_msg['person'] + ' ' + love_msg['message'], love_msg['type'])
-
-        last_isSend = love_msg['isSend']
-
-    doc_love.save(filename)
+            self.log('wrong')
+            self.log(love_msg.theTime + ' ' + love_msg.person + ' ' + love_msg.message + ' ' + str(love_msg.type))
+
+    def save(self):
+        """
+        保存文档
+        """
+        renumber_love_pictures(self.doc_love)
+        self.doc_love.save(self.filename)
+
+    def transcode_voices(self):
+        """
+        把文档中的语音并行转成mp3放到voice_love，转换失败的复制原文件到tmp_voice，可以手动转换
+        """
+        failed = get_voice_cache().transcode_all([(voice_file, self.voice_love_dic + '/' + name + '.mp3')
+                                                  for voice_file, name in self.voices])
+        for voice_file, mp3_file in failed:
+            get_blob_store().link(voice_file, self.tmp_voice_dic + '/' + os.path.basename(mp3_file)[:-4] + '.amr')
+        if self.voices:
+            self.log(colored('{}条语音已转换，{}条失败'.format(len(self.voices) - len(failed), len(failed)), "green"))
+        self.voices = []
+
+    def close(self):
+        """
+        保存文档，转换语音，删除没有用到的文件夹
+        """
+        self.save()
+        self.transcode_voices()
+
+        if len(os.listdir(self.file_love_dic)) == 0:
+            os.removedirs(self.file_love_dic)
+            # print('成功删除 ' + self.file_love_dic)
+        if len(os.listdir(self.tmp_voice_dic)) == 0:
+            os.removedirs(self.tmp_voice_dic)
+            # print('成功删除 ' + self.tmp_voice_dic)
+        if len(os.listdir(self.voice_love_dic)) == 0:
+            os.removedirs(self.voice_love_dic)
+            # print('成功删除 ' + self.voice_love_dic)
+        if len(os.listdir(self.video_love_dic)) == 0:
+            os.removedirs(self.video_love_dic)
+            # print('成功删除 ' + self.video_love_dic)
+        if self.image_love_dic is not None and len(os.listdir(self.image_love_dic)) == 0:
+            os.removedirs(self.image_love_dic)
+
+
+def love_writer(backend='docx'):
+    """
+    获取文档生成方式对应的类
+
+    :param backend: 'docx'或'ooxml'
+    :return: LoveDocxWriter或OoxmlLoveWriter
+    """
+    if backend == 'docx':
+        return LoveDocxWriter
+    if backend == 'ooxml':
+        from wcooxml import OoxmlLoveWriter
+        return OoxmlLoveWriter
+    raise ValueError('Unknown backend: ' + backend)
+
+
+def _love_to_docx(conRemark, timeStart, timeEnd, session, log, backend='docx'):
+    """
+    love_to_docx的实现，数据库查询全部走已打开的会话
 
-    if len(os.listdir(file_love_dic)) == 0:
-        os.removedirs(file_love_dic)
-        # print('成功删除 ' + file_love_dic)
-    if len(os.listdir(tmp_voice_dic)) == 0:
-        os.removedirs(tmp_voice_dic)
-        # print('成功删除 ' + tmp_voice_dic)
-        os.removedirs(voice_love_dic)
-        # print('成功删除 ' + voice_love_dic)
-    if len(os.listdir(video_love_dic)) == 0:
-        os.removedirs(video_love_dic)
-        # print('成功删除 ' + video_love_dic)
+    :param conRemark:
+    :param timeStart:
+    :param timeEnd:
+    :param session: 导出会话
+    :param log: 输出进度的函数
+    :param backend: 文档生成方式
+    """
+    writer = love_writer(backend)(timeStart, session, log)
+    for love_msg in prefetch_love_msg(iter_love_msg(conRemark, timeStart, timeEnd, session), session):
+        writer.write(love_msg)
+    writer.close()
 
 
-def love_all(conRemark, timeStart, timeEnd):
+def love_months(timeStart, timeEnd):
     """
-    按年月分别导出
+    把时间范围按自然月切分
 
-    :param conRemark:
     :param timeStart:
     :param timeEnd:
+    :return: [(月初, 下月初)]
     """
     Start_month = (int(timeStart[:4]) - 2020) * 12 + int(timeStart[5:7]) - 1
     End_month = (int(timeEnd[:4]) - 2020) * 12 + int(timeEnd[5:7]) - 1
+    months = []
     while Start_month < End_month:
         new_timeStart = str(Start_month // 12 + 2020) + '-' + '{:0>2d}'.format(Start_month % 12 + 1) + '-01 00:00:00'
         Start_month += 1
         new_timeEnd = str(Start_month // 12 + 2020) + '-' + '{:0>2d}'.format(Start_month % 12 + 1) + '-01 00:00:00'
-        love_to_docx(conRemark, new_timeStart, new_timeEnd)
+        months.append((new_timeStart, new_timeEnd))
+    return months
+
+
+_worker_session = None
+
+
+def _love_worker_init(media, images=None, prefetch=LOVE_PREFETCH, emoji=None):
+    """
+    并行导出的子进程初始化：每个子进程打开自己的数据库连接，媒体索引由主进程传入（只读共享）
+
+    :param media: 媒体文件索引
+    :param images: 图片缓存的设置
+    :param prefetch: 预读的消息条数
+    :param emoji: 表情包下载的设置
+    """
+    global _worker_session
+    _worker_session = LoveSession(media, images, prefetch, emoji)
+    Finalize(_worker_session, _worker_session.close, exitpriority=10)
+
+
+def _love_worker_month(conRemark, timeStart, timeEnd, backend='docx'):
+    """
+    在子进程中导出一个月，进度信息收集起来交给主进程按顺序输出
+
+    :param conRemark:
+    :param timeStart:
+    :param timeEnd:
+    :param backend: 文档生成方式
+    :return: 进度信息列表
+    """
+    lines = []
+    _love_to_docx(conRemark, timeStart, timeEnd, _worker_session, lines.append, backend)
+    return lines
+
+
+def love_all_single_scan(conRemark, months, session, backend='docx'):
+    """
+    只查询一次数据库：按时间顺序读取整个范围的聊天记录，边读边按月份分到各自的文档中。
+    上一条消息的时间跨月延续，月初的时间显示与前后文一致
+
+    :param conRemark:
+    :param months: love_months的结果
+    :param session: 导出会话
+    :param backend: 文档生成方式
+    """
+    writer_class = love_writer(backend)
+    month_ends = [love_time_to_ms(new_timeEnd) for new_timeStart, new_timeEnd in months]
+    month = 0
+    writer = writer_class(months[month][0], session)
+    for love_msg in prefetch_love_msg(iter_love_msg(conRemark, months[0][0], months[-1][1], session), session):
+        '''切换到消息所在的月份，中间没有消息的月份也照常生成文档'''
+        while love_msg.createTime >= month_ends[month]:
+            writer.close()
+            print(colored(months[month][0][:7] + ' is finished!!!', "red"))
+            month += 1
+            writer = writer_class(months[month][0], session, last_time=writer.last_time,
+                                  last_isSend=writer.last_isSend)
+        writer.write(love_msg)
+    writer.close()
+    print(colored(months[month][0][:7] + ' is finished!!!', "red"))
+    for new_timeStart, new_timeEnd in months[month + 1:]:
+        writer = writer_class(new_timeStart, session, last_time=writer.last_time, last_isSend=writer.last_isSend)
+        writer.close()
         print(colored(new_timeStart[:7] + ' is finished!!!', "red"))
 
 
-def sum_love_voip(conRemark):
+def love_all(conRemark, timeStart, timeEnd, session=None, workers=1, single_scan=False, backend='docx'):
+    """
+    按年月分别导出：单进程时所有月份共用一个导出会话；workers > 1时各月份分配到进程池并行导出
+
+    :param conRemark:
+    :param timeStart:
+    :param timeEnd:
+    :param session: 导出会话，为空时临时打开数据库
+    :param workers: 并行导出的进程数，每个月份互相独立
+    :param single_scan: 只查询一次数据库，按月份拆分（单进程，跨月份延续时间显示），不能和workers > 1同时使用
+    :param backend: 'docx'用python-docx生成；'ooxml'直接流式写入WordprocessingML
+    """
+    if single_scan and workers > 1:
+        raise ValueError('single_scan cannot be combined with workers > 1')
+    months = love_months(timeStart, timeEnd)
+    if not months:
+        return
+    with love_session(session) as love:
+        '''整个范围的表情包一次下载完，子进程的媒体索引中已包含新下载的表情包'''
+        prefetch_love_emoji(conRemark, months[0][0], months[-1][1], love)
+    if workers > 1 and len(months) > 1:
+        media = get_media(session)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_love_worker_init,
+                                 initargs=(media, get_images(session),
+                                           session.prefetch if session is not None else LOVE_PREFETCH,
+                                           get_emoji(session))) as pool:
+            futures = [pool.submit(_love_worker_month, conRemark, new_timeStart, new_timeEnd, backend)
+                       for new_timeStart, new_timeEnd in months]
+            '''按月份顺序输出各子进程的进度'''
+            for (new_timeStart, new_timeEnd), future in zip(months, futures):
+                for line in future.result():
+                    print(line)
+                print(colored(new_timeStart[:7] + ' is finished!!!', "red"))
+        return
+    with love_session(session) as session:
+        if single_scan:
+            love_all_single_scan(conRemark, months, session, backend)
+            return
+        for new_timeStart, new_timeEnd in months:
+            _love_to_docx(conRemark, new_timeStart, new_timeEnd, session, print, backend)
+            print(colored(new_timeStart[:7] + ' is finished!!!', "red"))
+
+
+def love_voip_seconds(buffer):
+    """
+    从通话消息的lvbuffer中取出通话时长，如“聊天时长 05:23”“通话时长 1:02:03”
+
+    :param buffer: lvbuffer
+    :return: 秒数，没有时长（未接通、已取消等）时为0
+    """
+    love_voip = VOIP_DURATION_RE.search(str(buffer or b'', 'utf-8', 'ignore'))
+    if love_voip is None:
+        return 0
+    love_seconds = 0
+    for part in love_voip.group(1).split(':'):
+        love_seconds = love_seconds * 60 + int(part)
+    return love_seconds
+
+
+def sum_love_voip(conRemark, session=None, snapshot=None):
     """
     计算语音/视频通话时长和
     sum_love(hour, min, mes)：通话时长和/（时，分，秒）记录
 
     :param conRemark: 备注
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
     """
-    select_love_voip = 'SELECT datetime(subStr(cast(msg.createTime as text),1,10),"unixepoch","localtime") AS theTime,' \
-                       'msg.lvbuffer AS buffer ' \
-                       'FROM message msg INNER JOIN rcontact name ON msg.talker = name.username ' \
-                       'WHERE name.conRemark = \'' + conRemark + '\' ' \
-                                                                 'AND msg.type = 50 ' \
-                                                                 'ORDER BY theTime;'
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love_voip)
-    desc = msg_cur.description
-    special_love_voip = [dict(zip([col[0] for col in desc], row)) for row in msg_cur.fetchall()]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
-
-    sum_love = 0
-    str_love = '语音通话'
-    for love_voip in special_love_voip:
-        str_tmp = str(love_voip['buffer'], 'utf-8')
-        if str_tmp.find('聊天时长') != -1:
-            str_love = str_tmp[str_tmp.find('聊天时长'):str_tmp.find(':') + 3]
-        elif str_tmp.find('通话时长') != -1:
-            str_love = str_tmp[str_tmp.find('通话时长'):str_tmp.find(':') + 3]
-        elif str_tmp.find('通话中断') != -1:
-            try:
-                str_love = str_tmp[str_tmp.find('通话中断'):str_tmp.find(':') + 3]
-            except Exception:
-                str_love = '通话中断'
-        if str_love:
-            # print(str_love)
-            try:
-                min_love = str_love[str_love.find(' ') + 1:str_love.find(':')]
-                mes_love = str_love[str_love.find(':') + 1:]
-                sum_love += int(mes_love) + int(min_love) * 60
-                # print(mes_love)
-                # print(min_love)
-            except Exception:
-                sum_love = sum_love
-                # print(str_love)
+    if snapshot is not None:
+        _print_love_voip(int(snapshot.voip_seconds.sum()))
+        return
+    select_love_voip = 'SELECT msg.lvbuffer AS buffer ' \
+                       'FROM message msg ' \
+                       'WHERE msg.talker = ? ' \
+                       'AND msg.type = ?;'
+    with love_session(session) as session:
+        talker = session.get_love_wxid(conRemark)
+        sum_love = sum(love_voip_seconds(love_voip.buffer)
+                       for love_voip in session.iter_rows(select_love_voip, (talker, TYPE_VOIP)))
+    _print_love_voip(sum_love)
+
+
+def _print_love_voip(sum_love):
     minute, mes = divmod(sum_love, 60)
     hour, minute = divmod(minute, 60)
     print("%d:%02d:%02d" % (hour, minute, mes))
     print(sum_love)
 
 
-def sum_love_baby(conRemark):
+def love_words(conRemark, words=LOVE_WORDS, session=None, snapshot=None):
+    """
+    统计关键词：只扫描一遍文字消息，同时统计所有关键词的次数、各自说了多少次、第一次/最后一次的时间和每月次数
+
+    :param conRemark: 备注
+    :param words: 关键词列表
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
+    :return: {关键词: LoveWord}
+    """
+    matcher = WordMatcher(words)
+    if snapshot is not None:
+        love_msgs = ((int(snapshot.createTime[index]), snapshot.isSend[index], snapshot.content(index))
+                     for index in np.flatnonzero(snapshot.type == TYPE_MSG))
+        return _count_love_words(matcher, love_msgs)
+    select_love_words = 'SELECT msg.createTime AS createTime, msg.isSend AS isSend, msg.content AS message ' \
+                        'FROM message msg ' \
+                        'WHERE msg.talker = ? ' \
+                        'AND msg.type = ? ' \
+                        'ORDER BY msg.createTime;'
+    with love_session(session) as session:
+        talker = session.get_love_wxid(conRemark)
+        love_msgs = ((love_msg.createTime, love_msg.isSend, love_msg.message)
+                     for love_msg in session.iter_rows(select_love_words, (talker, TYPE_MSG)))
+        return _count_love_words(matcher, love_msgs)
+
+
+def _count_love_words(matcher, love_msgs):
+    """
+    :param matcher: WordMatcher
+    :param love_msgs: 按时间排序的(createTime, isSend, 内容)
+    :return: {关键词: LoveWord}
+    """
+    count = [0] * len(matcher.words)
+    send = [0] * len(matcher.words)
+    first = [None] * len(matcher.words)
+    last = [None] * len(matcher.words)
+    months = [{} for word in matcher.words]
+    for createTime, isSend, message in love_msgs:
+        love_counts = matcher.count(message)
+        if not any(love_counts):
+            continue
+        theTime = love_ms_to_time(createTime)
+        for index, love_count in enumerate(love_counts):
+            if not love_count:
+                continue
+            count[index] += love_count
+            if isSend:
+                send[index] += love_count
+            if first[index] is None:
+                first[index] = theTime
+            last[index] = theTime
+            months[index][theTime[:7]] = months[index].get(theTime[:7], 0) + love_count
+    return {word: LoveWord(word, count[index], send[index], count[index] - send[index], first[index], last[index],
+                           months[index])
+            for index, word in enumerate(matcher.words)}
+
+
+def sum_love_word(conRemark, word, session=None, snapshot=None):
+    """
+    计算说某个词的次数，打印第一次说的时间和次数
+
+    :param conRemark:
+    :param word: 关键词
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
+    """
+    love_word = love_words(conRemark, (word,), session, snapshot)[word]
+    if love_word.first is not None:
+        print(love_word.first)
+    print(love_word.count)
+
+
+def sum_love_baby(conRemark, session=None, snapshot=None):
     """
     计算称呼宝宝的次数
     sum_love：我叫宝宝的次数
     start_love_baby：第一次叫宝宝的时间
 
     :param conRemark:
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
     """
-    select_love_baby = 'SELECT datetime(subStr(cast(msg.createTime as text),1,10),"unixepoch","localtime") AS theTime,' \
-                       'msg.content AS message ' \
-                       'FROM message msg INNER JOIN rcontact name ON msg.talker = name.username ' \
-                       'WHERE name.conRemark = \'' + conRemark + '\' ' \
-                                                                 'AND msg.type = 1 ' \
-                                                                 "AND msg.content LIKE '%宝宝%' " \
-                                                                 'ORDER BY theTime;'
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love_baby)
-    desc = msg_cur.description
-    special_love_baby = [dict(zip([col[0] for col in desc], row)) for row in msg_cur.fetchall()]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
-    start_love_baby = special_love_baby[0]['theTime']
-    print(start_love_baby)
-
-    sum_love = 0
-
-    for love_baby in special_love_baby:
-        sum_love += love_baby['message'].count('宝宝')
-
-    print(sum_love)
+    sum_love_word(conRemark, '宝宝', session, snapshot)
 
 
-def sum_love_guai(conRemark):
+def sum_love_guai(conRemark, session=None, snapshot=None):
     """
     计算称呼乖乖的次数
     sum_love：我叫乖乖的次数
     start_love_guai：第一次叫乖乖的时间
 
     :param conRemark:
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
     """
-    select_love_guai = 'SELECT datetime(subStr(cast(msg.createTime as text),1,10),"unixepoch","localtime") AS theTime,' \
-                       'msg.content AS message ' \
-                       'FROM message msg INNER JOIN rcontact name ON msg.talker = name.username ' \
-                       'WHERE name.conRemark = \'' + conRemark + '\' ' \
-                                                                 'AND msg.type = 1 ' \
-                                                                 "AND msg.content LIKE '%乖乖%' " \
-                                                                 'ORDER BY theTime;'
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love_guai)
-    desc = msg_cur.description
-    special_love_guai = [dict(zip([col[0] for col in desc], row)) for row in msg_cur.fetchall()]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
-    start_love_guai = special_love_guai[0]['theTime']
-    print(start_love_guai)
-
-    sum_love = 0
-
-    for love_guai in special_love_guai:
-        sum_love += love_guai['message'].count('乖乖')
-
-    print(sum_love)
+    sum_love_word(conRemark, '乖乖', session, snapshot)
 
 
-def sum_love_ILOVEU(conRemark):
+def sum_love_ILOVEU(conRemark, session=None, snapshot=None):
     """
     计算说我爱你的次数
     sum_love：说我爱你的次数
     start_love_ILOVEU：第一次说我爱你的时间
 
     :param conRemark:
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
     """
-    select_love_ILOVEU = 'SELECT datetime(subStr(cast(msg.createTime as text),1,10),"unixepoch","localtime") AS theTime,' \
-                         'msg.content AS message ' \
-                         'FROM message msg INNER JOIN rcontact name ON msg.talker = name.username ' \
-                         'WHERE name.conRemark = \'' + conRemark + '\' ' \
-                                                                   'AND msg.type = 1 ' \
-                                                                   "AND msg.content LIKE '%我爱你%' " \
-                                                                   'ORDER BY theTime;'
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love_ILOVEU)
-    desc = msg_cur.description
-    special_love_ILOVEU = [dict(zip([col[0] for col in desc], row)) for row in msg_cur.fetchall()]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
-    start_love_ILOVEU = special_love_ILOVEU[0]['theTime']
-    print(start_love_ILOVEU)
-
-    sum_love = 0
-
-    for love_ILOVEU in special_love_ILOVEU:
-        sum_love += love_ILOVEU['message'].count('我爱你')
+    sum_love_word(conRemark, '我爱你', session, snapshot)
 
-    print(sum_love)
 
-
-def sum_love_LOVEU(conRemark):
+def sum_love_LOVEU(conRemark, session=None, snapshot=None):
     """
     计算说爱你的次数
     sum_love：说爱你的次数
     start_love_ILOVEU：第一次说爱你的时间
 
     :param conRemark:
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
     """
-    select_love_LOVEU = 'SELECT datetime(subStr(cast(msg.createTime as text),1,10),"unixepoch","localtime") AS theTime,' \
-                        'msg.content AS message ' \
-                        'FROM message msg INNER JOIN rcontact name ON msg.talker = name.username ' \
-                        'WHERE name.conRemark = \'' + conRemark + '\' ' \
-                                                                  'AND msg.type = 1 ' \
-                                                                  "AND msg.content LIKE '%爱你%' " \
-                                                                  'ORDER BY theTime;'
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love_LOVEU)
-    desc = msg_cur.description
-    special_love_LOVEU = [dict(zip([col[0] for col in desc], row)) for row in msg_cur.fetchall()]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
-    start_love_LOVEU = special_love_LOVEU[0]['theTime']
-    print(start_love_LOVEU)
-
-    sum_love = 0
-
-    for love_LOVEU in special_love_LOVEU:
-        sum_love += love_LOVEU['message'].count('爱你')
-
-    print(sum_love)
+    sum_love_word(conRemark, '爱你', session, snapshot)
 
 
-def sum_love_LOVE(conRemark):
+def sum_love_LOVE(conRemark, session=None, snapshot=None):
     """
     计算说爱的次数
     sum_love：说爱的次数
     start_love_ILOVEU：第一次说爱的时间
 
     :param conRemark:
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
     """
-    select_love_LOVE = 'SELECT datetime(subStr(cast(msg.createTime as text),1,10),"unixepoch","localtime") AS theTime,' \
-                       'msg.content AS message ' \
-                       'FROM message msg INNER JOIN rcontact name ON msg.talker = name.username ' \
-                       'WHERE name.conRemark = \'' + conRemark + '\' ' \
-                                                                 'AND msg.type = 1 ' \
-                                                                 "AND msg.content LIKE '%爱%' " \
-                                                                 'ORDER BY theTime;'
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love_LOVE)
-    desc = msg_cur.description
-    special_love_LOVE = [dict(zip([col[0] for col in desc], row)) for row in msg_cur.fetchall()]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
-    start_love_LOVE = special_love_LOVE[0]['theTime']
-    print(start_love_LOVE)
-
-    sum_love = 0
-
-    for love_LOVE in special_love_LOVE:
-        sum_love += love_LOVE['message'].count('爱')
+    sum_love_word(conRemark, '爱', session, snapshot)
 
-    print(sum_love)
 
+def sum_love_words(conRemark, words=LOVE_WORDS, session=None, snapshot=None):
+    """
+    一次统计多个关键词，每个词打印一行：关键词、次数、自己/对方说的次数、第一次和最后一次的时间
 
-def love_in_night(conRemark):
+    :param conRemark:
+    :param words: 关键词列表
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
+    """
+    for love_word in love_words(conRemark, words, session, snapshot).values():
+        print(love_word.word, love_word.count, love_word.send, love_word.receive, love_word.first, love_word.last)
+
+
+def love_in_night(conRemark, session=None, snapshot=None):
     """
     记录每一次深夜畅聊
     sum_love_talk：两人凌晨还在聊天的天数
@@ -1460,123 +2116,115 @@ def love_in_night(conRemark):
     start_love_in_night：第一次因为对方熬夜到第二天
 
     :param conRemark:
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
+    :return: LoveNight
     """
-    select_love_talk = 'SELECT datetime(subStr(cast(msg.createTime as text),1,10),"unixepoch","localtime") AS theTime ' \
-                       'FROM message msg INNER JOIN rcontact name ON msg.talker = name.username ' \
-                       'WHERE name.conRemark = \'' + conRemark + '\' ' \
-                                                                 'AND (msg.type = 50 OR msg.isSend = 0) ' \
-                                                                 'ORDER BY theTime;'
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love_talk)
-    desc = msg_cur.description
-    special_love_talk = [dict(zip([col[0] for col in desc], row)) for row in msg_cur.fetchall()]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
-
-    timestamp_flag = 23400
+    love = love_night(love_columns(conRemark, session=session, snapshot=snapshot))
+    print(love.talk_days)
+    print(love.night_days)
+    print(love.midnight_days)
+    print(love.first_night)
+    return love
 
-    love_flag = "00"
-    sum_love_talk = 0
 
-    for love_talk in special_love_talk:
-        if love_talk['theTime'][8:10] == love_flag:
-            continue
-        love_flag = love_talk['theTime'][8:10]
-        love_timestamp = int(love_talk['theTime'][11:13]) * 60 * 60 + int(love_talk['theTime'][14:16]) * 60 + int(
-            love_talk['theTime'][17:19])
-        if love_timestamp < timestamp_flag:
-            sum_love_talk += 1
-
-    select_love = 'SELECT datetime(subStr(cast(msg.createTime as text),1,10),"unixepoch","localtime") AS theTime ' \
-                  'FROM message msg INNER JOIN rcontact name ON msg.talker = name.username ' \
-                  'WHERE name.conRemark = \'' + conRemark + '\' ' \
-                                                            'ORDER BY theTime;'
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love)
-    desc = msg_cur.description
-    special_love = [dict(zip([col[0] for col in desc], row)) for row in msg_cur.fetchall()]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
-
-    timestamp_flag = 23400
-
-    trigger_love = 0
-    love_flag = "00"
-    sum_love = 0
-    flag = 1
-    for love in special_love:
-        if love['theTime'][8:10] == love_flag:
-            continue
-        love_flag = love['theTime'][8:10]
-        love_timestamp = int(love['theTime'][11:13]) * 60 * 60 + int(love['theTime'][14:16]) * 60 + int(
-            love['theTime'][17:19])
-        if love_timestamp < timestamp_flag:
-            if flag == 1:
-                start_love_in_night = love['theTime']
-                flag = 0
-            sum_love += 1
-        if love['theTime'][11:16] == '00:00':
-            trigger_love += 1
-
-    print(sum_love_talk)
-    print(sum_love)
-    print(trigger_love)
-    print(start_love_in_night)
-
-
-def sum_love_wanan(conRemark):
+def sum_love_wanan(conRemark, session=None, snapshot=None):
     """
     计算说晚安的次数
     sum_love：说晚安的次数
     start_love_wanan：第一次说晚安的时间
 
     :param conRemark:
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
     """
-    select_love_wanan = 'SELECT datetime(subStr(cast(msg.createTime as text),1,10),"unixepoch","localtime") AS theTime,' \
-                        'msg.content AS message ' \
-                        'FROM message msg INNER JOIN rcontact name ON msg.talker = name.username ' \
-                        'WHERE name.conRemark = \'' + conRemark + '\' ' \
-                                                                  'AND msg.type = 1 ' \
-                                                                  "AND msg.content LIKE '%晚安%' " \
-                                                                  'ORDER BY theTime;'
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love_wanan)
-    desc = msg_cur.description
-    special_love_wanan = [dict(zip([col[0] for col in desc], row)) for row in msg_cur.fetchall()]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
-    start_love_wanan = special_love_wanan[0]['theTime']
-    print(start_love_wanan)
-
-    sum_love = 0
-
-    for love_wanan in special_love_wanan:
-        sum_love += love_wanan['message'].count('晚安')
-
-    print(sum_love)
+    sum_love_word(conRemark, '晚安', session, snapshot)
 
 
-def get_love_sum(conRemark, timeStart, timeInterval):
+def get_love_sum(conRemark, timeStart, timeInterval, session=None):
     """
     记录当前时间间隔发送消息数量
 
     :param conRemark: 备注
     :param timeStart: 开始时间（时间戳表示）
     :param timeInterval: 时间间隔长度（时间戳表示）
+    :param session: 导出会话，为空时临时打开数据库
     :return: timeEnd, love_sum: 结束时间， 消息数量
     """
     timeEnd = timeStart + timeInterval
     select_love_sum = 'SELECT COUNT(*) ' \
-                      'FROM message msg INNER JOIN rcontact name ON msg.talker = name.username ' \
-                      'WHERE name.conRemark = \'' + conRemark + '\' ' \
-                                                                'AND msg.createTime < ' + str(timeEnd) + ' ' \
-                                                                'AND msg.createTime >= ' + str(timeStart) + ' ' \
-                                                                'ORDER BY msg.createTime;'
-    msg_cur, file_cur, msg_con, file_con = connect_wcdb()
-    msg_cur.execute(select_love_sum)
-    love_sum = msg_cur.fetchone()[0]
-    close_wcdb(msg_cur, file_cur, msg_con, file_con)
+                      'FROM message msg ' \
+                      'WHERE msg.talker = ? ' \
+                      'AND msg.createTime < ? ' \
+                      'AND msg.createTime >= ?;'
+    with love_session(session) as session:
+        talker = session.get_love_wxid(conRemark)
+        love_sum = session.query(select_love_sum, (talker, timeEnd, timeStart)).fetchone()[0]
     return timeEnd, love_sum
 
 
-def sum_love_every(conRemark, Start, End, Interval):
+def love_columns(conRemark, timeStart=None, timeEnd=None, session=None, snapshot=None):
+    """
+    一次查询读出联系人所有消息的时间、收发和类型，放进NumPy数组，统计时不再逐行处理
+
+    :param conRemark: 备注
+    :param timeStart: 开始时间，为空时从第一条消息开始
+    :param timeEnd: 结束时间（不含），为空时到最后一条消息
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
+    :return: LoveColumns
+    """
+    if snapshot is not None:
+        return snapshot.columns(timeStart, timeEnd)
+    talker_start = love_time_to_ms(timeStart) if timeStart else 0
+    talker_end = love_time_to_ms(timeEnd) if timeEnd else 1 << 62
+    select_love_columns = 'SELECT msg.createTime, msg.isSend, msg.type ' \
+                          'FROM message msg ' \
+                          'WHERE msg.talker = ? ' \
+                          'AND msg.createTime >= ? ' \
+                          'AND msg.createTime < ? ' \
+                          'ORDER BY msg.createTime;'
+    with love_session(session) as session:
+        talker = session.get_love_wxid(conRemark)
+        cur = session.query(select_love_columns, (talker, talker_start, talker_end))
+        try:
+            '''直接从游标逐行填进结构化数组，不经过Python列表'''
+            love_rows = np.fromiter(cur, dtype=[('createTime', np.int64), ('isSend', np.uint8), ('type', np.int64)])
+        finally:
+            cur.close()
+    return LoveColumns(love_rows['createTime'].copy(), love_rows['isSend'].copy(), love_rows['type'].copy())
+
+
+def love_every(conRemark, Start, End, Interval, session=None, snapshot=None):
+    """
+    按固定间隔统计消息数：只查询一次，用bincount按区间序号计数
+
+    :param conRemark:
+    :param Start: 开始时间
+    :param End: 结束时间，最后一个区间可以超过它
+    :param Interval: 时间间隔长度（/天）
+    :param session: 导出会话，为空时临时打开数据库
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
+    :return: LoveEvery
+    """
+    timeStart = love_time_to_ms(Start)
+    timeEnd = love_time_to_ms(End)
+    timeInterval = 86400000 * Interval
+    love_starts = np.arange(timeStart, timeEnd, timeInterval, dtype=np.int64)
+    love_count = len(love_starts)
+    '''和原来逐段查询一样，最后一个区间完整统计，不截断在End'''
+    createTime = love_columns(conRemark, Start, love_ms_to_time(timeStart + love_count * timeInterval),
+                              session, snapshot).createTime
+    counts = np.bincount((createTime - timeStart) // timeInterval, minlength=love_count)[:love_count]
+    times = [love_ms_to_time(int(love_start))[:10] for love_start in love_starts]
+    if not love_count:
+        return LoveEvery(times, counts, 0, Start[:10], 0)
+    '''次数相同时取最后一个区间'''
+    max_index = love_count - 1 - int(np.argmax(counts[::-1]))
+    return LoveEvery(times, counts, int(counts[max_index]), times[max_index], int(counts.sum()))
+
+
+def sum_love_every(conRemark, Start, End, Interval, session=None, save=None, snapshot=None):
     """
     绘制每天聊天记录曲线图，且记载次数最多的时间和数量，以及全部总和
 
@@ -1584,21 +2232,12 @@ def sum_love_every(conRemark, Start, End, Interval):
     :param Start:
     :param End:
     :param Interval: 时间间隔长度（/天）
+    :param session: 导出会话，为空时临时打开数据库
+    :param save: 图片保存路径，不为空时保存到文件而不弹出窗口（可在没有显示器的环境运行）
+    :param snapshot: wcsnap导出的快照，不为空时直接读快照，不查询数据库
+    :return: LoveEvery
     """
-    timeStart = int(time.mktime(time.strptime(Start, '%Y-%m-%d %H:%M:%S'))) * 1000
-    timeEnd = int(time.mktime(time.strptime(End, '%Y-%m-%d %H:%M:%S'))) * 1000
-    timeInterval = 86400000 * Interval
-    love_list = []
-    love_time = []
-    max_love = 0
-    max_love_time = Start[:10]
-    while timeStart < timeEnd:
-        love_time.append(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timeStart / 1000))[:10])
-        timeStart, love_sum = get_love_sum(conRemark, timeStart, timeInterval)
-        love_list.append(love_sum)
-        if love_sum >= max_love:
-            max_love = love_sum
-            max_love_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timeStart / 1000))[:10]
+    love = love_every(conRemark, Start, End, Interval, session, snapshot)
     fig, ax = plt.subplots(figsize=(7, 3), dpi=200)
 
     ax.spines["left"].set_visible(False)
@@ -1606,15 +2245,51 @@ def sum_love_every(conRemark, Start, End, Interval):
     ax.spines["right"].set_visible(False)
 
     ax.grid(ls="--", lw=0.5, color="#4E616C")
-    print(max_love)
-    print(max_love_time)
-    print(sum(love_list))
-    ax.plot(love_time, love_list, marker="o", mfc="white", ms=2, lw=1)
+    print(love.max_count)
+    print(love.max_time)
+    print(love.total)
+    ax.plot(love.times, love.counts, marker="o", mfc="white", ms=2, lw=1)
     ax.xaxis.set_major_locator(ticker.MultipleLocator(20))  # ticker every 2 matchdays
-    ax.set_xticks(love_time[::20])
+    ax.set_xticks(love.times[::20])
     ax.xaxis.set_tick_params(direction='inout', length=2, color="#4E616C", labelcolor="#4E616C", labelsize=4,
                              rotation=90)
     ax.yaxis.set_tick_params(direction='inout', length=2, color="#4E616C", labelcolor="#4E616C", labelsize=5)
 
     ax.spines["bottom"].set_edgecolor("#4E616C")
-    plt.show()
+    if save:
+        fig.savefig(save, bbox_inches='tight')
+        plt.close(fig)
+    else:
+        plt.show()
+    return love
+
+
+def main():
+    parser = argparse.ArgumentParser(description='将与指定备注的联系人的聊天记录按月导出到docx')
+    parser.add_argument('conRemark', help='联系人备注')
+    parser.add_argument('timeStart', help='开始月份，如 2021-01')
+    parser.add_argument('timeEnd', help='结束月份（不含），如 2022-01')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='并行导出的进程数')
+    parser.add_argument('--single-scan', action='store_true', help='只查询一次数据库，按月份拆分（单进程）')
+    parser.add_argument('--backend', choices=('docx', 'ooxml'), default='docx',
+                        help='文档生成方式：docx用python-docx；ooxml直接流式写入，速度快、内存占用小')
+    parser.add_argument('--image-max-px', type=int, default=IMAGE_MAX_PX,
+                        help='插入文档的图片长边的最大像素，0为不缩小')
+    parser.add_argument('--image-quality', type=int, default=IMAGE_QUALITY, help='缩小后JPEG图片的质量')
+    parser.add_argument('--link-original', action='store_true', help='把原图复制到image_love文件夹，并在图片下方链接原图')
+    parser.add_argument('--prefetch', type=int, default=LOVE_PREFETCH,
+                        help='后台线程提前准备图片的消息条数，0为不预读')
+    parser.add_argument('--emoji-base-url', help='下载表情包时用这个地址代替cdnurl的协议和域名，例如本地镜像')
+    parser.add_argument('--offline', action='store_true', help='不下载网络图片，只使用net_cache中已有的')
+    args = parser.parse_args()
+    if args.single_scan and args.jobs > 1:
+        parser.error('--single-scan只能单进程运行，不能和-j同时使用')
+    images = ImageCache(max_px=args.image_max_px, quality=args.image_quality, sidecar=args.link_original)
+    emoji = EmojiFetcher(base_url=args.emoji_base_url, assets=AssetCache(offline=args.offline))
+    with LoveSession(images=images, prefetch=args.prefetch, emoji=emoji) as session:
+        love_all(args.conRemark, args.timeStart, args.timeEnd, session, workers=args.jobs,
+                 single_scan=args.single_scan, backend=args.backend)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import os
+from urllib.parse import urlsplit
+
+from wcblob import link_file
+from wcmedia import EMOJI_DIR
+from wcnet import get_asset_cache
+
+
+def emoji_cdn_url(content):
+    """
+    从表情消息的content中取出cdnurl
+
+    :param content:
+    :return: url，没有时返回None
+    """
+    try:
+        url = content.split('cdnurl = "')[1].split('"')[0]
+    except (AttributeError, IndexError):
+        return None
+    url = ':'.join(url.split('*#*'))
+    if 'amp;' in url:
+        url = ''.join(url.split('amp;'))
+    return url or None
+
+
+class EmojiFetcher(object):
+    """
+    表情包下载：通过网络文件缓存（AssetCache）并发下载，再放到emoji文件夹中以md5命名
+    """
+
+    def __init__(self, emoji_dir=EMOJI_DIR, base_url=None, assets=None):
+        """
+        :param emoji_dir: 表情包保存的文件夹
+        :param base_url: 替换cdnurl中的协议和域名，例如'http://127.0.0.1:8000'，为空时直接请求cdnurl
+        :param assets: 网络文件缓存，为空时使用默认设置
+        """
+        self.emoji_dir = emoji_dir
+        self.base_url = base_url
+        self.assets = assets if assets is not None else get_asset_cache()
+
+    def resolve(self, url):
+        """
+        :param url: cdnurl
+        :return: 实际请求的地址
+        """
+        if not url or not self.base_url:
+            return url
+        parts = urlsplit(url)
+        return self.base_url.rstrip('/') + parts.path + ('?' + parts.query if parts.query else '')
+
+    def _place(self, md5, cache_file):
+        os.makedirs(self.emoji_dir, exist_ok=True)
+        emoji_path = self.emoji_dir + '/' + md5
+        link_file(cache_file, emoji_path)
+        return emoji_path
+
+    def fetch(self, md5, url):
+        """
+        下载一个表情包到emoji文件夹
+
+        :param md5: 表情包md5，也是保存的文件名
+        :param url: cdnurl
+        :return: 路径，失败时返回None
+        """
+        cache_file = self.assets.get(self.resolve(url))
+        if cache_file is None:
+            return None
+        return self._place(md5, cache_file)
+
+    def prefetch(self, emojis):
+        """
+        并发下载一批表情包
+
+        :param emojis: {md5: cdnurl}
+        :return: {md5: 路径}，只包含下载成功的
+        """
+        emojis = {md5: self.resolve(url) for md5, url in emojis.items() if url}
+        cache_files = self.assets.prefetch(emojis.values())
+        return {md5: self._place(md5, cache_files[url]) for md5, url in emojis.items() if url in cache_files}
+
+    def save_dead(self):
+        """
+        保存下载失败的地址
+        """
+        self.assets.save_dead()
+
+
+_emoji_fetcher = None
+
+
+def get_emoji_fetcher():
+    """
+    默认设置的表情包下载
+
+    :return: EmojiFetcher
+    """
+    global _emoji_fetcher
+    if _emoji_fetcher is None:
+        _emoji_fetcher = EmojiFetcher()
+    return _emoji_fetcher
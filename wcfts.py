@@ -0,0 +1,211 @@
+import argparse
+import os
+import sqlite3
+from collections import namedtuple
+
+from wcappmsg import parse_appmsg
+from wcconst import TYPE_ANSWER_MSG, TYPE_MSG, love_ms_to_time, love_time_to_ms
+from wcdb import LOVE_BATCH, love_session
+
+# 全文索引保存在单独的数据库中（标准库sqlite3，不改动解密后的数据库），再次建立时只加入新消息
+FTS_DB = 'love_fts.db'
+# 建立索引的消息类型：文字消息和回复消息（只取回复的文字）
+FTS_TYPES = (TYPE_MSG, TYPE_ANSWER_MSG)
+# trigram分词：不满3个字的词不能用MATCH，改为逐行instr
+FTS_MIN_MATCH = 3
+
+'''一条搜索结果：snippet为命中位置附近的内容，命中的词用[]标出'''
+LoveHit = namedtuple('LoveHit', ['msgId', 'talker', 'conRemark', 'theTime', 'isSend', 'snippet'])
+'''一个词的统计：count为出现次数（与str.count一致），msg_count为包含它的消息条数'''
+LovePhrase = namedtuple('LovePhrase', ['phrase', 'count', 'msg_count', 'first', 'last'])
+
+
+def connect_fts(fts_db=FTS_DB):
+    """
+    打开全文索引数据库，没有时建表
+
+    :param fts_db: 索引文件
+    :return: 连接
+    """
+    fts = sqlite3.connect(fts_db)
+    fts.executescript('CREATE TABLE IF NOT EXISTS love_contact (username TEXT PRIMARY KEY, conRemark TEXT, '
+                      'nickname TEXT);'
+                      'CREATE TABLE IF NOT EXISTS love_msg (msgId INTEGER PRIMARY KEY, talker TEXT, '
+                      'createTime INTEGER, isSend INTEGER, type INTEGER);'
+                      'CREATE INDEX IF NOT EXISTS love_msg_talker_createTime ON love_msg (talker, createTime);'
+                      'CREATE VIRTUAL TABLE IF NOT EXISTS love_fts USING fts5(content, tokenize=\'trigram\');')
+    return fts
+
+
+def build_love_fts(session=None, fts_db=FTS_DB, rebuild=False, batch_size=LOVE_BATCH):
+    """
+    建立全文索引：所有联系人的文字和回复消息，以msgId为键，记录talker和createTime。
+    已经建立过时只加入msgId更大的新消息
+
+    :param session: 导出会话，为空时临时打开数据库
+    :param fts_db: 索引文件
+    :param rebuild: 删除已有索引重新建立
+    :param batch_size: 每批写入的行数
+    :return: 新加入的消息条数
+    """
+    if rebuild and os.path.isfile(fts_db):
+        os.remove(fts_db)
+    fts = connect_fts(fts_db)
+    select_love_fts = 'SELECT msg.msgId AS msgId, msg.talker AS talker, msg.createTime AS createTime, ' \
+                      'msg.isSend AS isSend, msg.type AS type, msg.content AS content ' \
+                      'FROM message msg ' \
+                      'WHERE msg.msgId > ? ' \
+                      'AND msg.type IN (?, ?) ' \
+                      'ORDER BY msg.msgId;'
+    select_love_contact = 'SELECT username, conRemark, nickname FROM rcontact;'
+    love_sum = 0
+    try:
+        last_msgId = fts.execute('SELECT MAX(msgId) FROM love_msg;').fetchone()[0] or 0
+        with love_session(session) as session:
+            with fts:
+                fts.executemany('INSERT OR REPLACE INTO love_contact VALUES (?, ?, ?);',
+                                session.query(select_love_contact).fetchall())
+            love_rows = []
+            for love_msg in session.iter_rows(select_love_fts, (last_msgId,) + FTS_TYPES):
+                content = love_msg.content or ''
+                if love_msg.type == TYPE_ANSWER_MSG:
+                    content = parse_appmsg(content).title
+                love_rows.append((love_msg.msgId, love_msg.talker, love_msg.createTime, love_msg.isSend,
+                                  love_msg.type, content))
+                if len(love_rows) >= batch_size:
+                    love_sum += _insert_love_fts(fts, love_rows)
+                    love_rows = []
+            love_sum += _insert_love_fts(fts, love_rows)
+        with fts:
+            fts.execute("INSERT INTO love_fts(love_fts) VALUES ('optimize');")
+    finally:
+        fts.close()
+    return love_sum
+
+
+def _insert_love_fts(fts, love_rows):
+    with fts:
+        fts.executemany('INSERT INTO love_msg VALUES (?, ?, ?, ?, ?);', [row[:5] for row in love_rows])
+        fts.executemany('INSERT INTO love_fts (rowid, content) VALUES (?, ?);',
+                        [(row[0], row[5]) for row in love_rows])
+    return len(love_rows)
+
+
+def _love_where(query, conRemark, timeStart, timeEnd):
+    """
+    把搜索条件拼成WHERE子句：3个字及以上的词用MATCH走索引，短词用instr
+
+    :return: (where, params, 是否用到了MATCH)
+    """
+    terms = query.split() if isinstance(query, str) else list(query)
+    if not terms:
+        raise ValueError('empty query')
+    where = []
+    params = []
+    match = ['"' + term.replace('"', '""') + '"' for term in terms if len(term) >= FTS_MIN_MATCH]
+    if match:
+        where.append('love_fts MATCH ?')
+        params.append(' '.join(match))
+    for term in terms:
+        if len(term) < FTS_MIN_MATCH:
+            where.append('instr(love_fts.content, ?) > 0')
+            params.append(term)
+    if conRemark is not None:
+        where.append('m.talker IN (SELECT username FROM love_contact WHERE conRemark = ?)')
+        params.append(conRemark)
+    if timeStart is not None:
+        where.append('m.createTime >= ?')
+        params.append(love_time_to_ms(timeStart))
+    if timeEnd is not None:
+        where.append('m.createTime < ?')
+        params.append(love_time_to_ms(timeEnd))
+    return ' AND '.join(where), params, bool(match)
+
+
+def search_love(query, conRemark=None, timeStart=None, timeEnd=None, limit=20, fts_db=FTS_DB):
+    """
+    全文搜索：空格分隔的多个词须同时出现，按相关度排序（只有短词时按时间排序）
+
+    :param query: 搜索的词
+    :param conRemark: 备注，为空时搜索所有联系人
+    :param timeStart: 开始时间，'%Y-%m-%d %H:%M:%S'
+    :param timeEnd: 结束时间（不含）
+    :param limit: 最多返回的条数
+    :param fts_db: 索引文件
+    :return: [LoveHit]
+    """
+    where, params, ranked = _love_where(query, conRemark, timeStart, timeEnd)
+    select_love_hit = 'SELECT m.msgId, m.talker, c.conRemark, m.createTime, m.isSend, ' \
+                      'snippet(love_fts, 0, \'[\', \']\', \'…\', 16) ' \
+                      'FROM love_fts JOIN love_msg m ON m.msgId = love_fts.rowid ' \
+                      'LEFT JOIN love_contact c ON c.username = m.talker ' \
+                      'WHERE ' + where + ' ' + \
+                      ('ORDER BY rank ' if ranked else 'ORDER BY m.createTime ') + \
+                      'LIMIT ?;'
+    fts = connect_fts(fts_db)
+    try:
+        love_hits = fts.execute(select_love_hit, params + [limit]).fetchall()
+    finally:
+        fts.close()
+    return [LoveHit(msgId, talker, conRemark, love_ms_to_time(createTime), isSend, snippet)
+            for msgId, talker, conRemark, createTime, isSend, snippet in love_hits]
+
+
+def count_love_phrase(phrase, conRemark=None, timeStart=None, timeEnd=None, fts_db=FTS_DB):
+    """
+    统计一个词出现的次数、包含它的消息条数以及第一次和最后一次出现的时间
+
+    :param phrase: 词
+    :param conRemark: 备注，为空时统计所有联系人
+    :param timeStart: 开始时间
+    :param timeEnd: 结束时间（不含）
+    :param fts_db: 索引文件
+    :return: LovePhrase
+    """
+    where, params = _love_where([phrase], conRemark, timeStart, timeEnd)[:2]
+    '''去掉所有出现后长度的减少量 / 词长 = 不重叠的出现次数，与str.count一致'''
+    select_love_phrase = 'SELECT SUM((length(love_fts.content) - length(replace(love_fts.content, ?, \'\'))) ' \
+                         '/ length(?)), COUNT(*), MIN(m.createTime), MAX(m.createTime) ' \
+                         'FROM love_fts JOIN love_msg m ON m.msgId = love_fts.rowid ' \
+                         'WHERE ' + where + ';'
+    fts = connect_fts(fts_db)
+    try:
+        count, msg_count, first, last = fts.execute(select_love_phrase, [phrase, phrase] + params).fetchone()
+    finally:
+        fts.close()
+    return LovePhrase(phrase, count or 0, msg_count, love_ms_to_time(first) if first is not None else None,
+                      love_ms_to_time(last) if last is not None else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='聊天记录全文索引：建立索引、搜索、统计词语')
+    parser.add_argument('--fts-db', default=FTS_DB, help='索引文件')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='建立或更新索引')
+    build.add_argument('--rebuild', action='store_true', help='删除已有索引重新建立')
+    for name, command_help in (('search', '搜索，空格分隔的多个词须同时出现'), ('count', '统计词语出现的次数和第一次出现的时间')):
+        command = commands.add_parser(name, help=command_help)
+        command.add_argument('query', nargs='+', help='搜索的词')
+        command.add_argument('-r', '--remark', help='联系人备注，不指定时为所有联系人')
+        command.add_argument('--start', help='开始日期，如 2021-01-01')
+        command.add_argument('--end', help='结束日期（不含），如 2022-01-01')
+        if name == 'search':
+            command.add_argument('-n', '--limit', type=int, default=20, help='最多显示的条数')
+    args = parser.parse_args()
+    if args.command == 'build':
+        print(build_love_fts(fts_db=args.fts_db, rebuild=args.rebuild))
+        return
+    timeStart = args.start + ' 00:00:00' if args.start else None
+    timeEnd = args.end + ' 00:00:00' if args.end else None
+    if args.command == 'search':
+        for love_hit in search_love(args.query, args.remark, timeStart, timeEnd, args.limit, args.fts_db):
+            print(love_hit.theTime, love_hit.conRemark or love_hit.talker, '我' if love_hit.isSend else '对方',
+                  love_hit.snippet)
+    else:
+        for phrase in args.query:
+            love_phrase = count_love_phrase(phrase, args.remark, timeStart, timeEnd, args.fts_db)
+            print(love_phrase.phrase, love_phrase.count, love_phrase.msg_count, love_phrase.first, love_phrase.last)
+
+
+if __name__ == '__main__':
+    main()
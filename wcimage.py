@@ -0,0 +1,89 @@
+import hashlib
+import os
+import threading
+
+from PIL import Image, ImageOps
+
+# 缩小后的图片保存的文件夹，文件名为原图内容的md5，重新导出和重复的图片直接使用
+IMAGE_CACHE_DIR = 'image_cache'
+# 文档中的图片高2英寸，长边800像素已足够清晰
+IMAGE_MAX_PX = 800
+IMAGE_QUALITY = 85
+
+
+class ImageCache(object):
+    """
+    插入文档前的图片处理：把过大的图片缩小为长边不超过max_px的JPEG（有透明通道时为PNG），
+    按原图内容的md5缓存在磁盘上。小图和动图直接使用原图
+    """
+
+    def __init__(self, cache_dir=IMAGE_CACHE_DIR, max_px=IMAGE_MAX_PX, quality=IMAGE_QUALITY, sidecar=False):
+        """
+        :param cache_dir: 缓存文件夹
+        :param max_px: 长边的最大像素，为None时不缩小
+        :param quality: JPEG质量
+        :param sidecar: 是否把原图复制到文档旁的image_love文件夹，并在图片下方链接原图
+        """
+        self.cache_dir = cache_dir
+        self.max_px = max_px
+        self.quality = quality
+        self.sidecar = sidecar
+
+    def _cache_file(self, md5, ext):
+        return os.path.join(self.cache_dir, md5[:2], '{}_{}_{}.{}'.format(md5, self.max_px, self.quality, ext))
+
+    def prepare(self, image_file):
+        """
+        获取插入文档用的图片
+
+        :param image_file: 原图路径
+        :return: 缩小后的图片路径；不需要缩小或无法识别时返回原图路径
+        """
+        if not self.max_px:
+            return image_file
+        with open(image_file, 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        for ext in ('jpg', 'png'):
+            cache_file = self._cache_file(md5, ext)
+            if os.path.isfile(cache_file):
+                return cache_file
+        try:
+            with Image.open(image_file) as img:
+                if max(img.size) <= self.max_px or getattr(img, 'is_animated', False):
+                    return image_file
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((self.max_px, self.max_px))
+                if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+                    cache_file = self._cache_file(md5, 'png')
+                    kwargs = {'format': 'PNG', 'optimize': True}
+                else:
+                    img = img.convert('RGB')
+                    cache_file = self._cache_file(md5, 'jpg')
+                    kwargs = {'format': 'JPEG', 'quality': self.quality, 'optimize': True}
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                '''先写临时文件再改名，并行导出时不会读到写了一半的文件'''
+                tmp_file = '{}.{}.{}'.format(cache_file, os.getpid(), threading.get_ident())
+                try:
+                    img.save(tmp_file, **kwargs)
+                    os.replace(tmp_file, cache_file)
+                finally:
+                    if os.path.isfile(tmp_file):
+                        os.remove(tmp_file)
+                return cache_file
+        except Exception:
+            return image_file
+
+
+_image_cache = None
+
+
+def get_image_cache():
+    """
+    默认设置的图片缓存
+
+    :return: ImageCache
+    """
+    global _image_cache
+    if _image_cache is None:
+        _image_cache = ImageCache()
+    return _image_cache
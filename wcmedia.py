@@ -0,0 +1,193 @@
+import os
+import re
+
+from wechat_dump.wechat.common.dirindex import DirIndex
+
+# 需要建立索引的媒体文件夹
+AVATAR_DIR = 'avatar'
+IMAGE_DIR = 'image2'
+EMOJI_DIR = 'emoji'
+VIDEO_DIR = 'video'
+VOICE_DIR = 'voice2'
+DOWNLOAD_DIR = 'Download'
+MEDIA_DIRS = (AVATAR_DIR, IMAGE_DIR, EMOJI_DIR, VIDEO_DIR, VOICE_DIR, DOWNLOAD_DIR)
+# 保存文件列表和文件夹修改时间的SQLite文件，再次运行时只重新扫描有变化的文件夹
+MEDIA_INDEX_FILE = 'media_index.db'
+
+MD5_RE = re.compile(r'[0-9a-f]{32}')
+
+
+class MediaIndex(object):
+    """
+    媒体文件索引：启动时把avatar/image2/emoji/video/voice2/Download各扫描一次，
+    之后按md5或imgPath直接查字典，不再对每条消息调用os.walk。
+    文件列表保存在media_index.db中，再次运行时只重新扫描修改时间变化的文件夹
+    """
+
+    def __init__(self, root='.', cache_file=MEDIA_INDEX_FILE):
+        """
+        :param root: 媒体文件夹所在目录
+        :param cache_file: 索引文件（相对root），为None时不保存
+        """
+        self.root = root
+        if cache_file is not None:
+            cache_file = os.path.join(root, cache_file)
+        self.listing = {name: DirIndex(os.path.join(root, name), cache_file).listing() for name in MEDIA_DIRS}
+        self._build()
+
+    def _build(self):
+        """
+        根据文件列表建立查找用的字典
+        """
+        '''头像/图片/表情包的文件名里都带有md5，以md5为键'''
+        self._md5 = {}
+        for name in (AVATAR_DIR, IMAGE_DIR, EMOJI_DIR):
+            index = {}
+            for rel, files in self.listing[name].items():
+                for file in files:
+                    for key in set(MD5_RE.findall(file)):
+                        index.setdefault(key, []).append((rel, file))
+            self._md5[name] = index
+        '''视频文件以imgPath命名：<imgPath>.jpg为封面，<imgPath>.mp4为视频'''
+        self._video = {}
+        for rel, files in self.listing[VIDEO_DIR].items():
+            if rel:
+                continue
+            for file in files:
+                self._video.setdefault(file.split('.')[0], []).append(file)
+        '''语音文件为 voice2/xx/yy/msg_<imgPath>.amr'''
+        self._voice = {}
+        for rel, files in self.listing[VOICE_DIR].items():
+            for file in files:
+                if file.startswith('msg_') and file.endswith('.amr'):
+                    self._voice[file[4:-4]] = rel + '/' + file
+        self._download = set(self.listing[DOWNLOAD_DIR].get('', []))
+
+    def _path(self, name, rel, file):
+        return '/'.join(k for k in (self.root, name, rel, file) if k)
+
+    def _candidates(self, name, key, rel=None):
+        """
+        查找文件名包含key的文件；key不是md5时退回到在对应文件夹内逐个比较
+
+        :param name: 媒体文件夹名
+        :param key:
+        :param rel: 只在该子文件夹中查找
+        :return: [(相对路径, 文件名)]
+        """
+        if MD5_RE.fullmatch(key):
+            cands = self._md5[name].get(key, [])
+            return [k for k in cands if rel is None or k[0] == rel]
+        dirs = [rel] if rel is not None else self.listing[name].keys()
+        return [(d, file) for d in dirs for file in self.listing[name].get(d, []) if key in file]
+
+    def avatar(self, wxid_md5):
+        """
+        获取头像文件路径
+
+        :param wxid_md5: wxid的md5
+        :return: 路径，找不到时返回None
+        """
+        rel = wxid_md5[:2] + '/' + wxid_md5[2:4]
+        for d, file in self._candidates(AVATAR_DIR, wxid_md5, rel):
+            return self._path(AVATAR_DIR, d, file)
+        return None
+
+    def image(self, imgPath, isSend):
+        """
+        获取聊天图片路径：自己发送的优先使用hd大图，跳过_hevc和jpg文件
+
+        :param imgPath: 去掉th_前缀后的imgPath
+        :param isSend:
+        :return: 路径，找不到时返回None
+        """
+        rel = imgPath[:2] + '/' + imgPath[2:4]
+        cands = self._candidates(IMAGE_DIR, imgPath, rel)
+        if isSend:
+            for d, file in cands:
+                if imgPath + 'hd' in file and '_hevc' not in file:
+                    return self._path(IMAGE_DIR, d, file)
+        for d, file in cands:
+            if '_hevc' in file or 'jpg' in file:
+                continue
+            return self._path(IMAGE_DIR, d, file)
+        return None
+
+    def emoji(self, md5):
+        """
+        获取表情包路径：优先使用_cover文件
+
+        :param md5:
+        :return: 路径，找不到时返回None
+        """
+        cands = self._candidates(EMOJI_DIR, md5)
+        for d, file in cands:
+            if md5 + '_cover' in file:
+                return self._path(EMOJI_DIR, d, file)
+        for d, file in cands:
+            return self._path(EMOJI_DIR, d, file)
+        return None
+
+    def add_emoji(self, file):
+        """
+        把新下载的表情包加入索引
+
+        :param file: emoji文件夹下的文件名
+        """
+        self.listing[EMOJI_DIR][''] = self.listing[EMOJI_DIR].get('', ()) + (file,)
+        for key in set(MD5_RE.findall(file)):
+            self._md5[EMOJI_DIR].setdefault(key, []).append(('', file))
+
+    def video(self, imgPath):
+        """
+        获取视频封面和视频文件路径
+
+        :param imgPath:
+        :return: (封面路径, 视频路径)，找不到的为None
+        """
+        love_image = love_video = None
+        for file in self._video.get(imgPath, []):
+            if '.jpg' in file:
+                love_image = self._path(VIDEO_DIR, '', file)
+            if '.mp4' in file:
+                love_video = self._path(VIDEO_DIR, '', file)
+        return love_image, love_video
+
+    def voice(self, imgPath):
+        """
+        获取语音文件路径
+
+        :param imgPath:
+        :return: 路径，找不到时返回None
+        """
+        rel = self._voice.get(imgPath)
+        if rel is None:
+            return None
+        return self._path(VOICE_DIR, '', rel)
+
+    def download(self, filename):
+        """
+        获取Download文件夹中的文件路径
+
+        :param filename:
+        :return: 路径，找不到时返回None
+        """
+        if filename not in self._download:
+            return None
+        return self._path(DOWNLOAD_DIR, '', filename)
+
+
+_media_index = {}
+
+
+def get_media_index(root='.'):
+    """
+    获取媒体文件索引，同一个目录在一个进程中只扫描一次
+
+    :param root: 媒体文件夹所在目录
+    :return: MediaIndex
+    """
+    root = os.path.abspath(root)
+    if root not in _media_index:
+        _media_index[root] = MediaIndex(root)
+    return _media_index[root]
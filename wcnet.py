@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 下载的网络图片（表情包、被回复的表情、名片图标）保存的文件夹，文件名为url的sha1，每个地址只下载一次
+NET_CACHE_DIR = 'net_cache'
+# 同时下载的文件数
+NET_WORKERS = 8
+# (连接超时, 读取超时)，单位秒
+NET_TIMEOUT = (5, 20)
+NET_RETRIES = 2
+# 地址本身有问题（4xx、空文件）时记录在这个文件中，DEAD_TTL秒内再次运行时不再重试；超时、连接失败和5xx不记录
+NET_DEAD_FILE = 'net_dead.json'
+NET_DEAD_TTL = 7 * 24 * 3600
+
+
+class AssetCache(object):
+    """
+    网络文件缓存：按url的sha1保存在磁盘上，多次引用、重新导出都只下载一次。
+    连接池复用连接，限制并发数，带超时和重试；失败的地址记录在net_dead.json中，一段时间内不再重复请求。
+    离线模式下只使用已缓存的文件
+    """
+
+    def __init__(self, cache_dir=NET_CACHE_DIR, offline=False, workers=NET_WORKERS, timeout=NET_TIMEOUT,
+                 retries=NET_RETRIES, dead_file=NET_DEAD_FILE, dead_ttl=NET_DEAD_TTL):
+        """
+        :param cache_dir: 缓存文件夹
+        :param offline: 离线模式，不发出任何请求
+        :param workers: 同时下载的文件数
+        :param timeout: 超时，(连接超时, 读取超时)
+        :param retries: 连接失败或服务器错误时的重试次数
+        :param dead_file: 记录失败地址的文件，为None时不保存
+        :param dead_ttl: 失败地址多少秒后可以重试
+        """
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.dead_file = dead_file
+        self.dead_ttl = dead_ttl
+        self._http = None
+        self._dead = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        '''并行导出时传给子进程：连接池和锁不能跨进程，到子进程中重新创建'''
+        state = self.__dict__.copy()
+        state['_http'] = None
+        state['_dead'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def http(self):
+        """
+        共用的requests.Session，连接池大小与并发数一致
+        """
+        if self._http is None:
+            retry = Retry(total=self.retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers, max_retries=retry)
+            self._http = requests.Session()
+            self._http.mount('http://', adapter)
+            self._http.mount('https://', adapter)
+        return self._http
+
+    @property
+    def dead(self):
+        """
+        {url: 失败时间}，第一次使用时从dead_file读取（去掉已过期的）；修改时要持有_lock
+        """
+        if self._dead is None:
+            '''预读线程可能同时第一次用到，加锁只读取一次，不会互相覆盖刚记下的失败地址'''
+            with self._lock:
+                if self._dead is None:
+                    self._dead = self._load_dead()
+        return self._dead
+
+    def _load_dead(self):
+        dead = {}
+        if self.dead_file and os.path.isfile(self.dead_file):
+            try:
+                with open(self.dead_file, encoding='utf-8') as f:
+                    dead = json.load(f)
+            except ValueError:
+                pass
+        self._prune_dead(dead)
+        return dead
+
+    def _prune_dead(self, dead):
+        '''过期的地址可以重试，从记录中删掉，net_dead.json不会越来越大'''
+        now = time.time()
+        for url in [url for url, failed_at in dead.items() if now - failed_at >= self.dead_ttl]:
+            del dead[url]
+
+    def _mark_dead(self, url):
+        dead = self.dead
+        with self._lock:
+            dead[url] = time.time()
+
+    def is_dead(self, url):
+        """
+        :param url:
+        :return: 该地址最近是否下载失败过
+        """
+        failed_at = self.dead.get(url)
+        return failed_at is not None and time.time() - failed_at < self.dead_ttl
+
+    def save_dead(self):
+        """
+        保存失败地址
+        """
+        if not self.dead_file or self._dead is None:
+            return
+        with self._lock:
+            self._prune_dead(self._dead)
+            tmp_file = self.dead_file + '.' + str(os.getpid())
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self._dead, f)
+            os.replace(tmp_file, self.dead_file)
+
+    def cache_file(self, url):
+        """
+        :param url:
+        :return: url对应的缓存路径（不一定存在）
+        """
+        sha1 = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, sha1[:2], sha1)
+
+    def get(self, url):
+        """
+        获取网络文件：已缓存时直接返回，否则下载到缓存中
+
+        :param url:
+        :return: 缓存路径，失败或离线时没有缓存返回None
+        """
+        if not url:
+            return None
+        cache_file = self.cache_file(url)
+        if os.path.isfile(cache_file):
+            return cache_file
+        if self.offline or self.is_dead(url):
+            return None
+        try:
+            resp = self.http.get(url, timeout=self.timeout)
+        except (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+                requests.exceptions.InvalidSchema):
+            self._mark_dead(url)
+            return None
+        except requests.RequestException:
+            '''超时、连接失败等可能只是这次网络不好，不记为失败地址，下次运行再试'''
+            return None
+        '''只有4xx和空文件是地址本身的问题；5xx在重试后仍失败也只跳过这一次'''
+        if 400 <= resp.status_code < 500 or (resp.ok and not resp.content):
+            self._mark_dead(url)
+            return None
+        if not resp.ok:
+            return None
+        '''先写临时文件再改名，并行导出时不会读到下载了一半的文件'''
+        tmp_file = '{}.{}.{}'.format(cache_file, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(tmp_file, 'wb') as f:
+                f.write(resp.content)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            return None
+        finally:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+        dead = self.dead
+        if url in dead:
+            with self._lock:
+                dead.pop(url, None)
+        return cache_file
+
+    def prefetch(self, urls):
+        """
+        并发下载一批网络文件
+
+        :param urls: url列表
+        :return: {url: 缓存路径}，只包含成功的
+        """
+        urls = list(dict.fromkeys(url for url in urls if url))
+        if not urls:
+            return {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            paths = list(pool.map(self.get, urls))
+        self.save_dead()
+        return {url: path for url, path in zip(urls, paths) if path is not None}
+
+
+_asset_cache = None
+
+
+def get_asset_cache():
+    """
+    默认设置的网络文件缓存
+
+    :return: AssetCache
+    """
+    global _asset_cache
+    if _asset_cache is None:
+        _asset_cache = AssetCache()
+    return _asset_cache
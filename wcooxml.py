@@ -0,0 +1,500 @@
+import io
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+import docx
+from docx.image.image import Image
+from docx.oxml.ns import qn
+from docx.shared import Inches
+
+from wcappmsg import parse_appmsg
+from wcblob import get_blob_store
+from wcdb import (LoveDocxWriter, MSG_MAX, TYPE_ANSWER_MSG, TYPE_APP_MSG, TYPE_BIG_EMOJI, TYPE_CUSTOM_EMOJI,
+                  TYPE_FILE, TYPE_IMG, TYPE_LINK, TYPE_LUCKY_MONEY, TYPE_MONEY_TRANSFER, TYPE_MSG, TYPE_NAME_CARD,
+                  TYPE_SHOT, TYPE_SPEAK, TYPE_SYSTEM, TYPE_VIDEO_FILE, TYPE_VOIP, TYPE_WITHDRAW_MSG, add_love_styles,
+                  get_assets, get_avatar_blob, get_emoji_path, get_media, get_sender_wxid,
+                  luck_money_text, money_transfer_text, namecard_info, read_display_image, reply_text, shot_text,
+                  system_text, voip_text)
+
+'''直接生成WordprocessingML：每条消息拼成一段XML字符串写入临时文件，图片边读边写入zip，
+最后把正文拷贝到word/document.xml。版式与python-docx导出的文档一致'''
+
+RT_IMAGE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image'
+RT_HYPERLINK = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink'
+
+# XML 1.0 不允许出现的字符
+INVALID_XML_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+BREAK_RE = re.compile(r'(\t|\r\n|\n|\r)')
+
+# 头像0.5英寸，聊天图片高2英寸
+AVATAR_WIDTH = Inches(0.5)
+PICTURE_HEIGHT = Inches(2)
+
+LOVE_TABLE = '<w:tbl><w:tblPr><w:tblW w:type="auto" w:w="0"/>{jc}<w:tblLook w:firstColumn="1" w:firstRow="1" ' \
+             'w:lastColumn="0" w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr>' \
+             '<w:tblGrid><w:gridCol w:w="4320"/><w:gridCol w:w="4320"/></w:tblGrid><w:tr>{cells}</w:tr></w:tbl>'
+AVATAR_CELL = '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="720"/></w:tcPr>' \
+              '<w:p><w:pPr><w:spacing w:before="0" w:after="0"/></w:pPr><w:r>{drawing}</w:r></w:p></w:tc>'
+CONTENT_CELL = '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="4320"/><w:vAlign w:val="center"/></w:tcPr>{paragraphs}</w:tc>'
+LOVE_DRAWING = '<w:drawing><wp:inline xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" ' \
+               'xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture">' \
+               '<wp:extent cx="{cx}" cy="{cy}"/><wp:docPr id="{id}" name="Picture {id}"/>' \
+               '<wp:cNvGraphicFramePr><a:graphicFrameLocks noChangeAspect="1"/></wp:cNvGraphicFramePr>' \
+               '<a:graphic><a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">' \
+               '<pic:pic><pic:nvPicPr><pic:cNvPr id="0" name={name}/><pic:cNvPicPr/></pic:nvPicPr>' \
+               '<pic:blipFill><a:blip r:embed="{rId}"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>' \
+               '<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>' \
+               '<a:prstGeom prst="rect"/></pic:spPr></pic:pic></a:graphicData></a:graphic></wp:inline></w:drawing>'
+
+_love_template = None
+
+
+def love_template():
+    """
+    python-docx默认模板（已设置好正文字体和聊天记录的样式），除正文外的各部分原样写入生成的文档
+
+    :return: {部件名: 内容}
+    """
+    global _love_template
+    if _love_template is None:
+        doc_love = docx.Document()
+        doc_love.styles['Normal'].font.name = 'Times New Roman'
+        doc_love.styles['Normal']._element.rPr.rFonts.set(qn('w:eastAsia'), u'楷体')
+        add_love_styles(doc_love)
+        love_file = io.BytesIO()
+        doc_love.save(love_file)
+        with zipfile.ZipFile(love_file) as love_zip:
+            _love_template = {name: love_zip.read(name) for name in love_zip.namelist()}
+    return _love_template
+
+
+def love_text(text):
+    """
+    把文字转换为run中的内容：换行变为<w:br/>，去掉XML不允许的字符
+
+    :param text:
+    :return: xml
+    """
+    parts = []
+    for piece in BREAK_RE.split(INVALID_XML_RE.sub('', text)):
+        if piece == '\t':
+            parts.append('<w:tab/>')
+        elif piece in ('\r\n', '\n', '\r'):
+            parts.append('<w:br/>')
+        elif piece:
+            parts.append('<w:t xml:space="preserve">' + escape(piece) + '</w:t>')
+    return ''.join(parts)
+
+
+def love_run(text='', style=None, color=None, bold=False, hyperlink=False, drawing=''):
+    """
+    生成一个run
+
+    :param text:
+    :param style: 字符样式id
+    :param color: RGB颜色，如'797979'
+    :param bold: 加粗
+    :param hyperlink: 超链接格式
+    :param drawing: 跟在文字后面的图片
+    :return: xml
+    """
+    rPr = []
+    if style:
+        rPr.append('<w:rStyle w:val="' + style + '"/>')
+    if bold:
+        rPr.append('<w:b/>')
+    if hyperlink:
+        rPr.append('<w:color w:val="000000" w:themeColor="hyperlink"/><w:u w:val="single"/>')
+    elif color:
+        rPr.append('<w:color w:val="' + color + '"/>')
+    rPr = '<w:rPr>' + ''.join(rPr) + '</w:rPr>' if rPr else ''
+    return '<w:r>' + rPr + love_text(text) + drawing + '</w:r>'
+
+
+def love_paragraph(runs='', style=None, align=None, before=None, after=None):
+    """
+    生成一个段落
+
+    :param runs:
+    :param style: 段落样式id
+    :param align: 对齐方式：right/center
+    :param before: 段前间距（twip）
+    :param after: 段后间距（twip）
+    :return: xml
+    """
+    pPr = []
+    if style:
+        pPr.append('<w:pStyle w:val="' + style + '"/>')
+    if before is not None or after is not None:
+        pPr.append('<w:spacing' + (' w:before="{}"'.format(before) if before is not None else '') +
+                   (' w:after="{}"'.format(after) if after is not None else '') + '/>')
+    if align:
+        pPr.append('<w:jc w:val="' + align + '"/>')
+    pPr = '<w:pPr>' + ''.join(pPr) + '</w:pPr>' if pPr else ''
+    return '<w:p>' + pPr + runs + '</w:p>'
+
+
+def love_bubble(runs='', right=False):
+    """
+    聊天内容的段落
+
+    :param runs:
+    :param right: 是否右对齐
+    :return: xml
+    """
+    return love_paragraph(runs, 'BubbleTextRight' if right else 'BubbleText')
+
+
+def love_expired(text, isSend):
+    """
+    文件已过期时的灰色删除线提示
+
+    :param text:
+    :param isSend:
+    :return: xml
+    """
+    return love_bubble(love_run(text, 'Expired'), isSend)
+
+
+class OoxmlLoveWriter(LoveDocxWriter):
+    """
+    流式生成docx：正文逐条写入临时文件，内存占用和消息数量无关，比python-docx逐个建立对象快得多
+    """
+
+    def open(self):
+        """
+        新建文档：打开zip和保存正文的临时文件
+        """
+        self.part_file = self.filename + '.part'
+        self.love_zip = zipfile.ZipFile(self.part_file, 'w', zipfile.ZIP_DEFLATED)
+        self.body = tempfile.TemporaryFile()
+        self.rels = []
+        self.hyperlinks = {}
+        self.images = {}
+        self.image_exts = {}
+        self.avatars = {}
+        self.docPr_id = 0
+        '''模板中已有的关系之后接着编号'''
+        self.rel_start = love_template()['word/_rels/document.xml.rels'].count(b'<Relationship ') + 1
+
+    def _rel(self, reltype, target, external=False):
+        """
+        添加一个关系
+
+        :param reltype:
+        :param target:
+        :param external:
+        :return: rId
+        """
+        rId = 'rId' + str(len(self.rels) + self.rel_start)
+        self.rels.append((rId, reltype, target, external))
+        return rId
+
+    def image(self, blob):
+        """
+        添加图片：相同内容的图片只保存一份
+
+        :param blob: 图片内容
+        :return: rId, docx.image.image.Image
+        """
+        image = Image.from_blob(blob)
+        if image.sha1 not in self.images:
+            partname = 'media/image' + str(len(self.images) + 1) + '.' + image.ext
+            self.love_zip.writestr('word/' + partname, blob)
+            self.images[image.sha1] = self._rel(RT_IMAGE, partname)
+            self.image_exts[image.ext] = image.content_type
+        return self.images[image.sha1], image
+
+    def drawing(self, rId, name, cx, cy):
+        """
+        :return: <w:drawing> xml
+        """
+        self.docPr_id += 1
+        return LOVE_DRAWING.format(cx=int(cx), cy=int(cy), id=self.docPr_id, rId=rId, name=quoteattr(name))
+
+    def picture(self, image_file, width=None, height=None, blob=None):
+        """
+        插入图片
+
+        :param image_file: 图片路径
+        :param width:
+        :param height:
+        :param blob: 已读取的图片内容，为空时读取image_file
+        :return: <w:drawing> xml
+        """
+        if blob is None:
+            with open(image_file, 'rb') as f:
+                blob = f.read()
+        rId, image = self.image(blob)
+        cx, cy = image.scaled_dimensions(width, height)
+        return self.drawing(rId, os.path.basename(image_file), cx, cy)
+
+    def display_picture(self, image_file):
+        """
+        插入聊天图片：高2英寸，使用缩小（或预读好）的图片
+
+        :param image_file: 原图路径
+        :return: <w:drawing> xml
+        """
+        return self.picture(image_file, height=PICTURE_HEIGHT, blob=read_display_image(image_file, self.session))
+
+    def hyperlink(self, text, url):
+        """
+        超链接
+
+        :param text:
+        :param url:
+        :return: xml
+        """
+        if url not in self.hyperlinks:
+            self.hyperlinks[url] = self._rel(RT_HYPERLINK, url, True)
+        return '<w:hyperlink r:id="' + self.hyperlinks[url] + '">' + love_run(text, hyperlink=True) + \
+               '</w:hyperlink>'
+
+    def avatar(self, wxid):
+        """
+        头像图片：每个wxid只添加一次，之后直接引用已有的关系
+
+        :param wxid:
+        :return: <w:drawing> xml
+        """
+        if wxid not in self.avatars:
+            rId, image = self.image(get_avatar_blob(wxid, self.session))
+            self.avatars[wxid] = rId, image.filename, image.scaled_dimensions(AVATAR_WIDTH, None)
+        rId, name, (cx, cy) = self.avatars[wxid]
+        return self.drawing(rId, name, cx, cy)
+
+    def add_xml(self, xml):
+        self.body.write(xml.encode('utf-8'))
+
+    def add_table(self, isSend, person, paragraphs, wxid=None):
+        """
+        1*2表格：isSend = 1 左边聊天内容，右边头像；isSend = 0 左边头像，右边聊天内容
+
+        :param isSend:
+        :param person:
+        :param paragraphs: 聊天内容的段落
+        :param wxid: 发送者的wxid，群聊时传入发言的群成员；为空时按isSend和备注查找
+        """
+        if wxid is None:
+            wxid = get_sender_wxid(isSend, person, self.session)
+        avatar = AVATAR_CELL.format(drawing=self.avatar(wxid))
+        content = CONTENT_CELL.format(paragraphs=''.join(paragraphs) or '<w:p/>')
+        if isSend:
+            self.add_xml(LOVE_TABLE.format(jc='<w:jc w:val="right"/>', cells=content + avatar))
+        else:
+            self.add_xml(LOVE_TABLE.format(jc='', cells=avatar + content))
+
+    def add_time(self, love_time):
+        self.add_xml(love_paragraph(love_run(love_time), 'TimeStamp'))
+
+    def add_spacing(self):
+        self.add_xml(love_paragraph(before=100, after=100))
+
+    def add_notice(self, text):
+        """
+        居中的灰色提示：撤回/系统消息
+        """
+        self.add_xml(love_paragraph(love_run(text), 'SystemNotice'))
+
+    def add_msg(self, love_msg):
+        isSend, person, message, msgId = love_msg.isSend, love_msg.person, love_msg.message, love_msg.msgId
+        if love_msg.type == TYPE_MSG:
+            if love_msg.status == 5:
+                message += '（未发出） '
+            '''当且仅当是自己发送的且发送的字符较短时：右对齐'''
+            self.add_table(isSend, person, [love_bubble(love_run(message), len(message) < MSG_MAX and isSend)])
+        elif love_msg.type == TYPE_IMG:
+            imgPath = love_msg.imgPath.split('//th_')[-1]
+            img_file = get_media(self.session).image(imgPath, isSend)
+            try:
+                if img_file is None:
+                    raise FileNotFoundError(imgPath)
+                runs = love_run(drawing=self.display_picture(img_file))
+                if self.image_love_dic is not None:
+                    love_image = os.path.basename(img_file)
+                    get_blob_store().link(img_file, self.image_love_dic + '/' + love_image)
+                    runs += self.hyperlink('\n查看原图', 'image_love/' + love_image)
+                paragraph = love_bubble(runs, isSend)
+            except Exception:
+                paragraph = love_expired('您的图片已过期或被错误删除', isSend)
+            self.add_table(isSend, person, [paragraph])
+        elif love_msg.type in (TYPE_BIG_EMOJI, TYPE_CUSTOM_EMOJI):
+            imgPath = love_msg.imgPath
+            if love_msg.type == TYPE_CUSTOM_EMOJI:
+                if 'emoticonmd5' not in message:
+                    print('Custom emoji deal wrong')
+                    return
+                imgPath = parse_appmsg(message, msgId).emoticonmd5
+            ret, emoji_path = get_emoji_path(message, imgPath, self.session)
+            if not ret:
+                paragraph = love_expired('不能正确找到表情', isSend)
+            else:
+                try:
+                    paragraph = love_bubble(love_run(drawing=self.display_picture(emoji_path)), isSend)
+                except Exception:
+                    paragraph = love_expired('不能正确打开表情', isSend)
+            self.add_table(isSend, person, [paragraph])
+        elif love_msg.type == TYPE_SPEAK:
+            voice_file = get_media(self.session).voice(love_msg.imgPath)
+            voice_name = 'msg_' + love_msg.imgPath
+            try:
+                if voice_file is None:
+                    raise FileNotFoundError(love_msg.imgPath)
+                self.voices.append((voice_file, voice_name))
+                paragraph = love_bubble(self.hyperlink(person + '的语音', 'voice_love/' + voice_name + '.mp3'), isSend)
+            except Exception:
+                paragraph = love_expired('您的语音已过期或被错误删除', isSend)
+            self.add_table(isSend, person, [paragraph])
+        elif love_msg.type == TYPE_ANSWER_MSG:
+            self.add_reply(isSend, person, message, msgId)
+        elif love_msg.type in (TYPE_WITHDRAW_MSG, TYPE_SYSTEM):
+            if love_msg.type == TYPE_SYSTEM:
+                message = system_text(person, message)
+            self.add_notice(message)
+        elif love_msg.type == TYPE_NAME_CARD:
+            nickname, love_images = namecard_info(message, self.session, msgId)
+            for love_image in love_images:
+                try:
+                    runs = love_run(drawing=self.picture(love_image, height=PICTURE_HEIGHT))
+                    break
+                except Exception:
+                    continue
+            else:
+                runs = love_run('[图片]')
+            self.add_table(isSend, person, [love_bubble(runs, isSend), love_bubble(love_run('分享卡片'), isSend),
+                                            love_bubble(love_run(nickname), isSend)])
+        elif love_msg.type in (TYPE_VOIP, TYPE_MONEY_TRANSFER, TYPE_LUCKY_MONEY, TYPE_APP_MSG):
+            if love_msg.type == TYPE_VOIP:
+                text = voip_text(love_msg.buffer)
+            elif love_msg.type == TYPE_MONEY_TRANSFER:
+                text = money_transfer_text(message, msgId)
+            elif love_msg.type == TYPE_LUCKY_MONEY:
+                text = luck_money_text(message, msgId)
+            else:
+                appmsg = parse_appmsg(message, msgId)
+                text = appmsg.title + appmsg.des
+            self.add_table(isSend, person, [love_bubble(love_run(text), isSend)])
+        elif love_msg.type == TYPE_FILE:
+            love_filename = parse_appmsg(message, msgId).title
+            download_file = get_media(self.session).download(love_filename)
+            try:
+                if download_file is None:
+                    raise FileNotFoundError(love_filename)
+                get_blob_store().link(download_file, self.file_love_dic + '/' + love_filename)
+                paragraph = love_bubble(self.hyperlink(love_filename, 'file_love/' + love_filename), isSend)
+            except Exception:
+                paragraph = love_expired(love_filename + '\n(您的文件已过期或被错误删除)', isSend)
+            self.add_table(isSend, person, [paragraph])
+        elif love_msg.type == TYPE_SHOT:
+            self.add_xml(love_paragraph(love_run(shot_text(person, message, msgId), color='797979', bold=True), align='center',
+                                        before=0, after=0))
+        elif love_msg.type == TYPE_VIDEO_FILE:
+            self.add_video(isSend, person, love_msg.imgPath)
+        elif love_msg.type == TYPE_LINK:
+            self.add_link(isSend, person, message, msgId)
+        else:
+            self.log('wrong')
+            self.log(love_msg.theTime + ' ' + person + ' ' + message + ' ' + str(love_msg.type))
+
+    def add_reply(self, isSend, person, message, msgId=None):
+        """
+        回复信息：回复内容 + 灰色的被回复内容
+        """
+        answer_love, name_love, last_love, love_url = reply_text(message, msgId)
+        paragraphs = [love_bubble(love_run(answer_love), len(answer_love) < MSG_MAX and isSend)]
+        if love_url is not None:
+            try:
+                drawing = self.picture(get_assets(self.session).get('http://' + love_url), height=PICTURE_HEIGHT)
+                paragraphs.append(love_bubble(love_run(name_love + ':', 'QuoteText', drawing=drawing), isSend))
+                self.add_table(isSend, person, paragraphs)
+                return
+            except Exception:
+                last_love = '[动画表情]'
+        quote = name_love + ':' + last_love
+        paragraphs.append(love_bubble(love_run(quote, 'QuoteText'), len(quote) < MSG_MAX and isSend))
+        self.add_table(isSend, person, paragraphs)
+
+    def add_video(self, isSend, person, imgPath):
+        """
+        视频：封面图 + 播放视频的超链接
+        """
+        love_image, video_file = get_media(self.session).video(imgPath)
+        runs = ''
+        try:
+            if love_image is None:
+                raise FileNotFoundError(imgPath)
+            runs += love_run(drawing=self.display_picture(love_image))
+            if video_file is None:
+                raise FileNotFoundError(imgPath)
+            love_video = os.path.basename(video_file)
+            get_blob_store().link(video_file, self.video_love_dic + '/' + love_video)
+            runs += self.hyperlink('\n播放视频', 'video_love/' + love_video)
+        except Exception:
+            runs += love_run('您的视频已过期或被错误删除', 'Expired')
+        self.add_table(isSend, person, [love_bubble(runs, isSend)])
+
+    def add_link(self, isSend, person, message, msgId=None):
+        """
+        微信分享：聊天记录/网络文件/外部链接
+        """
+        appmsg = parse_appmsg(message, msgId)
+        url_love = appmsg.url
+        title_love = appmsg.title.split(' null')[0]
+        if '聊天记录' in title_love:
+            paragraphs = [love_paragraph(love_run(title_love), 'BubbleText', after=100),
+                          love_bubble(love_run(appmsg.des))]
+        elif not url_love:
+            if appmsg.des != '':
+                line_love = title_love + '(' + appmsg.des + ')'
+            else:
+                line_love = title_love
+            try:
+                download_file = get_media(self.session).download(title_love)
+                if download_file is None:
+                    raise FileNotFoundError(title_love)
+                get_blob_store().link(download_file, self.file_love_dic + '/' + title_love)
+                paragraphs = [love_bubble(self.hyperlink(line_love, 'file_love/' + title_love), isSend)]
+            except Exception:
+                paragraphs = [love_bubble(love_run(line_love), isSend)]
+        else:
+            paragraphs = [love_bubble(self.hyperlink(title_love, url_love), isSend)]
+        self.add_table(isSend, person, paragraphs)
+
+    def save(self):
+        """
+        写入正文、关系和内容类型，完成后替换为正式文件名
+        """
+        template = love_template()
+        for name, blob in template.items():
+            if name not in ('[Content_Types].xml', 'word/document.xml', 'word/_rels/document.xml.rels'):
+                self.love_zip.writestr(name, blob)
+
+        document = template['word/document.xml'].decode('utf-8')
+        body_start = document.index('<w:body>') + len('<w:body>')
+        body_end = document.index('<w:sectPr')
+        with self.love_zip.open('word/document.xml', 'w') as f:
+            f.write(document[:body_start].encode('utf-8'))
+            self.body.seek(0)
+            shutil.copyfileobj(self.body, f)
+            f.write(document[body_end:].encode('utf-8'))
+        self.body.close()
+
+        rels = template['word/_rels/document.xml.rels'].decode('utf-8')
+        love_rels = ''.join('<Relationship Id="{}" Type="{}" Target={}{}/>'.format(
+            rId, reltype, quoteattr(target), ' TargetMode="External"' if external else '')
+            for rId, reltype, target, external in self.rels)
+        self.love_zip.writestr('word/_rels/document.xml.rels', rels.replace('</Relationships>',
+                                                                            love_rels + '</Relationships>'))
+
+        content_types = template['[Content_Types].xml'].decode('utf-8')
+        love_types = ''.join('<Default Extension="{}" ContentType="{}"/>'.format(ext, content_type)
+                             for ext, content_type in self.image_exts.items()
+                             if 'Extension="' + ext + '"' not in content_types)
+        self.love_zip.writestr('[Content_Types].xml', content_types.replace('<Default ', love_types + '<Default ', 1))
+        self.love_zip.close()
+        os.replace(self.part_file, self.filename)
@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from wcconst import TYPE_VOIP, LoveColumns, love_ms_to_time, love_time_to_ms
+from wcdb import LOVE_BATCH, get_md5, love_session, love_voip_seconds
+
+# 快照保存的文件夹，每个联系人一个子文件夹（备注的md5）
+SNAP_DIR = 'love_snapshot'
+# 快照对应的数据库，修改时间或大小变了快照就作废
+SNAP_DB = 'EnMicroMsg-decrypted.db'
+SNAP_META = 'meta.json'
+# 列名 -> 类型；content_offsets比消息数多一个，第i条消息的内容为content.bin[offsets[i]:offsets[i+1]]
+SNAP_COLUMNS = {
+    'createTime': np.int64,
+    'type': np.int64,
+    'isSend': np.uint8,
+    'voip_seconds': np.int32,
+}
+SNAP_CONTENT = 'content.bin'
+SNAP_OFFSETS = 'content_offsets'
+
+
+def _snap_path(conRemark, snap_dir=SNAP_DIR):
+    return os.path.join(snap_dir, get_md5(conRemark))
+
+
+def _snap_db_state(db=SNAP_DB):
+    st = os.stat(db)
+    return {'db_mtime_ns': st.st_mtime_ns, 'db_size': st.st_size}
+
+
+class LoveSnapshot(object):
+    """
+    按列保存的聊天记录快照：每列是一个.npy文件，打开时内存映射，不读入内存也不查询数据库；
+    消息内容拼接在content.bin中，按偏移量取出
+    """
+
+    def __init__(self, path, meta):
+        """
+        :param path: 快照文件夹
+        :param meta: meta.json的内容
+        """
+        self.path = path
+        self.meta = meta
+        for name in SNAP_COLUMNS:
+            setattr(self, name, self._load(name))
+        self.content_offsets = self._load(SNAP_OFFSETS)
+        self.content_blob = self._load_blob()
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def _load_blob(self):
+        '''空文件不能内存映射'''
+        if not self.meta['content_bytes']:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(os.path.join(self.path, SNAP_CONTENT), dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.createTime)
+
+    def content(self, index):
+        """
+        :param index: 消息序号
+        :return: 第index条消息的内容
+        """
+        start, end = self.content_offsets[index], self.content_offsets[index + 1]
+        return self.content_blob[start:end].tobytes().decode('utf-8')
+
+    def columns(self, timeStart=None, timeEnd=None):
+        """
+        取出时间范围内的消息给wcstats中的统计函数使用
+
+        :param timeStart: 开始时间，为空时从第一条消息开始
+        :param timeEnd: 结束时间（不含），为空时到最后一条消息
+        :return: LoveColumns
+        """
+        start = np.searchsorted(self.createTime, love_time_to_ms(timeStart)) if timeStart else 0
+        end = np.searchsorted(self.createTime, love_time_to_ms(timeEnd)) if timeEnd else len(self)
+        return LoveColumns(self.createTime[start:end], self.isSend[start:end], self.type[start:end])
+
+
+def open_love_snapshot(conRemark, snap_dir=SNAP_DIR, db=SNAP_DB):
+    """
+    打开联系人的快照
+
+    :param conRemark: 备注
+    :param snap_dir: 快照文件夹
+    :param db: 解密后的数据库，修改过时快照作废
+    :return: LoveSnapshot，没有快照或已作废时返回None
+    """
+    path = _snap_path(conRemark, snap_dir)
+    try:
+        with open(os.path.join(path, SNAP_META), encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('conRemark') != conRemark or any(meta.get(key) != value for key, value in _snap_db_state(db).items()):
+        return None
+    return LoveSnapshot(path, meta)
+
+
+def build_love_snapshot(conRemark, session=None, snap_dir=SNAP_DIR, db=SNAP_DB, batch_size=LOVE_BATCH):
+    """
+    导出联系人的快照：按时间顺序把每条消息的时间、类型、收发和通话时长写成.npy，内容写入content.bin
+
+    :param conRemark: 备注
+    :param session: 导出会话，为空时临时打开数据库
+    :param snap_dir: 快照文件夹
+    :param db: 解密后的数据库
+    :param batch_size: 每批读取的行数
+    :return: LoveSnapshot
+    """
+    path = _snap_path(conRemark, snap_dir)
+    os.makedirs(path, exist_ok=True)
+    meta_file = os.path.join(path, SNAP_META)
+    '''先删掉meta.json，写到一半中断时快照视为不存在'''
+    if os.path.isfile(meta_file):
+        os.remove(meta_file)
+    db_state = _snap_db_state(db)
+    select_love_snapshot = 'SELECT msg.createTime, msg.type, msg.isSend, msg.content, msg.lvbuffer ' \
+                           'FROM message msg ' \
+                           'WHERE msg.talker = ? ' \
+                           'ORDER BY msg.createTime;'
+    chunks = {name: [] for name in SNAP_COLUMNS}
+    offsets = [np.zeros(1, dtype=np.int64)]
+    content_bytes = 0
+    with love_session(session) as session, open(os.path.join(path, SNAP_CONTENT), 'wb') as blob:
+        talker = session.get_love_wxid(conRemark)
+        cur = session.query(select_love_snapshot, (talker,))
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                '''每批转成数组再拼接，不为每条消息保留Python对象'''
+                createTime, msg_type, isSend, content, buffer = zip(*rows)
+                content = [(love_content or '').encode('utf-8') for love_content in content]
+                blob.write(b''.join(content))
+                content_len = np.array([len(love_content) for love_content in content], dtype=np.int64)
+                offsets.append(content_bytes + np.cumsum(content_len))
+                content_bytes += int(content_len.sum())
+                love_batch = {
+                    'createTime': createTime,
+                    'type': msg_type,
+                    'isSend': isSend,
+                    'voip_seconds': [love_voip_seconds(love_buffer) if love_type == TYPE_VOIP else 0
+                                     for love_type, love_buffer in zip(msg_type, buffer)],
+                }
+                for name, dtype in SNAP_COLUMNS.items():
+                    chunks[name].append(np.asarray(love_batch[name], dtype=dtype))
+        finally:
+            cur.close()
+    for name, dtype in SNAP_COLUMNS.items():
+        column = np.concatenate(chunks[name]) if chunks[name] else np.zeros(0, dtype=dtype)
+        np.save(os.path.join(path, name + '.npy'), column)
+    offsets = np.concatenate(offsets)
+    np.save(os.path.join(path, SNAP_OFFSETS + '.npy'), offsets)
+    meta = dict(db_state, conRemark=conRemark, talker=talker, count=len(offsets) - 1, content_bytes=content_bytes,
+                created=love_ms_to_time(int(time.time() * 1000)))
+    tmp_file = meta_file + '.' + str(os.getpid())
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_file, meta_file)
+    return LoveSnapshot(path, meta)
+
+
+def love_snapshot(conRemark, session=None, snap_dir=SNAP_DIR, db=SNAP_DB):
+    """
+    打开联系人的快照，没有或已作废时重新导出
+
+    :param conRemark: 备注
+    :param session: 导出会话，为空时临时打开数据库
+    :param snap_dir: 快照文件夹
+    :param db: 解密后的数据库
+    :return: LoveSnapshot
+    """
+    snapshot = open_love_snapshot(conRemark, snap_dir, db)
+    if snapshot is None:
+        snapshot = build_love_snapshot(conRemark, session, snap_dir, db)
+    return snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description='把与指定备注的联系人的聊天记录按列导出为快照，统计时直接内存映射读取')
+    parser.add_argument('conRemark', nargs='+', help='联系人备注')
+    parser.add_argument('--snap-dir', default=SNAP_DIR, help='快照文件夹')
+    parser.add_argument('--rebuild', action='store_true', help='数据库没有变化也重新导出')
+    args = parser.parse_args()
+    with love_session() as session:
+        for conRemark in args.conRemark:
+            snapshot = None if args.rebuild else open_love_snapshot(conRemark, args.snap_dir)
+            if snapshot is None:
+                snapshot = build_love_snapshot(conRemark, session, args.snap_dir)
+            print(conRemark, len(snapshot), snapshot.path)
+
+
+if __name__ == '__main__':
+    main()
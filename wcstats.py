@@ -0,0 +1,161 @@
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from wcconst import TYPE_SYSTEM, TYPE_VOIP, love_ms_to_time
+
+# 凌晨06:30之前发的消息算熬夜（秒）
+LOVE_NIGHT_END = 23400
+# 和上一条消息相隔这么久（秒）算开始新的一段对话
+LOVE_SESSION_GAP = 3600
+
+'''深夜畅聊：talk_days为对方凌晨还在发消息（或通话）的天数，night_days为至少有一人凌晨发消息的天数，
+first_night为第一次凌晨发消息的时间，midnight_days为当天第一条消息卡在00:00的天数，
+send_night_days/receive_night_days为自己/对方凌晨发消息的天数'''
+LoveNight = namedtuple('LoveNight', ['talk_days', 'night_days', 'first_night', 'midnight_days', 'send_night_days',
+                                     'receive_night_days'])
+'''活跃时间：heatmap为[星期, 小时]的消息数（7×24，星期一为0），send/receive为自己/对方的部分，
+hours为每个小时的消息数，weekdays为每个星期几的消息数'''
+LoveActivity = namedtuple('LoveActivity', ['heatmap', 'send', 'receive', 'hours', 'weekdays'])
+'''一组数值的分布：个数、平均、中位数、90%分位数、最大值'''
+LovePercentiles = namedtuple('LovePercentiles', ['count', 'mean', 'median', 'p90', 'max'])
+'''回复用时（秒）：send/receive为自己/对方回复的用时，months为{'%Y-%m': (send, receive)}'''
+LoveReply = namedtuple('LoveReply', ['send', 'receive', 'months'])
+'''对话：count为段数，messages为每段的消息数，seconds为每段持续的秒数，send_first为自己先开口的段数'''
+LoveSessions = namedtuple('LoveSessions', ['count', 'messages', 'seconds', 'send_first'])
+
+
+def love_local_seconds(createTime):
+    """
+    毫秒时间戳转换为本地时间的秒数（相对1970-01-01 00:00:00本地时间）。
+    时区偏移按小时取一次，夏令时切换也不会算错
+
+    :param createTime: 毫秒时间戳数组
+    :return: int64数组
+    """
+    seconds = np.asarray(createTime, dtype=np.int64) // 1000
+    hours, index = np.unique(seconds // 3600, return_inverse=True)
+    offsets = np.array([time.localtime(int(hour) * 3600).tm_gmtoff for hour in hours], dtype=np.int64)
+    return seconds + offsets[index.reshape(-1)]
+
+
+def love_days(local_seconds):
+    """
+    :param local_seconds: love_local_seconds的结果
+    :return: (天序号, 当天的秒数)
+    """
+    return np.divmod(local_seconds, 86400)
+
+
+def love_night(columns):
+    """
+    统计深夜畅聊，按真实日期区分每一天（不同月份的同一天不会混在一起）
+
+    :param columns: LoveColumns，按时间排序
+    :return: LoveNight
+    """
+    local_seconds = love_local_seconds(columns.createTime)
+    days, seconds = love_days(local_seconds)
+    night = seconds < LOVE_NIGHT_END
+    '''对方发的消息或通话'''
+    talk = (columns.isSend == 0) | (columns.type == TYPE_VOIP)
+    send = columns.isSend == 1
+    first_night = None
+    if night.any():
+        first_night = love_ms_to_time(int(columns.createTime[np.argmax(night)]))
+    return LoveNight(talk_days=len(np.unique(days[night & talk])),
+                     night_days=len(np.unique(days[night])),
+                     first_night=first_night,
+                     midnight_days=len(np.unique(days[seconds < 60])),
+                     send_night_days=len(np.unique(days[night & send])),
+                     receive_night_days=len(np.unique(days[night & ~send])))
+
+
+def love_activity(columns):
+    """
+    统计一周中每天每个小时的消息数，分别统计自己和对方
+
+    :param columns: LoveColumns
+    :return: LoveActivity
+    """
+    days, seconds = love_days(love_local_seconds(columns.createTime))
+    '''1970-01-01是星期四'''
+    cells = (days + 3) % 7 * 24 + seconds // 3600
+    send = columns.isSend == 1
+    send_map = np.bincount(cells[send], minlength=7 * 24).reshape(7, 24)
+    receive_map = np.bincount(cells[~send], minlength=7 * 24).reshape(7, 24)
+    heatmap = send_map + receive_map
+    return LoveActivity(heatmap, send_map, receive_map, heatmap.sum(axis=0), heatmap.sum(axis=1))
+
+
+def love_percentiles(values):
+    """
+    :param values: 数组
+    :return: LovePercentiles，没有数据时各项为None
+    """
+    if not len(values):
+        return LovePercentiles(0, None, None, None, None)
+    p50, p90 = np.percentile(values, (50, 90))
+    return LovePercentiles(len(values), float(np.mean(values)), float(p50), float(p90), float(np.max(values)))
+
+
+def love_sessions_index(createTime, gap=LOVE_SESSION_GAP):
+    """
+    按间隔切分对话：和上一条消息相隔gap秒及以上时开始新的一段（同IS_3_min按时间差判断显示时间）
+
+    :param createTime: 毫秒时间戳数组，按时间排序
+    :param gap: 间隔（秒）
+    :return: 每条消息所在对话的序号
+    """
+    createTime = np.asarray(createTime, dtype=np.int64)
+    return np.cumsum(np.diff(createTime, prepend=createTime[:1]) >= gap * 1000)
+
+
+def _love_chat(columns):
+    '''系统消息（撤回、转账提示等）不是谁发的消息，不参与统计'''
+    chat = columns.type != TYPE_SYSTEM
+    return columns.createTime[chat], columns.isSend[chat]
+
+
+def love_reply(columns, gap=LOVE_SESSION_GAP):
+    """
+    回复速度：同一段对话中换人说话时，后一条消息与前一条的时间差就是回复用时
+
+    :param columns: LoveColumns，按时间排序
+    :param gap: 切分对话的间隔（秒），隔了这么久才说话算开始新的对话，不算回复
+    :return: LoveReply
+    """
+    createTime, isSend = _love_chat(columns)
+    session = love_sessions_index(createTime, gap)
+    '''第i条是对第i-1条的回复：换了人说话且在同一段对话中'''
+    reply = (isSend[1:] != isSend[:-1]) & (session[1:] == session[:-1])
+    latency = (np.diff(createTime) / 1000)[reply]
+    send = isSend[1:][reply] == 1
+    months = love_local_seconds(createTime[1:][reply]).astype('datetime64[s]').astype('datetime64[M]')
+    love_months = {}
+    for month in np.unique(months):
+        in_month = months == month
+        love_months[str(month)] = (love_percentiles(latency[in_month & send]),
+                                   love_percentiles(latency[in_month & ~send]))
+    return LoveReply(love_percentiles(latency[send]), love_percentiles(latency[~send]), love_months)
+
+
+def love_sessions(columns, gap=LOVE_SESSION_GAP):
+    """
+    对话统计：有多少段对话、每段多少条消息、持续多久、谁先开口
+
+    :param columns: LoveColumns，按时间排序
+    :param gap: 切分对话的间隔（秒）
+    :return: LoveSessions
+    """
+    createTime, isSend = _love_chat(columns)
+    if not len(createTime):
+        return LoveSessions(0, love_percentiles([]), love_percentiles([]), 0)
+    session = love_sessions_index(createTime, gap)
+    '''每段的第一条和最后一条：session有变化的位置'''
+    starts = np.flatnonzero(np.diff(session, prepend=-1))
+    ends = np.append(starts[1:], len(createTime)) - 1
+    return LoveSessions(len(starts), love_percentiles(ends - starts + 1),
+                        love_percentiles((createTime[ends] - createTime[starts]) / 1000),
+                        int(np.count_nonzero(isSend[starts] == 1)))
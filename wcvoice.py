@@ -0,0 +1,88 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from wcblob import link_file
+from wechat_dump.wechat.audio import convert_wechat_audio_file
+
+# 转换好的mp3保存的文件夹，文件名为语音文件内容的md5，重新导出和导出范围重叠时直接使用
+VOICE_CACHE_DIR = 'voice_cache'
+
+
+class VoiceCache(object):
+    """
+    语音转换：用wechat_dump的AMR/SILK解码把语音转成mp3，按语音文件内容的md5缓存在磁盘上。
+    转换由sox/silk解码器子进程完成，线程池即可占满所有核
+    """
+
+    def __init__(self, cache_dir=VOICE_CACHE_DIR, workers=None):
+        """
+        :param cache_dir: 缓存文件夹
+        :param workers: 同时转换的语音数，为空时为CPU核数
+        """
+        self.cache_dir = cache_dir
+        self.workers = workers or os.cpu_count() or 1
+
+    def _cache_file(self, md5):
+        return os.path.join(self.cache_dir, md5[:2], md5 + '.mp3')
+
+    def transcode(self, voice_file):
+        """
+        把一条语音转成mp3
+
+        :param voice_file: 语音文件路径（voice2下的.amr）
+        :return: 缓存中的mp3路径；无法转换时返回None
+        """
+        try:
+            with open(voice_file, 'rb') as f:
+                md5 = hashlib.md5(f.read()).hexdigest()
+            cache_file = self._cache_file(md5)
+            if os.path.isfile(cache_file):
+                return cache_file
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            '''先转换到临时文件再改名，并行导出时不会读到写了一半的文件；sox按后缀判断格式，临时文件也以.mp3结尾'''
+            tmp_file = '{}.{}.{}.mp3'.format(cache_file[:-4], os.getpid(), threading.get_ident())
+            try:
+                convert_wechat_audio_file(voice_file, tmp_file)
+                os.replace(tmp_file, cache_file)
+            finally:
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+            return cache_file
+        except Exception:
+            return None
+
+    def transcode_all(self, voices):
+        """
+        并行转换一批语音，并链接到文档旁的文件夹
+
+        :param voices: [(语音文件路径, 输出的mp3路径)]
+        :return: 转换失败的[(语音文件路径, 输出的mp3路径)]
+        """
+        if not voices:
+            return []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            cache_files = list(pool.map(self.transcode, [voice_file for voice_file, mp3_file in voices]))
+        failed = []
+        for (voice_file, mp3_file), cache_file in zip(voices, cache_files):
+            if cache_file is None:
+                failed.append((voice_file, mp3_file))
+                continue
+            link_file(cache_file, mp3_file)
+        return failed
+
+
+_voice_cache = None
+
+
+def get_voice_cache():
+    """
+    默认设置的语音缓存
+
+    :return: VoiceCache
+    """
+    global _voice_cache
+    if _voice_cache is None:
+        _voice_cache = VoiceCache()
+    return _voice_cache
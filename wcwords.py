@@ -0,0 +1,76 @@
+import re
+from collections import deque, namedtuple
+
+# 默认统计的称呼/情话，sum_love_*系列函数各统计其中一个
+LOVE_WORDS = ('宝宝', '乖乖', '我爱你', '爱你', '爱', '晚安')
+
+'''一个关键词的统计结果：send/receive为自己/对方说的次数，first/last为第一次/最后一次的时间，
+months为{'%Y-%m': 次数}（按时间顺序）'''
+LoveWord = namedtuple('LoveWord', ['word', 'count', 'send', 'receive', 'first', 'last', 'months'])
+
+
+class WordMatcher(object):
+    """
+    多关键词匹配（Aho-Corasick自动机）：一次扫描文本就能数出所有关键词。
+    每个关键词的计数与str.count一致（同一关键词的出现互不重叠），不同关键词之间可以重叠，
+    例如“我爱你”同时计入“我爱你”、“爱你”和“爱”
+    """
+
+    def __init__(self, words):
+        """
+        :param words: 关键词列表，不能有空字符串
+        """
+        self.words = tuple(dict.fromkeys(words))
+        if not self.words or not all(self.words):
+            raise ValueError('words must be non-empty strings')
+        '''goto[状态] = {字符: 下一个状态}；out[状态] = 在该状态结束的关键词序号'''
+        self._goto = [{}]
+        self._out = [()]
+        for index, word in enumerate(self.words):
+            state = 0
+            for char in word:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._out.append(())
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._out[state] += (index,)
+        '''按层次遍历建立失败指针，并把失败状态的输出合并进来'''
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state] += self._out[self._fail[next_state]]
+                queue.append(next_state)
+        '''正则预筛：大多数消息不含任何关键词，由re在C里直接跳过'''
+        self._any = re.compile('|'.join(map(re.escape, sorted(self.words, key=len, reverse=True))))
+
+    def count(self, text):
+        """
+        数出文本中每个关键词出现的次数
+
+        :param text:
+        :return: [次数]，与words一一对应
+        """
+        counts = [0] * len(self.words)
+        if not text or self._any.search(text) is None:
+            return counts
+        goto, fail, out, words = self._goto, self._fail, self._out, self.words
+        '''每个关键词上次匹配结束的位置，同一关键词的出现不重叠'''
+        last_end = [0] * len(words)
+        state = 0
+        for pos, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for index in out[state]:
+                if pos - len(words[index]) >= last_end[index]:
+                    counts[index] += 1
+                    last_end[index] = pos
+        return counts
+
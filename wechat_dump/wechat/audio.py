@@ -26,6 +26,13 @@ def do_parse_wechat_audio_file(file_name):
     with tempfile.TemporaryDirectory(prefix="wechatdump_audio") as temp:
         mp3_file = os.path.join(temp,
                                 os.path.basename(file_name)[:-4] + '.mp3')
+        duration = convert_wechat_audio_file(file_name, mp3_file)
+        mp3_string = get_file_b64(mp3_file)
+    return mp3_string, duration
+
+def convert_wechat_audio_file(file_name, mp3_file):
+    """ convert an AMR/SILK voice file to mp3_file, return the duration"""
+    with tempfile.TemporaryDirectory(prefix="wechatdump_audio") as temp:
         with open(file_name, 'rb') as f:
             header = f.read(10)
         if b'AMR' in header:
@@ -62,8 +69,7 @@ def do_parse_wechat_audio_file(file_name):
             subproc_succ('sox -r 24000 -e signed -b 16 -c 1 {} {}'.format(raw_file, mp3_file))
         else:
             raise NotImplementedError("Audio file format cannot be recognized.")
-        mp3_string = get_file_b64(mp3_file)
-    return mp3_string, duration
+    return duration
 
 if __name__ == '__main__':
     import sys
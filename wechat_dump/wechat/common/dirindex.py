@@ -0,0 +1,128 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import sqlite3
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+# A directory modified this close to the scan may change again within the
+# same mtime tick, so its mtime is not trusted and it is rescanned next time.
+RACY_NS = 2 * 10 ** 9
+
+
+class DirIndex(object):
+    """ Listing of a directory tree, persisted in a small sqlite file.
+        Later runs only rescan the directories whose mtime changed.
+    """
+    def __init__(self, top, cache_file=None):
+        """
+        Args:
+            top: root of the directory tree
+            cache_file: sqlite file to store the listing in. Several trees
+                can share one file. None to keep the listing in memory only.
+        """
+        self.top = os.path.abspath(top)
+        self.cache_file = cache_file
+        self._dirs = {}
+        self.refresh()
+
+    def refresh(self):
+        """ Bring the listing up to date with the file system. """
+        start_time = time.time()
+        cached = self._load()
+        dirs = {}
+        dirty = []
+        now = time.time_ns()
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.top, rel)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            entry = cached.get(rel)
+            if entry is None or entry[0] != mtime:
+                entry = self._scan(path, mtime, now)
+                dirty.append(rel)
+            dirs[rel] = entry
+            stack.extend(os.path.join(rel, d) if rel else d for d in entry[2])
+        removed = [k for k in cached if k not in dirs]
+        self._dirs = dirs
+        self._save(dirs, dirty, removed)
+        logger.debug("Indexed {} directories under {} in {:.2f} seconds, {} rescanned.".format(
+            len(dirs), self.top, time.time() - start_time, len(dirty)))
+
+    @staticmethod
+    def _scan(path, mtime, now):
+        files, subdirs = [], []
+        try:
+            for entry in os.scandir(path):
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+        except OSError:
+            logger.warning("Cannot list directory {}".format(path))
+        if now - mtime < RACY_NS:
+            mtime = -1
+        return mtime, tuple(sorted(files)), tuple(sorted(subdirs))
+
+    def _connect(self):
+        conn = sqlite3.connect(self.cache_file)
+        conn.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                     'top TEXT, path TEXT, mtime INTEGER, files TEXT, subdirs TEXT, '
+                     'PRIMARY KEY (top, path))')
+        return conn
+
+    def _load(self):
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return {}
+        try:
+            conn = self._connect()
+            try:
+                rows = conn.execute('SELECT path, mtime, files, subdirs FROM dirs WHERE top = ?',
+                                    (self.top,)).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            logger.warning("Cannot read directory index {}".format(self.cache_file))
+            return {}
+        # '/' can never appear in a file name, so it separates the names
+        return {path: (mtime, tuple(files.split('/')) if files else (),
+                       tuple(subdirs.split('/')) if subdirs else ())
+                for path, mtime, files, subdirs in rows}
+
+    def _save(self, dirs, dirty, removed):
+        if not self.cache_file or not (dirty or removed):
+            return
+        try:
+            conn = self._connect()
+        except sqlite3.Error:
+            logger.warning("Cannot write directory index {}".format(self.cache_file))
+            return
+        try:
+            with conn:
+                conn.executemany('DELETE FROM dirs WHERE top = ? AND path = ?',
+                                 [(self.top, k) for k in removed])
+                conn.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)',
+                                 [(self.top, k, dirs[k][0], '/'.join(dirs[k][1]), '/'.join(dirs[k][2]))
+                                  for k in dirty])
+        except sqlite3.Error:
+            logger.warning("Cannot write directory index {}".format(self.cache_file))
+        finally:
+            conn.close()
+
+    def listdir(self, rel):
+        """ Returns: file names directly under top/rel, or None if no such directory. """
+        entry = self._dirs.get(os.path.normpath(rel) if rel else '')
+        if entry is None:
+            return None
+        return entry[1]
+
+    def listing(self):
+        """ Returns: a dict mapping each directory (relative to top, '/'-separated)
+            to the file names directly under it.
+        """
+        return {k.replace(os.sep, '/'): v[1] for k, v in self._dirs.items()}
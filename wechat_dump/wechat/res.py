@@ -16,6 +16,7 @@ from .emoji import EmojiReader
 from .avatar import AvatarReader
 from .common.textutil import md5 as get_md5_hex, get_file_b64
 from .common.timer import timing
+from .common.dirindex import DirIndex
 from .msg import TYPE_SPEAK
 from .audio import parse_wechat_audio_file
 
@@ -24,16 +25,20 @@ VOICE_DIRNAME = 'voice2'
 IMG_DIRNAME = 'image2'
 EMOJI_DIRNAME = 'emoji'
 VIDEO_DIRNAME = 'video'
+MEDIA_INDEX_NAME = 'media_index.db'
 
 JPEG_QUALITY = 50
 
 class Resource(object):
     """ multimedia resources in chat"""
-    def __init__(self, parser, res_dir, avt_db):
+    def __init__(self, parser, res_dir, avt_db, media_index=None):
         """
         Args:
             res_dir: path to the resource directory
             avt_db: "avatar.index" file that only exists in old versions of wechat
+            media_index: a sqlite file to cache the listing of image directories.
+                default to a media_index.db file under res_dir, so that
+                each backup keeps its own listing.
         """
         def check(subdir):
             dir_to_check = os.path.join(res_dir, subdir)
@@ -41,9 +46,12 @@ class Resource(object):
         [check(k) for k in ['', IMG_DIRNAME, EMOJI_DIRNAME, VOICE_DIRNAME]]
 
         self.res_dir = res_dir
+        if media_index is None:
+            media_index = os.path.join(res_dir, MEDIA_INDEX_NAME)
         self.parser = parser
         self.voice_cache_idx = {}
         self.img_dir = os.path.join(res_dir, IMG_DIRNAME)
+        self.img_index = DirIndex(self.img_dir, media_index)
         self.voice_dir = os.path.join(res_dir, VOICE_DIRNAME)
         self.video_dir = os.path.join(res_dir, VIDEO_DIRNAME)
         self.avt_reader = AvatarReader(res_dir, avt_db)
@@ -105,10 +113,11 @@ class Resource(object):
         for fname in fnames:
             dir1, dir2 = fname[:2], fname[2:4]
             dirname = os.path.join(self.img_dir, dir1, dir2)
-            if not os.path.isdir(dirname):
+            files = self.img_index.listdir(os.path.join(dir1, dir2))
+            if files is None:
                 logger.warn("Directory not found: {}".format(dirname))
                 continue
-            for f in os.listdir(dirname):
+            for f in files:
                 if fname in f:
                     full_name = os.path.join(dirname, f)
                     size = os.path.getsize(full_name)